@@ -0,0 +1,76 @@
+""" Micro-benchmark of ACLEncoderMixin.stringify_acl/objectify_acl and
+validate_acl.
+
+Simulates decoding a page of 50 items with 20 ACEs each and a single
+ACL of 5000 ACEs.
+"""
+from pyramid.security import (
+    Allow, Deny, Everyone, Authenticated, ALL_PERMISSIONS)
+
+from harness import best_rate, report, run
+from nefertari_guards.base import ACLEncoderMixin
+
+
+ITEMS = 50
+ACES_PER_ITEM = 20
+LARGE_ACL = 5000
+
+
+def make_acl(size):
+    """ Generate Pyramid ACL of :size: entries using a mix of special
+    and regular principals/permissions.
+    """
+    principals = [Everyone, Authenticated, 'g:admins', 'user1', 'user2']
+    permissions = ['view', 'update', 'delete', ALL_PERMISSIONS]
+    acl = []
+    for index in range(size):
+        action = Deny if index % 7 == 0 else Allow
+        acl.append((
+            action,
+            principals[index % len(principals)],
+            permissions[index % len(permissions)],
+        ))
+    return acl
+
+
+def main():
+    object_page = [make_acl(ACES_PER_ITEM) for _ in range(ITEMS)]
+    string_page = [ACLEncoderMixin.stringify_acl(acl)
+                   for acl in object_page]
+    entries = ITEMS * ACES_PER_ITEM
+
+    def stringify():
+        for acl in object_page:
+            ACLEncoderMixin.stringify_acl(acl)
+
+    def objectify():
+        for acl in string_page:
+            ACLEncoderMixin.objectify_acl(acl)
+
+    def objectify_cached():
+        for acl in string_page:
+            ACLEncoderMixin.objectify_acl_cached(acl)
+
+    def validate():
+        for acl in string_page:
+            encoder.validate_acl(acl)
+
+    encoder = ACLEncoderMixin()
+    report('stringify_acl', best_rate(stringify, entries, number=20))
+    report('objectify_acl', best_rate(objectify, entries, number=20))
+    report('objectify_acl_cached',
+           best_rate(objectify_cached, entries, number=20))
+    report('validate_acl', best_rate(validate, entries, number=20))
+
+    large_acl = make_acl(LARGE_ACL)
+    large_string_acl = ACLEncoderMixin.stringify_acl(large_acl)
+    report('stringify_acl (large)', best_rate(
+        lambda: ACLEncoderMixin.stringify_acl(large_acl), LARGE_ACL))
+    report('objectify_acl (large)', best_rate(
+        lambda: ACLEncoderMixin.objectify_acl(large_string_acl), LARGE_ACL))
+    report('validate_acl (large)', best_rate(
+        lambda: encoder.validate_acl(large_string_acl), LARGE_ACL))
+
+
+if __name__ == '__main__':
+    run(main)
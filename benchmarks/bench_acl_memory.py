@@ -0,0 +1,56 @@
+""" Memory taken by 1M ACEs loaded as ACE dicts, ACE dicts with
+interned strings and CompactACL.
+
+ACLs are decoded from JSON as they would be loaded from database or
+ES, so equal strings of different ACLs are separate objects.
+"""
+import json
+import sys
+
+from harness import measure_memory, report_size, run
+from nefertari_guards.base import ACLEncoderMixin
+from nefertari_guards.elasticsearch import intern_acls
+
+
+ACLS = 100000
+ACES_PER_ACL = 10
+
+
+def make_acl_json(index):
+    acl = [{
+        'action': 'deny' if ace % 7 == 0 else 'allow',
+        'principal': 'g:group{}'.format((index + ace) % 50),
+        'permission': ['view', 'update', 'delete', 'all'][ace % 4],
+    } for ace in range(ACES_PER_ACL)]
+    return json.dumps(acl)
+
+
+def main():
+    if sys.version_info < (3, 4):
+        print('tracemalloc is required')
+        return
+    dumped = [make_acl_json(index) for index in range(ACLS)]
+    entries = ACLS * ACES_PER_ACL
+
+    dicts, size = measure_memory(
+        lambda: [json.loads(acl) for acl in dumped])
+    report_size('ACE dicts ({:,})'.format(entries), size, entries, 'aces')
+
+    def load_interned():
+        acls = [json.loads(acl) for acl in dumped]
+        for acl in acls:
+            intern_acls({'_acl': acl})
+        return acls
+
+    interned, size = measure_memory(load_interned)
+    report_size('ACE dicts, interned ({:,})'.format(entries), size,
+                entries, 'aces')
+
+    compact, size = measure_memory(
+        lambda: [ACLEncoderMixin.compact_acl(json.loads(acl))
+                 for acl in dumped])
+    report_size('CompactACL ({:,})'.format(entries), size, entries, 'aces')
+
+
+if __name__ == '__main__':
+    run(main)
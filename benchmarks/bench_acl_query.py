@@ -0,0 +1,52 @@
+""" Benchmark of building ES ACL filtering queries.
+
+Builds queries for requests with 10, 100 and 1000 principals using
+nested and flattened ACL fields.
+"""
+from mock import patch
+
+from harness import best_rate, report, run
+from nefertari_guards import elasticsearch as es
+from nefertari_guards.base import ACLEncoderMixin
+
+
+PRINCIPALS = [10, 100, 1000]
+
+
+def make_principals(size):
+    principals = ['system.Everyone', 'system.Authenticated', 'user1']
+    principals += ['g:group{}'.format(index) for index in range(size - 3)]
+    return principals
+
+
+class FlatACLField(ACLEncoderMixin):
+    flat_acl = True
+
+
+def main():
+    for acl_field, label in [(ACLEncoderMixin, ''), (FlatACLField, 'flat ')]:
+        with patch.object(es, 'engine') as engine:
+            engine.ACLField = acl_field
+            for size in PRINCIPALS:
+                principals = make_principals(size)
+                report(
+                    '{}build_acl_query ({})'.format(label, size),
+                    best_rate(
+                        lambda: es.build_acl_query(principals, 'view'),
+                        size, number=10),
+                    'principals')
+
+    with patch.object(es, 'engine') as engine:
+        engine.ACLField = ACLEncoderMixin
+        principals = make_principals(PRINCIPALS[-1])
+        es.ACL_QUERY_CACHE.clear()
+        report(
+            'cached_acl_query ({})'.format(PRINCIPALS[-1]),
+            best_rate(
+                lambda: es.cached_acl_query(principals, 'view'),
+                len(principals), number=10),
+            'principals')
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,154 @@
+""" Benchmark of ACL filtering of ES documents relationships.
+
+Generates a page of synthetic 3-level documents: each top-level
+document has 100+ related documents which have relations of their
+own. About a third of related documents is not visible to user.
+"""
+import sys
+from copy import deepcopy
+
+from mock import patch
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import Everyone, Authenticated
+
+from harness import best_rate, report, run
+from nefertari_guards import elasticsearch as es
+from nefertari_guards.base import ACLEncoderMixin
+
+
+PAGE_SIZE = 10
+COMMENTS = 100
+TAGS = 5
+
+PUBLIC_ACL = [
+    {'action': 'allow', 'principal': 'everyone', 'permission': 'view'}]
+OWNER_ACL = [
+    {'action': 'allow', 'principal': 'user1', 'permission': 'all'},
+    {'action': 'allow', 'principal': 'g:admins', 'permission': 'all'},
+]
+PRIVATE_ACL = [
+    {'action': 'deny', 'principal': 'everyone', 'permission': 'view'}]
+ACLS = [PUBLIC_ACL, OWNER_ACL, PRIVATE_ACL]
+
+_NESTED_ACL = {'type': 'nested', 'properties': {}}
+_SCALARS = {
+    '_acl': _NESTED_ACL,
+    'id': {'type': 'long'},
+    'title': {'type': 'string'},
+    'score': {'type': 'float'},
+    'keywords': {'type': 'string'},
+}
+""" ES mapping properties of generated Story documents """
+STORY_PROPERTIES = dict(_SCALARS, comments={
+    'type': 'nested',
+    'properties': dict(_SCALARS, author={
+        'type': 'nested',
+        'properties': dict(_SCALARS, stories={'type': 'long'}),
+    }, tags={
+        'type': 'nested',
+        'properties': dict(_SCALARS, stories={'type': 'long'}),
+    }),
+}, owner={'type': 'nested', 'properties': dict(_SCALARS)})
+
+
+class Request(object):
+    """ Request stub that checks permissions with ACLAuthorizationPolicy.
+    """
+    effective_principals = [Everyone, Authenticated, 'user1']
+    policy = ACLAuthorizationPolicy()
+
+    def has_permission(self, permission, context):
+        return self.policy.permits(
+            context, self.effective_principals, permission)
+
+
+def make_document(_type, index, **relations):
+    document = {
+        '_type': _type,
+        '_acl': ACLS[index % len(ACLS)],
+        'id': index,
+        'title': 'Document {}'.format(index),
+        'score': index * 1.5,
+        'keywords': ['foo', 'bar', 'baz'],
+    }
+    document.update(relations)
+    return document
+
+
+def make_page():
+    """ Generate page of PAGE_SIZE 3-level documents. """
+    page = []
+    for story_id in range(PAGE_SIZE):
+        comments = []
+        for comment_id in range(COMMENTS):
+            author = make_document(
+                'User', comment_id, stories=list(range(20)))
+            tags = [make_document('Tag', tag_id, stories=list(range(20)))
+                    for tag_id in range(TAGS)]
+            comments.append(make_document(
+                'Comment', comment_id, author=author, tags=tags))
+        page.append(make_document(
+            'Story', story_id, comments=comments,
+            owner=make_document('User', story_id)))
+    return page
+
+
+def count_documents(page):
+    count = 0
+    pending = list(page)
+    while pending:
+        document = pending.pop()
+        count += 1
+        for value in document.values():
+            if es.is_document(value):
+                pending.append(value)
+            elif isinstance(value, list):
+                pending.extend(v for v in value if es.is_document(v))
+    return count
+
+
+def main():
+    page = make_page()
+    documents = count_documents(page)
+
+    def setup():
+        return Request(), deepcopy(page)
+
+    def check(request, page):
+        for document in page:
+            es.check_relations_permissions(request, document)
+
+    def filter_page(request, page):
+        es.filter_documents(request, page)
+
+    with patch.object(es, 'engine') as engine:
+        engine.ACLField = ACLEncoderMixin
+        report('check_relations_permissions',
+               best_rate(check, documents, setup=setup), 'documents')
+        report('filter_documents',
+               best_rate(filter_page, documents, setup=setup), 'documents')
+        index = {'Story': es._relations_tree(STORY_PROPERTIES)}
+        with patch.object(es.ACLFilterES, 'relations_index', index):
+            report('check_relations_permissions (index)',
+                   best_rate(check, documents, setup=setup), 'documents')
+            report('filter_documents (index)',
+                   best_rate(filter_page, documents, setup=setup),
+                   'documents')
+
+    deep = {'_type': 'Node', '_acl': PUBLIC_ACL}
+    node = deep
+    for _ in range(sys.getrecursionlimit()):
+        node['child'] = {'_type': 'Node', '_acl': PUBLIC_ACL}
+        node = node['child']
+    with patch.object(es, 'engine') as engine:
+        engine.ACLField = ACLEncoderMixin
+        try:
+            es.check_relations_permissions(Request(), deep)
+        except RuntimeError:
+            print('{:<40} {:>14}'.format('deep nesting', 'RecursionError'))
+        else:
+            print('{:<40} {:>14}'.format('deep nesting', 'ok'))
+
+
+if __name__ == '__main__':
+    run(main)
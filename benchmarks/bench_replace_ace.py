@@ -0,0 +1,49 @@
+""" Benchmark of replacing an ACE in batches of loaded documents.
+
+Documents are stubs, so no database is used. Each document has an ACL
+of 20 ACEs, half of which contain the replaced ACE.
+"""
+from harness import best_rate, report, run
+from nefertari_guards import acl_utils
+
+
+BATCH_SIZES = [500, 5000]
+ACES_PER_ITEM = 20
+
+FROM_ACE = {'action': 'allow', 'principal': 'user1', 'permission': 'view'}
+TO_ACE = {'action': 'allow', 'principal': 'user2', 'permission': 'view'}
+
+
+class Document(object):
+    """ Document stub with `update` method of nefertari documents. """
+    def __init__(self, acl):
+        self._acl = acl
+
+    def update(self, params):
+        self._acl = params['_acl']
+
+
+def make_acl(index):
+    acl = [{'action': 'allow', 'principal': 'g:group{}'.format(ace),
+            'permission': 'view'} for ace in range(ACES_PER_ITEM)]
+    if index % 2:
+        acl[index % ACES_PER_ITEM] = dict(FROM_ACE)
+    return acl
+
+
+def main():
+    # Don't measure logging of documents that don't contain the ACE
+    acl_utils.log.disabled = True
+    for size in BATCH_SIZES:
+        def setup():
+            return ([Document(make_acl(index)) for index in range(size)],)
+
+        def replace(items):
+            acl_utils._replace_docs_ace(items, FROM_ACE, TO_ACE)
+
+        report('_replace_docs_ace ({})'.format(size),
+               best_rate(replace, size, setup=setup), 'documents')
+
+
+if __name__ == '__main__':
+    run(main)
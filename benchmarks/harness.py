@@ -0,0 +1,106 @@
+""" Minimal timing helpers shared by the benchmark scripts.
+
+Scripts in this directory are run directly, e.g.:
+
+    $ python benchmarks/bench_acl_codec.py
+
+Pass ``--json <path>`` to also write results to a JSON file, which may
+be compared between releases. ``run_all.py`` runs all benchmarks.
+Benchmarks don't need elasticsearch or a database.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+
+""" Results reported by `report` in current process """
+RESULTS = []
+
+
+def best_rate(func, entries, repeat=5, number=1, setup=None):
+    """ Run :func: and return the best observed rate in entries/sec.
+
+    :param func: Callable to benchmark.
+    :param entries: Number of entries processed by a single call of
+        :func:.
+    :param repeat: Number of timing rounds. Best round is used.
+    :param number: Number of :func: calls per round.
+    :param setup: Optional callable run before each round and not
+        timed. Its result is passed to :func: as positional arguments.
+    """
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = default_timer()
+        for _ in range(number):
+            func(*args)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return entries * number / best
+
+
+def report(name, rate, unit='entries'):
+    RESULTS.append({'name': name, 'rate': rate, 'unit': unit})
+    print('{:<40} {:>14,.0f} {}/sec'.format(name, rate, unit))
+
+
+def measure_memory(func):
+    """ Call :func: and return (result, number of bytes allocated by
+    call and still held). Uses tracemalloc, so it's not available in
+    python 2.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def report_size(name, size, entries, unit='entries'):
+    RESULTS.append({'name': name, 'bytes': size, 'entries': entries,
+                    'unit': unit})
+    print('{:<40} {:>14,.0f} MiB {:>8.1f} bytes/{}'.format(
+        name, size / 2.0 ** 20, size / float(entries), unit[:-1]))
+
+
+def write_json(path, results=None):
+    """ Write :results: along with environment info to JSON file at
+    :path:. Defaults to results reported so far.
+    """
+    version_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'VERSION')
+    try:
+        with open(version_path) as version_file:
+            version = version_file.read().strip()
+    except IOError:
+        version = None
+    data = {
+        'version': version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'date': datetime.utcnow().isoformat(),
+        'results': RESULTS if results is None else results,
+    }
+    with open(path, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+
+
+def run(main, argv=None):
+    """ Run benchmark :main: function writing results to JSON file if
+    '--json <path>' argument is passed.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', help='Path of JSON results file')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    main()
+    if args.json:
+        write_json(args.json)
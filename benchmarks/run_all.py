@@ -0,0 +1,29 @@
+""" Run all benchmarks in this directory.
+
+    $ python benchmarks/run_all.py --json results.json
+"""
+import bench_acl_codec
+import bench_acl_memory
+import bench_acl_query
+import bench_relations
+import bench_replace_ace
+from harness import run
+
+
+BENCHMARKS = [
+    bench_acl_codec,
+    bench_acl_memory,
+    bench_acl_query,
+    bench_relations,
+    bench_replace_ace,
+]
+
+
+def main():
+    for module in BENCHMARKS:
+        print(module.__name__)
+        module.main()
+
+
+if __name__ == '__main__':
+    run(main)
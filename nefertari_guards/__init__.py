@@ -1,10 +1,17 @@
 from .acl_utils import (
+    acl_report,
+    bulk_update_acl,
     count_ace,
+    count_aces,
+    diff_ace,
     update_ace,
     find_by_ace,
+    iter_by_ace,
 )
 
 
 def includeme(config):
+    config.include('nefertari_guards.metrics')
+    config.include('nefertari_guards.base')
     config.include('nefertari_guards.engine')
     config.include('nefertari_guards.elasticsearch')
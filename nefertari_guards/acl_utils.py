@@ -1,15 +1,31 @@
+import json
 import logging
-from collections import defaultdict
+import os
+import time
+from collections import defaultdict, deque
 from copy import deepcopy
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
+from elasticsearch import helpers
 from nefertari import engine
-from nefertari.elasticsearch import ES
+from nefertari.elasticsearch import ES, IndexNotFoundException
+from nefertari.utils import dict2obj
 
 from .base import ACLEncoderMixin
+from .compact import CompactACL
 
 
 log = logging.getLogger(__name__)
 
+""" Default number of documents fetched and updated at once """
+DEFAULT_BATCH_SIZE = 500
+
+""" Default maximum number of distinct principals reported per model
+and action by ``acl_report``
+"""
+DEFAULT_REPORT_SIZE = 10000
+
 
 def count_ace(ace, models=None):
     """ Count number of given models items with given ace.
@@ -22,47 +38,622 @@ def count_ace(ace, models=None):
     :returns: Dict of format {Model: number_of_matching_docs, ...}.
         Number of matching documents is None if model is not Es-based.
     """
-    counts = {}
+    return count_aces([ace], models)[0]
+
+
+def count_aces(aces, models=None):
+    """ Count number of given models items with each of given aces.
+
+    All ACEs and models are counted with a single ES request which
+    uses 'filters' aggregation by ACE and 'terms' aggregation by
+    document type.
+
+    :param aces: List of stringified ACL entries (ACEs).
+    :param models: List of document classes objects of which should
+        be found and counted.
+    :returns: List of dicts of format {Model: number_of_matching_docs}
+        in order of :aces:. Number of matching documents is None if
+        model is not Es-based.
+    """
     if models is None:
         models = list(engine.get_document_classes().values())
 
-    for model in models:
-        try:
-            counts[model] = find_by_ace(ace, [model], count=True)
-        except ValueError:
-            counts[model] = None
-
+    types = {ES.src2type(model.__name__): model for model in models
+             if getattr(model, '_index_enabled', False)}
+    counts = [
+        {model: (0 if model in types.values() else None)
+         for model in models}
+        for ace in aces]
+    if not types or not aces:
+        return counts
+
+    filters = {str(index): _get_ace_filter(ace)
+               for index, ace in enumerate(aces)}
+    body = {
+        'size': 0,
+        'aggs': {
+            'aces': {
+                'filters': {'filters': filters},
+                'aggs': {
+                    'types': {
+                        'terms': {'field': '_type', 'size': len(types)},
+                    },
+                },
+            },
+        },
+    }
+    try:
+        response = ES.api.search(
+            index=ES.settings.index_name,
+            doc_type=','.join(sorted(types)),
+            body=body)
+    except IndexNotFoundException:
+        return counts
+
+    buckets = response['aggregations']['aces']['buckets']
+    for index, ace_counts in enumerate(counts):
+        for bucket in buckets[str(index)]['types']['buckets']:
+            if bucket['key'] in types:
+                ace_counts[types[bucket['key']]] = bucket['doc_count']
+        log.info('Found {} documents that match ACE {}.'.format(
+            sum(count or 0 for count in ace_counts.values()),
+            str(aces[index])))
     return counts
 
 
-def update_ace(from_ace, to_ace, models=None):
+def acl_report(models=None, size=DEFAULT_REPORT_SIZE):
+    """ Report number of documents per model, ACE action, principal
+    and permission.
+
+    Report is built with a single ES aggregation request. Nested ACL
+    is aggregated by action, principal and permission and documents
+    are counted with 'reverse_nested' aggregation. When flattened ACL
+    fields are enabled, these are aggregated instead.
+
+    :param models: List of document classes objects of which should
+        be reported. Defaults to all es-based models.
+    :param size: Maximum number of distinct principals reported per
+        model and action (or ACE tokens per model and action when
+        flattened ACL is used).
+    :returns: Iterator of dicts with keys 'model', 'action',
+        'principal', 'permission' and 'count'.
+    :raises ValueError: If no es-based models passed.
+    """
+    if models is None:
+        models = list(engine.get_document_classes().values())
+
+    types = {ES.src2type(model.__name__): model for model in models
+             if getattr(model, '_index_enabled', False)}
+    if not types:
+        raise ValueError('No es-based models passed')
+
+    if ACLEncoderMixin.flat_acl:
+        acl_aggs = {
+            action: {'terms': {'field': '_acl_' + action, 'size': size}}
+            for action in ACLEncoderMixin.ACTIONS.values()}
+    else:
+        # Size of 0 returns all buckets, so no action or permission is
+        # dropped (ES returns top 10 buckets by default)
+        acl_aggs = {'acl': {
+            'nested': {'path': '_acl'},
+            'aggs': {'actions': {
+                'terms': {'field': '_acl.action', 'size': 0},
+                'aggs': {'principals': {
+                    'terms': {'field': '_acl.principal', 'size': size},
+                    'aggs': {'permissions': {
+                        'terms': {'field': '_acl.permission', 'size': 0},
+                        'aggs': {'documents': {'reverse_nested': {}}},
+                    }},
+                }},
+            }},
+        }}
+    body = {
+        'size': 0,
+        'aggs': {'types': {
+            'terms': {'field': '_type', 'size': len(types)},
+            'aggs': acl_aggs,
+        }},
+    }
+    try:
+        response = ES.api.search(
+            index=ES.settings.index_name,
+            doc_type=','.join(sorted(types)),
+            body=body)
+    except IndexNotFoundException:
+        return
+
+    for type_bucket in response['aggregations']['types']['buckets']:
+        model = types.get(type_bucket['key'])
+        if model is None:
+            continue
+        if ACLEncoderMixin.flat_acl:
+            rows = _flat_report_rows(type_bucket)
+        else:
+            rows = _nested_report_rows(type_bucket)
+        for action, principal, permission, count in rows:
+            yield {
+                'model': model.__name__,
+                'action': action,
+                'principal': principal,
+                'permission': permission,
+                'count': count,
+            }
+
+
+def _nested_report_rows(type_bucket):
+    """ Get (action, principal, permission, count) tuples from
+    nested ACL aggregation of ``acl_report``.
+    """
+    for action in type_bucket['acl']['actions']['buckets']:
+        for principal in action['principals']['buckets']:
+            for permission in principal['permissions']['buckets']:
+                yield (
+                    action['key'], principal['key'], permission['key'],
+                    permission['documents']['doc_count'])
+
+
+def _flat_report_rows(type_bucket):
+    """ Get (action, principal, permission, count) tuples from
+    flattened ACL aggregation of ``acl_report``.
+    """
+    for action in sorted(ACLEncoderMixin.ACTIONS.values()):
+        for token in type_bucket[action]['buckets']:
+            principal, permission = token['key'].rsplit(':', 1)
+            yield action, principal, permission, token['doc_count']
+
+
+def update_ace(from_ace, to_ace, models=None,
+               batch_size=DEFAULT_BATCH_SIZE, commit=False, workers=1,
+               server_side=False, dry_run=False, checkpoint=None,
+               resume=False):
     """ Update documents that contain ``from_ace`` with ``to_ace``.
     In fact ``from_ace`` is replaced with ``to_ace`` in matching
     documents.
 
+    Matching documents are streamed from ES and updated in batches of
+    ``batch_size`` documents. Each batch is loaded from database with
+    a single query per model. Progress and throughput are logged after
+    each batch.
+
     Look into ACLEncoderMixin.stringify_acl for details on ace format.
 
     **NOTE**: When using this util with SQLA outside of request cycle
     transaction management should be done explicitly for changes
-    to be saved.
+    to be saved, e.g. by passing ``commit=True``.
 
     :param from_ace: Stringified ACL entry (ACE) to match agains.
     :param to_ace: Stringified ACL entry (ACE) ``from_ace`` should be
         replaced with. Value is validated.
     :param models: List of document classes objects of which should
         be found and updated.
-    :raises ValueError: If no es-based documents passed.
+    :param batch_size: Number of documents updated at once.
+    :param commit: Boolean. When True transaction is committed after
+        each batch.
+    :param workers: Number of threads used to update documents. When
+        greater than 1, documents of each model in each batch are
+        updated by a separate task in its own DB session and
+        transaction which is always committed.
+    :param server_side: Boolean. When True ACLs are rewritten by
+        database with a single query per model and then updated in ES.
+        See `_update_ace_server_side`.
+    :param dry_run: Boolean. When True nothing is written and iterator
+        of changes is returned instead. See `diff_ace`.
+    :param checkpoint: Path of checkpoint file. When provided,
+        documents are processed in order of their ES '_uid' and the
+        last processed '_uid' is saved to the file after each batch is
+        committed. File is removed once all documents are updated.
+        Requires ``commit=True`` and is not supported with ``workers``
+        or ``server_side``.
+    :param resume: Boolean. When True processing continues after the
+        '_uid' saved in ``checkpoint`` file.
+    :returns: Number of updated documents.
+    :raises ValueError: If no es-based documents passed or checkpoint
+        options are invalid.
     """
     ACLEncoderMixin().validate_acl([to_ace])
     if models is None:
         models = list(engine.get_document_classes().values())
 
-    documents = find_by_ace(from_ace, models)
-    documents = _group_by_type(documents, models)
-    document_ids = _extract_ids(documents)
-    for model, doc_ids in document_ids.items():
-        items = model.get_by_ids(doc_ids)
-        _replace_docs_ace(items, from_ace, to_ace)
+    if checkpoint is not None:
+        if not commit or workers > 1 or server_side or dry_run:
+            raise ValueError(
+                'Checkpoint requires commit and is not supported with '
+                'workers, server_side or dry_run')
+        return _update_ace_checkpointed(
+            from_ace, to_ace, models, batch_size, checkpoint, resume)
+    elif resume:
+        raise ValueError('Checkpoint file is required to resume')
+
+    if dry_run:
+        return diff_ace(from_ace, to_ace, models, batch_size)
+
+    if server_side:
+        return _update_ace_server_side(from_ace, to_ace, models, commit)
+
+    if workers > 1:
+        return _update_ace_parallel(
+            from_ace, to_ace, models, batch_size, workers)
+
+    def replace(model, items):
+        return _replace_docs_ace(items, from_ace, to_ace)
+
+    return _update_batches(
+        iter_by_ace(from_ace, models, batch_size), models, replace,
+        commit=commit)
+
+
+def _update_ace_checkpointed(from_ace, to_ace, models, batch_size,
+                             checkpoint, resume):
+    """ Update documents that contain ``from_ace`` with ``to_ace``
+    saving progress to ``checkpoint`` file after each batch.
+
+    Replacing ACE is idempotent, so a batch that was committed before
+    its checkpoint was saved is safely processed again on resume.
+
+    :returns: Number of updated documents, including ones updated
+        before resume.
+    """
+    state = {'last_uid': None, 'batch': 0, 'updated': 0}
+    if resume:
+        state.update(_load_checkpoint(checkpoint, from_ace, to_ace))
+        log.info('Resuming after batch {} ({})'.format(
+            state['batch'], state['last_uid']))
+
+    previous = state['updated']
+
+    def replace(model, items):
+        return _replace_docs_ace(items, from_ace, to_ace)
+
+    def save_checkpoint(documents, updated):
+        state.update(
+            last_uid=documents[-1]._uid, batch=state['batch'] + 1,
+            updated=previous + updated)
+        _save_checkpoint(checkpoint, from_ace, to_ace, state)
+
+    documents_batches = iter_by_ace(
+        from_ace, models, batch_size, after=state['last_uid'], ordered=True)
+    updated = _update_batches(
+        documents_batches, models, replace, commit=True,
+        after_batch=save_checkpoint)
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return previous + updated
+
+
+def _load_checkpoint(path, from_ace, to_ace):
+    """ Load state saved by ``_save_checkpoint``.
+
+    :returns: Dict with keys 'last_uid', 'batch' and 'updated'.
+    :raises ValueError: If checkpoint was saved for different ACEs.
+    """
+    if not os.path.exists(path):
+        log.warn('Checkpoint {} not found. Starting over.'.format(path))
+        return {}
+    with open(path) as checkpoint_file:
+        data = json.load(checkpoint_file)
+    if data['from_ace'] != from_ace or data['to_ace'] != to_ace:
+        raise ValueError(
+            'Checkpoint {} was saved for different ACEs: {} -> {}'.format(
+                path, data['from_ace'], data['to_ace']))
+    return {key: data[key] for key in ('last_uid', 'batch', 'updated')}
+
+
+def _save_checkpoint(path, from_ace, to_ace, state):
+    """ Atomically save ``update_ace`` progress to file at ``path``. """
+    data = dict(state, from_ace=from_ace, to_ace=to_ace)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(data, checkpoint_file, sort_keys=True)
+    # os.rename is not atomic on Windows when file exists
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def diff_ace(from_ace, to_ace, models=None, batch_size=DEFAULT_BATCH_SIZE):
+    """ Get changes ``update_ace`` would make without writing them.
+
+    Documents are streamed and loaded in batches the same way as in
+    ``update_ace``, so only one batch is kept in memory at a time.
+
+    :param from_ace: Stringified ACL entry (ACE) to match agains.
+    :param to_ace: Stringified ACL entry (ACE) ``from_ace`` should be
+        replaced with.
+    :param models: List of document classes objects of which should
+        be found.
+    :param batch_size: Number of documents loaded at once.
+    :returns: Iterator of dicts with keys 'model', 'id', 'before' and
+        'after' where 'before' and 'after' are documents' ACLs.
+    :raises ValueError: If no es-based documents passed.
+    """
+    if models is None:
+        models = list(engine.get_document_classes().values())
+
+    documents_batches = iter_by_ace(from_ace, models, batch_size)
+    for documents, loaded in _load_batches(documents_batches, models):
+        for model, items in loaded:
+            pk_field = model.pk_field()
+            for item in items:
+                acl = _replace_ace(item._acl, from_ace, to_ace)
+                if acl is None:
+                    continue
+                yield {
+                    'model': model.__name__,
+                    'id': getattr(item, pk_field),
+                    'before': item._acl,
+                    'after': acl,
+                }
+
+
+def _update_ace_parallel(from_ace, to_ace, models, batch_size, workers):
+    """ Update documents that contain ``from_ace`` with ``to_ace``
+    using a pool of ``workers`` threads.
+
+    Documents are split into tasks by model and batch. Number of tasks
+    that are queued or running is limited to twice the number of
+    workers, so only a few batches are kept in memory.
+
+    :returns: Number of updated documents.
+    """
+    started = time.time()
+    updated = 0
+    pending = deque()
+    pool = ThreadPool(workers)
+    try:
+        for documents in iter_by_ace(from_ace, models, batch_size):
+            documents = _group_by_type(documents, models)
+            document_ids = _extract_ids(documents)
+            for model, doc_ids in document_ids.items():
+                if len(pending) >= workers * 2:
+                    updated += pending.popleft().get()
+                    _log_progress(updated, started)
+                pending.append(pool.apply_async(
+                    _update_by_ids, (model, doc_ids, from_ace, to_ace)))
+        while pending:
+            updated += pending.popleft().get()
+            _log_progress(updated, started)
+    finally:
+        pool.terminate()
+        pool.join()
+    return updated
+
+
+def _update_ace_server_side(from_ace, to_ace, models, commit):
+    """ Update documents that contain ``from_ace`` with ``to_ace``
+    using engine's ``replace_ace`` which rewrites ACLs in database
+    without loading documents.
+
+    ACL fields of updated documents are then updated in ES and
+    documents they are nested in are reindexed. Models which don't
+    store ACLs are skipped.
+
+    :returns: Number of updated documents.
+    :raises ValueError: If engine does not support server-side updates.
+    """
+    from nefertari_guards import engine as guards_engine
+    replace_ace = getattr(guards_engine, 'replace_ace', None)
+    if replace_ace is None:
+        raise ValueError(
+            'Server-side ACE replacement is not supported by engine')
+
+    started = time.time()
+    updated = 0
+    for model in models:
+        if not hasattr(model, '_acl'):
+            continue
+        count, rows = replace_ace(model, from_ace, to_ace)
+        if rows and getattr(model, '_index_enabled', False):
+            _reindex_acls(model, rows)
+        updated += count
+        if commit:
+            _commit()
+        _log_progress(updated, started)
+    return updated
+
+
+def _reindex_acls(model, rows):
+    """ Update ACL fields of ES documents of ``model`` and reindex
+    documents they are nested in.
+
+    :param model: Document class.
+    :param rows: List of (primary key, stringified ACL) tuples.
+    """
+    es = ES(model.__name__)
+    actions = []
+    for pk, acl in rows:
+        doc = {'_acl': acl}
+        if ACLEncoderMixin.flat_acl:
+            doc.update(ACLEncoderMixin.flatten_acl(acl))
+        actions.append({
+            '_op_type': 'update',
+            '_index': es.index_name,
+            '_type': es.doc_type,
+            '_id': str(pk),
+            'doc': doc,
+        })
+    helpers.bulk(ES.api, actions, chunk_size=es.chunk_size)
+
+    # Copies of documents nested in related documents are reindexed
+    ids = [pk for pk, acl in rows]
+    for start in range(0, len(ids), es.chunk_size):
+        items = model.get_by_ids(ids[start:start + es.chunk_size])
+        ES.bulk_index_relations(items, nested_only=True)
+
+
+def _update_by_ids(model, doc_ids, from_ace, to_ace):
+    """ Replace ``from_ace`` with ``to_ace`` in documents of ``model``
+    with ``doc_ids`` and commit.
+
+    Run in worker threads, each of which uses its own thread-local DB
+    session and transaction.
+
+    :returns: Number of updated documents.
+    """
+    items = model.get_by_ids(doc_ids)
+    updated = _replace_docs_ace(items, from_ace, to_ace)
+    _commit()
+    return updated
+
+
+def _load_batches(documents_batches, models):
+    """ Load batches of ES documents from database.
+
+    Documents of each batch are grouped by model and loaded with a
+    single query per model.
+
+    :param documents_batches: Iterator of lists of ES documents, e.g.
+        one returned by ``iter_by_ace``.
+    :param models: List of document classes.
+    :returns: Iterator of (documents, [(model, items), ...]) tuples
+        where ``documents`` is a batch of ES documents and ``items``
+        are loaded db objects.
+    """
+    for documents in documents_batches:
+        document_ids = _extract_ids(_group_by_type(documents, models))
+        loaded = [(model, model.get_by_ids(doc_ids))
+                  for model, doc_ids in document_ids.items()]
+        yield documents, loaded
+
+
+def _update_batches(documents_batches, models, update, commit=False,
+                    after_batch=None):
+    """ Update batches of ES documents loaded by ``_load_batches``.
+
+    :param update: Callable called as ``update(model, items)`` for each
+        model in batch. Returns number of updated items.
+    :param commit: Boolean. When True transaction is committed after
+        each batch.
+    :param after_batch: Callable called as
+        ``after_batch(documents, updated)`` after each batch is
+        updated and committed.
+    :returns: Number of updated documents.
+    """
+    started = time.time()
+    updated = 0
+    for documents, loaded in _load_batches(documents_batches, models):
+        for model, items in loaded:
+            updated += update(model, items)
+        if commit:
+            _commit()
+        if after_batch is not None:
+            after_batch(documents, updated)
+        _log_progress(updated, started)
+    return updated
+
+
+def _log_progress(updated, started):
+    """ Log number of updated documents and throughput. """
+    elapsed = time.time() - started
+    log.info('Updated {} documents in {:.1f}s ({:.1f} docs/s)'.format(
+        updated, elapsed, updated / elapsed if elapsed else 0))
+
+
+def bulk_update_acl(operations, models=None,
+                    batch_size=DEFAULT_BATCH_SIZE, commit=False):
+    """ Apply multiple ACE operations to documents in one pass.
+
+    Documents affected by any of operations are found with a single
+    ES query and streamed in batches the same way as in ``update_ace``.
+    All operations are applied to ACL of each document in order and
+    the document is updated once.
+
+    Supported operations are:
+        * {"op": "add", "ace": ace, "match": match_ace} - Insert ``ace``
+          right after the first ``match_ace`` in ACLs which include
+          ``match_ace`` and do not include ``ace``.
+        * {"op": "remove", "ace": ace} - Remove all ``ace`` entries.
+        * {"op": "replace", "from_ace": from_ace, "to_ace": to_ace} -
+          Replace all ``from_ace`` entries with ``to_ace``.
+
+    Look into ACLEncoderMixin.stringify_acl for details on ace format.
+
+    :param operations: List of operations.
+    :param models: List of document classes objects of which should
+        be found and updated.
+    :param batch_size: Number of documents updated at once.
+    :param commit: Boolean. When True transaction is committed after
+        each batch.
+    :returns: Number of updated documents.
+    :raises ValueError: If operations are invalid or no es-based
+        documents passed.
+    """
+    match_aces = _validate_operations(operations)
+    if models is None:
+        models = list(engine.get_document_classes().values())
+
+    def apply_operations(model, items):
+        updated = 0
+        for item in items:
+            acl = _apply_operations(item._acl or [], operations)
+            if acl != item._acl:
+                log.debug('Updating ACL of: {}'.format(str(item)))
+                item.update({'_acl': acl})
+                updated += 1
+        return updated
+
+    body = _get_es_body_any(match_aces)
+    return _update_batches(
+        _iter_documents(body, models, batch_size), models,
+        apply_operations, commit=commit)
+
+
+def _validate_operations(operations):
+    """ Validate ``bulk_update_acl`` operations.
+
+    :returns: List of ACEs documents that may be affected by operations
+        include.
+    :raises ValueError: If any of operations is invalid.
+    """
+    required = {
+        'add': ('ace', 'match'),
+        'remove': ('ace',),
+        'replace': ('from_ace', 'to_ace'),
+    }
+    if not operations:
+        raise ValueError('No operations passed')
+    match_aces = []
+    for operation in operations:
+        op = operation.get('op')
+        if op not in required:
+            raise ValueError(
+                'Invalid operation: {}. Valid operations are: {}'.format(
+                    op, ', '.join(sorted(required))))
+        missing = [key for key in required[op] if key not in operation]
+        if missing:
+            raise ValueError('Operation "{}" requires: {}'.format(
+                op, ', '.join(missing)))
+        if op == 'add':
+            ACLEncoderMixin().validate_acl([operation['ace']])
+            match_aces.append(operation['match'])
+        elif op == 'remove':
+            match_aces.append(operation['ace'])
+        else:
+            ACLEncoderMixin().validate_acl([operation['to_ace']])
+            match_aces.append(operation['from_ace'])
+    return match_aces
+
+
+def _apply_operations(acl, operations):
+    """ Apply ``bulk_update_acl`` operations to a copy of ACL.
+
+    :param acl: Stringified ACL.
+    :param operations: List of validated operations.
+    :returns: Updated stringified ACL.
+    """
+    acl = deepcopy(list(acl))
+    for operation in operations:
+        op = operation['op']
+        if op == 'add':
+            ace, match = operation['ace'], operation['match']
+            if match in acl and ace not in acl:
+                acl.insert(acl.index(match) + 1, ace)
+        elif op == 'remove':
+            acl = [ace for ace in acl if ace != operation['ace']]
+        else:
+            from_ace, to_ace = operation['from_ace'], operation['to_ace']
+            acl = [to_ace if ace == from_ace else ace for ace in acl]
+    return acl
 
 
 def find_by_ace(ace, models, count=False):
@@ -94,6 +685,87 @@ def find_by_ace(ace, models, count=False):
     return documents
 
 
+def iter_by_ace(ace, models, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    """ Iterate over documents of models that include ace in batches.
+
+    Documents are streamed using ES scroll, so only one batch is kept
+    in memory at a time. Only documents' primary keys are loaded.
+
+    :param ace: Stringified ACL entry (ACE) to match agains.
+    :param models: List of document classes objects of which should
+        be found.
+    :param batch_size: Number of documents in each batch.
+    :param ordered: Boolean. When True documents are sorted by ES
+        '_uid' which is available as documents' '_uid' attribute.
+    :param after: ES '_uid' of document after which ordered iteration
+        should start.
+    :returns: Iterator of lists of documents.
+    :raises ValueError: If no es-based models passed.
+    """
+    return _iter_documents(_get_es_body(ace), models, batch_size, **kwargs)
+
+
+def _iter_documents(body, models, batch_size, ordered=False, after=None):
+    """ Iterate over documents of models that match ES query ``body``
+    in batches.
+
+    Look into ``iter_by_ace`` for details.
+    """
+    es_types = _get_es_types(models)
+    if not es_types:
+        raise ValueError('No es-based models passed')
+
+    if ordered:
+        body = _get_ordered_body(body, after)
+
+    pk_fields = sorted(set(model.pk_field() for model in models))
+    hits = helpers.scan(
+        ES.api,
+        query=body,
+        index=ES.settings.index_name,
+        doc_type=es_types,
+        size=batch_size,
+        preserve_order=ordered,
+        _source_include=','.join(pk_fields),
+    )
+    documents = (
+        dict2obj(dict(
+            hit.get('_source', {}), _type=hit['_type'],
+            _uid='{}#{}'.format(hit['_type'], hit['_id'])))
+        for hit in hits)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _get_ordered_body(body, after=None):
+    """ Get copy of ES body generated by ``_get_es_body`` which sorts
+    documents by '_uid' and matches only documents after ``after``
+    '_uid' if provided.
+    """
+    ace_filter = body['query']['filtered']['filter']
+    if after is not None:
+        ace_filter = {'bool': {'must': [
+            ace_filter,
+            {'range': {'_uid': {'gt': after}}},
+        ]}}
+    return {
+        'query': {'filtered': {'filter': ace_filter}},
+        'sort': [{'_uid': 'asc'}],
+    }
+
+
+def _commit():
+    """ Commit current transaction if transaction manager is used. """
+    try:
+        import transaction
+    except ImportError:
+        return
+    transaction.commit()
+
+
 def _get_es_types(models):
     """ Get ES types from document model classes.
 
@@ -114,28 +786,49 @@ def _get_es_body(ace):
     :param ace: Stringified ACL entry (ACE) to generate body for.
     :returns: ES request body as a dict with root key "query".
     """
+    return {'query': {'filtered': {'filter': _get_ace_filter(ace)}}}
+
+
+def _get_es_body_any(aces):
+    """ Get ES body which matches documents that include any of ACEs.
+
+    :param aces: List of stringified ACL entries (ACEs).
+    :returns: ES request body as a dict with root key "query".
+    """
+    filters = []
+    for ace in aces:
+        ace_filter = _get_ace_filter(ace)
+        if ace_filter not in filters:
+            filters.append(ace_filter)
+    return {'query': {'filtered': {'filter': {'bool': {'should': filters}}}}}
+
+
+def _get_ace_filter(ace):
+    """ Get ES filter which matches documents that include ACE.
+
+    :param ace: Stringified ACL entry (ACE) to generate filter for.
+    """
+    if ACLEncoderMixin.flat_acl:
+        token = ACLEncoderMixin.ace_token(
+            ace['principal'], ace['permission'])
+        field = '_acl_' + ace['action']
+        return {'term': {field: token}}
+
     must = [
         {'term': {'_acl.action': ace['action']}},
         {'term': {'_acl.principal': ace['principal']}},
         {'term': {'_acl.permission': ace['permission']}}
     ]
-    body = {
-        'query': {
-            'filtered': {
-                'filter': {
-                    'nested': {
-                        'filter': {
-                            'bool': {
-                                'must': must
-                            }
-                        },
-                        'path': '_acl'
-                    }
+    return {
+        'nested': {
+            'filter': {
+                'bool': {
+                    'must': must
                 }
-            }
+            },
+            'path': '_acl'
         }
     }
-    return body
 
 
 def _group_by_type(documents, models=None):
@@ -185,18 +878,37 @@ def _replace_docs_ace(items, from_ace, to_ace):
     :param from_ace: Stringified ACL entry (ACE) to match agains.
     :param to_ace: Stringified ACL entry (ACE) ``from_ace`` should be
         replaced with.
+    :returns: Number of updated items.
     """
+    updated = 0
     for item in items:
-        log.info('Updating ACE in: {}'.format(str(item)))
-        acl = deepcopy(item._acl or [])
-        if from_ace not in acl:
+        log.debug('Updating ACE in: {}'.format(str(item)))
+        acl = _replace_ace(item._acl, from_ace, to_ace)
+        if acl is None:
             log.warn('ACE {} not found in document: {}'.format(
                 str(from_ace), str(item)))
             continue
 
-        while from_ace in acl:
-            ace_index = acl.index(from_ace)
-            acl.pop(ace_index)
-            acl.insert(ace_index, to_ace)
-
         item.update({'_acl': acl})
+        updated += 1
+    return updated
+
+
+def _replace_ace(acl, from_ace, to_ace):
+    """ Replace ``from_ace`` with ``to_ace`` in a copy of ``acl``.
+
+    :param acl: Stringified ACL. CompactACL is replaced by CompactACL.
+    :returns: Updated copy of ACL or None if ``from_ace`` is not
+        present in ``acl``.
+    """
+    if isinstance(acl, CompactACL):
+        return acl.replace(from_ace, to_ace)
+    acl = deepcopy(acl or [])
+    if from_ace not in acl:
+        return None
+
+    while from_ace in acl:
+        ace_index = acl.index(from_ace)
+        acl.pop(ace_index)
+        acl.insert(ace_index, to_ace)
+    return acl
@@ -1,6 +1,16 @@
+from operator import itemgetter
+from weakref import WeakKeyDictionary
+
+import six
 from pyramid.security import (
     Allow, Deny, Everyone, Authenticated, ALL_PERMISSIONS)
 from nefertari.resource import PERMISSIONS as NEF_PERMISSIONS
+from nefertari.utils import dictset
+
+from . import metrics
+from .cache import LRUCache
+from .compact import ACE, CompactACL, intern_string
+from .compiled import CompiledACL
 
 
 """ Elasticsearch type mapping for ACLField """
@@ -14,11 +24,104 @@ ACL_TYPE_MAPPING = {
 }
 
 
+""" Elasticsearch mapping of flattened ACL fields, which are indexed
+along with ACLField when 'nefertari_guards.flat_acl' setting is enabled.
+Fields hold 'principal:permission' tokens of allowing and denying ACEs.
+"""
+FLAT_ACL_MAPPING = {
+    '_acl_allow': {'type': 'string', 'index': 'not_analyzed'},
+    '_acl_deny': {'type': 'string', 'index': 'not_analyzed'},
+}
+
+
+""" Cache of objectified ACLs shared by all ACLEncoderMixin subclasses.
+Size may be changed with 'nefertari_guards.acl_cache_size' setting.
+"""
+OBJECTIFIED_ACL_CACHE = LRUCache(maxsize=1024)
+
+_ace_values = itemgetter('action', 'principal', 'permission')
+
+
+def includeme(config):
+    Settings = dictset(config.registry.settings)
+    OBJECTIFIED_ACL_CACHE.resize(Settings.asint(
+        'nefertari_guards.acl_cache_size', OBJECTIFIED_ACL_CACHE.maxsize))
+    ACLEncoderMixin.flat_acl = Settings.asbool(
+        'nefertari_guards.flat_acl', False)
+    ACLEncoderMixin.compiled_acl = Settings.asbool(
+        'nefertari_guards.compiled_acl', False)
+    config.add_directive('add_acl_permissions', add_acl_permissions)
+
+
+def add_acl_permissions(config, *permissions):
+    """ Config directive that makes :permissions: valid ACE
+    permissions in addition to nefertari view permissions and 'all'.
+
+    Permissions are added to ACLEncoderMixin, so they are valid in ACL
+    fields of all engines and stay registered for the lifetime of the
+    process. Use `ACLEncoderMixin.reset_permissions` to remove them,
+    e.g. between tests.
+
+    Usage: config.add_acl_permissions('publish', 'archive')
+    """
+    ACLEncoderMixin.add_permissions(permissions)
+
+
+class DerivedTable(object):
+    """ Class attribute built by :build: from values of class
+    attributes :names:.
+
+    Table is built once per class, so subclasses that override any of
+    :names: get their own table. It is rebuilt if any of :names:
+    attributes is replaced.
+    """
+    def __init__(self, build, *names):
+        self.build = build
+        self.names = names
+        self._tables = WeakKeyDictionary()
+
+    def __get__(self, instance, owner):
+        sources = tuple(getattr(owner, name) for name in self.names)
+        cached = self._tables.get(owner)
+        if cached is None or any(
+                old is not new for old, new in zip(cached[0], sources)):
+            cached = self._tables[owner] = (sources, self.build(*sources))
+        return cached[1]
+
+
+def _invert(table):
+    return dict((val, key) for key, val in table.items())
+
+
+def _valid_actions(actions):
+    return frozenset(actions.values())
+
+
+def _valid_permissions(permissions, extra_permissions):
+    return frozenset(permissions.values()).union(
+        NEF_PERMISSIONS.values(), extra_permissions)
+
+
+def _is_valid(value, valid_values):
+    try:
+        return value in valid_values
+    except TypeError:  # Unhashable value
+        return False
+
+
 class ACLEncoderMixin(object):
     """ Mixin which implements ACL encoding/decoding.
 
     Used in sqla and mongo ACLField.
+
+    When `flat_acl` is True, ACLs are also indexed as flat lists of
+    ACE tokens. See `flatten_acl`.
+
+    When `compiled_acl` is True, permissions of ES documents are checked
+    using ACLs compiled by `compile_acl_cached`.
     """
+    flat_acl = False
+    compiled_acl = False
     ACTIONS = {
         Allow: 'allow',
         Deny: 'deny',
@@ -33,37 +136,92 @@ class ACLEncoderMixin(object):
     PERMISSIONS_INVERTED = {
         'all': ALL_PERMISSIONS,
     }
+    EXTRA_PERMISSIONS = frozenset()
+    ACTIONS_INVERTED = DerivedTable(_invert, 'ACTIONS')
+    PRINCIPALS_INVERTED = DerivedTable(_invert, 'PRINCIPALS')
+    VALID_ACTIONS = DerivedTable(_valid_actions, 'ACTIONS')
+    VALID_PERMISSIONS = DerivedTable(
+        _valid_permissions, 'PERMISSIONS', 'EXTRA_PERMISSIONS')
+
+    @classmethod
+    def add_permissions(cls, permissions):
+        """ Make :permissions: valid in ACLs of :cls: and its
+        subclasses.
+
+        :param permissions: Iterable of permission names.
+        :raises TypeError: If :permissions: is a string.
+        """
+        if isinstance(permissions, six.string_types):
+            raise TypeError(
+                'Permissions must be an iterable of permission names, '
+                'not a string: {}'.format(permissions))
+        cls.EXTRA_PERMISSIONS = cls.EXTRA_PERMISSIONS.union(permissions)
+
+    @classmethod
+    def reset_permissions(cls):
+        """ Remove permissions added to :cls: with `add_permissions`.
+
+        Permissions added to parent classes stay valid.
+        """
+        if cls is ACLEncoderMixin:
+            cls.EXTRA_PERMISSIONS = frozenset()
+        elif 'EXTRA_PERMISSIONS' in vars(cls):
+            del cls.EXTRA_PERMISSIONS
 
     def _validate_action(self, action):
         """ Validate :action: has allowed value.
 
         :param action: String representation of Pyramid ACL action.
         """
-        valid_actions = self.ACTIONS.values()
-        if action not in valid_actions:
-            err = 'Invalid ACL action value: {}. Valid values are: {}'
-            raise ValueError(err.format(action, ', '.join(valid_actions)))
+        error = self._action_error(action)
+        if error is not None:
+            raise ValueError(error)
 
     def _validate_permission(self, permission):
         """ Validate :permission: has allowed value.
 
-        Valid permission is name of one of nefertari view methods or 'all'.
+        Valid permission is name of one of nefertari view methods, 'all'
+        or permission added with `add_permissions`.
         :param permission: String representing ACL permission name.
         """
-        valid_perms = set(self.PERMISSIONS.values())
-        valid_perms.update(NEF_PERMISSIONS.values())
-        if permission not in valid_perms:
-            err = 'Invalid ACL permission value: {}. Valid values are: {}'
-            raise ValueError(err.format(permission, ', '.join(valid_perms)))
+        error = self._permission_error(permission)
+        if error is not None:
+            raise ValueError(error)
+
+    def _action_error(self, action):
+        if _is_valid(action, self.VALID_ACTIONS):
+            return None
+        err = 'Invalid ACL action value: {}. Valid values are: {}'
+        return err.format(action, ', '.join(sorted(self.VALID_ACTIONS)))
+
+    def _permission_error(self, permission):
+        if _is_valid(permission, self.VALID_PERMISSIONS):
+            return None
+        err = 'Invalid ACL permission value: {}. Valid values are: {}'
+        return err.format(
+            permission, ', '.join(sorted(self.VALID_PERMISSIONS)))
 
     def validate_acl(self, value):
         """ Validate ACL elements.
 
         Identifiers are not validated as they may be arbitrary strings.
+        All invalid ACEs are reported in a single ValueError.
         """
-        for ac_entry in value:
-            self._validate_action(ac_entry['action'])
-            self._validate_permission(ac_entry['permission'])
+        actions = self.VALID_ACTIONS
+        permissions = self.VALID_PERMISSIONS
+        errors = []
+        for index, ac_entry in enumerate(value):
+            action = ac_entry.get('action')
+            permission = ac_entry.get('permission')
+            if (_is_valid(action, actions) and
+                    _is_valid(permission, permissions)):
+                continue
+            for error in (self._action_error(action),
+                          self._permission_error(permission)):
+                if error is not None:
+                    errors.append('ACE {}: {}'.format(index, error))
+        if errors:
+            raise ValueError('\n'.join(errors))
 
     @classmethod
     def _stringify_action(cls, action):
@@ -87,15 +245,16 @@ class ACLEncoderMixin(object):
         """
         if not isinstance(permissions, (list, tuple)):
             permissions = [permissions]
+        special = cls.PERMISSIONS
         clean_permissions = []
         for permission in permissions:
             try:
                 permission = permission.strip().lower()
             except AttributeError:
                 pass
-            clean_permissions.append(permission)
-        return [cls.PERMISSIONS.get(str(perm), perm)
-                for perm in clean_permissions]
+            clean_permissions.append(
+                special.get(str(permission), permission))
+        return clean_permissions
 
     @classmethod
     def stringify_acl(cls, value):
@@ -115,15 +274,18 @@ class ACLEncoderMixin(object):
             if isinstance(ac_entry, dict):  # ACE is already in DB format
                 string_acl.append(ac_entry)
                 continue
+            if isinstance(ac_entry, ACE):
+                string_acl.append(ac_entry.to_dict())
+                continue
             action, principal, permissions = ac_entry
-            action = cls._stringify_action(action)
-            principal = cls._stringify_principal(principal)
+            action = intern_string(cls._stringify_action(action))
+            principal = intern_string(cls._stringify_principal(principal))
             permissions = cls._stringify_permissions(permissions)
             for perm in permissions:
                 string_acl.append({
                     'action': action,
                     'principal': principal,
-                    'permission': perm,
+                    'permission': intern_string(perm),
                 })
         return string_acl
 
@@ -132,16 +294,14 @@ class ACLEncoderMixin(object):
         """ Convert string representation of action into valid
         Pyramid ACL action.
         """
-        inverted_actions = {v: k for k, v in cls.ACTIONS.items()}
-        return inverted_actions[action]
+        return cls.ACTIONS_INVERTED[action]
 
     @classmethod
     def _objectify_principal(cls, principal):
         """ Convert string representation if special Pyramid principals
         into valid Pyramid ACL indentifier objects.
         """
-        inverted_principals = {v: k for k, v in cls.PRINCIPALS.items()}
-        return inverted_principals.get(principal, principal)
+        return cls.PRINCIPALS_INVERTED.get(principal, principal)
 
     @classmethod
     def _objectify_permission(cls, permission):
@@ -152,13 +312,123 @@ class ACLEncoderMixin(object):
 
     @classmethod
     def objectify_acl(cls, value):
-        """ Convert string representation of ACL into valid Pyramid ACL. """
-        object_acl = []
+        """ Convert string representation of ACL into valid Pyramid ACL.
+
+        Lookups into inverted tables are inlined here instead of calling
+        `_objectify_*` methods as this is called for each ACL of each
+        document loaded from DB or ES. Principals and permissions are
+        interned.
+        """
         if value is None:
-            return object_acl
-        for ac_entry in value:
-            action = cls._objectify_action(ac_entry['action'])
-            principal = cls._objectify_principal(ac_entry['principal'])
-            permission = cls._objectify_permission(ac_entry['permission'])
-            object_acl.append([action, principal, permission])
-        return object_acl
+            return []
+        actions = cls.ACTIONS_INVERTED
+        principals = cls.PRINCIPALS_INVERTED
+        permissions = cls.PERMISSIONS_INVERTED
+        if isinstance(value, CompactACL):
+            acl = [
+                (actions[action],
+                 principals.get(principal, principal),
+                 permissions.get(permission, permission))
+                for action, principal, permission in value]
+        else:
+            acl = [
+                (actions[ac_entry['action']],
+                 intern_string(principals.get(
+                     ac_entry['principal'], ac_entry['principal'])),
+                 intern_string(permissions.get(
+                     ac_entry['permission'], ac_entry['permission'])))
+                for ac_entry in value]
+        metrics.incr('nefertari_guards.aces_decoded', len(acl))
+        return acl
+
+    @classmethod
+    def acl_fingerprint(cls, value):
+        """ Get canonical hashable representation of stringified ACL.
+
+        Order of ACEs is preserved as it affects permission checks.
+
+        :param value: Stringified ACL.
+        :return: Tuple of (action, principal, permission) tuples.
+        """
+        if value is None:
+            return ()
+        if isinstance(value, CompactACL):
+            return tuple(value)
+        return tuple(map(_ace_values, value))
+
+    @classmethod
+    def objectify_acl_cached(cls, value):
+        """ Cached version of `objectify_acl`.
+
+        Results are stored in OBJECTIFIED_ACL_CACHE by ACL fingerprint and
+        are shared between callers, thus ACL and its ACEs are returned as
+        tuples.
+        """
+        key = (cls, cls.acl_fingerprint(value))
+        try:
+            acl = OBJECTIFIED_ACL_CACHE.get(key)
+        except TypeError:  # Unhashable ACE values
+            return tuple(cls.objectify_acl(value))
+        if acl is None:
+            acl = tuple(cls.objectify_acl(value))
+            OBJECTIFIED_ACL_CACHE.set(key, acl)
+        return acl
+
+    @classmethod
+    def compact_acl(cls, value):
+        """ Convert Pyramid or stringified ACL into CompactACL.
+
+        CompactACL holds `nefertari_guards.compact.ACE` tuples which
+        take less memory than ACE dicts and may be read the same way.
+        It is converted to ACE dicts by `stringify_acl` when stored.
+        """
+        if isinstance(value, CompactACL):
+            return value
+        return CompactACL(cls.stringify_acl(value))
+
+    @classmethod
+    def compile_acl_cached(cls, value):
+        """ Get `nefertari_guards.compiled.CompiledACL` of stringified
+        ACL.
+
+        Compiled ACLs are stored in OBJECTIFIED_ACL_CACHE next to
+        objectified ACLs.
+        """
+        key = (CompiledACL, cls, cls.acl_fingerprint(value))
+        try:
+            compiled = OBJECTIFIED_ACL_CACHE.get(key)
+        except TypeError:  # Unhashable ACE values
+            return CompiledACL(cls.objectify_acl(value))
+        if compiled is None:
+            compiled = CompiledACL(cls.objectify_acl_cached(value))
+            OBJECTIFIED_ACL_CACHE.set(key, compiled)
+        return compiled
+
+    @staticmethod
+    def ace_token(principal, permission):
+        """ Build flattened ACL token of stringified :principal: and
+        :permission:.
+        """
+        return '{}:{}'.format(principal, permission)
+
+    @classmethod
+    def flatten_acl(cls, value):
+        """ Convert ACL into flattened ACL fields.
+
+        ACE order is not preserved, so flattened ACL may only be used
+        for filtering the same way nested ACL is filtered by
+        `nefertari_guards.elasticsearch.build_acl_query`.
+
+        :param value: Pyramid or stringified ACL.
+        :return: Dict of format {'_acl_allow': [token, ...],
+            '_acl_deny': [token, ...]} where tokens are built by
+            `ace_token`.
+        """
+        flat = {'_acl_allow': [], '_acl_deny': []}
+        for ac_entry in cls.stringify_acl(value):
+            field = '_acl_' + ac_entry['action']
+            token = cls.ace_token(
+                ac_entry['principal'], ac_entry['permission'])
+            if token not in flat[field]:
+                flat[field].append(token)
+        return flat
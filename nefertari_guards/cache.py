@@ -0,0 +1,118 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Bounded thread-safe mapping that evicts least recently used
+    entries once `maxsize` is exceeded.
+
+    Number of cache hits and misses is tracked in `hits` and `misses`
+    attributes. Cache with `maxsize` of 0 stores nothing.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # OrderedDict.move_to_end is not available in python 2
+        self._touch = getattr(self._data, 'move_to_end', self._reinsert)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """ Get value stored under :key: and mark it as recently used.
+
+        Lookups are not locked as they are performed much more often
+        than writes.
+
+        :param key: Hashable cache key.
+        :param default: Value returned when :key: is not cached.
+        """
+        try:
+            value = self._data[key]
+            self._touch(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """ Store :value: under :key: evicting least recently used
+        entries if cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def resize(self, maxsize):
+        """ Change cache size evicting entries that don't fit. """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """ Drop all cached entries and reset hit/miss counters. """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Return dict with cache hits, misses and size. """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def _reinsert(self, key):
+        with self._lock:
+            self._data[key] = self._data.pop(key)
+
+    def _evict(self):
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+
+
+class FrozenDict(dict):
+    """ Dict that can't be modified after creation.
+
+    Used to share cached values between callers. Copies are regular
+    dicts.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{} is immutable'.format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        from copy import deepcopy
+        return deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """ Recursively convert dicts in :value: to FrozenDict and lists to
+    tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(val)) for key, val in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    return value
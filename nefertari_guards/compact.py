@@ -0,0 +1,93 @@
+from collections import namedtuple
+
+import six
+from six.moves import intern
+
+
+ACE_FIELDS = ('action', 'principal', 'permission')
+_FIELD_INDEXES = dict((name, index) for index, name in enumerate(ACE_FIELDS))
+
+
+def intern_string(value):
+    """ Intern :value: if it's a native string, so equal values share
+    one object. Other values are returned as is.
+    """
+    try:
+        return intern(value)
+    except TypeError:
+        return value
+
+
+class ACE(namedtuple('ACE', ACE_FIELDS)):
+    """ Compact stringified ACL entry.
+
+    Takes less memory than ACE dict and supports dict-style access, so
+    it may be used wherever stringified ACEs are read. Equals to ACE
+    dict with same values. Strings are interned, so repeated values are
+    stored once.
+    """
+    __slots__ = ()
+
+    def __new__(cls, action, principal, permission):
+        return super(ACE, cls).__new__(
+            cls, intern_string(action), intern_string(principal),
+            intern_string(permission))
+
+    @classmethod
+    def from_dict(cls, ace):
+        return cls(ace['action'], ace['principal'], ace['permission'])
+
+    def to_dict(self):
+        return dict(zip(ACE_FIELDS, self))
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            try:
+                key = _FIELD_INDEXES[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+
+class CompactACL(tuple):
+    """ Immutable stringified ACL of ACE instances.
+
+    Converted to list of ACE dicts by `to_dicts` when stored or
+    serialized.
+    """
+    __slots__ = ()
+
+    def __new__(cls, aces=()):
+        return super(CompactACL, cls).__new__(cls, (
+            ace if isinstance(ace, ACE) else ACE.from_dict(ace)
+            for ace in aces))
+
+    def to_dicts(self):
+        return [ace.to_dict() for ace in self]
+
+    def replace(self, from_ace, to_ace):
+        """ Get copy of ACL with :from_ace: replaced by :to_ace:.
+
+        :return: New CompactACL or None if :from_ace: is not present.
+        """
+        if from_ace not in self:
+            return None
+        to_ace = to_ace if isinstance(to_ace, ACE) else ACE.from_dict(to_ace)
+        return CompactACL(
+            to_ace if ace == from_ace else ace for ace in self)
@@ -0,0 +1,111 @@
+from pyramid.security import Allow, AllPermissionsList
+from nefertari.resource import PERMISSIONS as NEF_PERMISSIONS
+
+
+""" Bits of permissions known to nefertari. Other permissions share
+OTHER_BIT which is only set by ACEs of ALL_PERMISSIONS.
+"""
+PERMISSION_BITS = dict(
+    (permission, 1 << index) for index, permission
+    in enumerate(sorted(set(NEF_PERMISSIONS.values()))))
+OTHER_BIT = 1 << len(PERMISSION_BITS)
+ALL_BITS = (OTHER_BIT << 1) - 1
+
+
+class CompiledACL(object):
+    """ Pyramid ACL compiled for fast permission checks.
+
+    Each principal of ACL is mapped to (allow mask, deny mask, positions),
+    where masks hold bits of permissions which first ACE of principal
+    that mentions them allows or denies, and positions hold indexes of
+    these ACEs by bit. When checking a permission, principal whose ACE
+    comes first decides, so `permits` gives the same results as
+    `pyramid.authorization.ACLAuthorizationPolicy`.
+
+    ACLs which contain permissions outside of PERMISSION_BITS or
+    ALL_PERMISSIONS are checked by walking ACEs as Pyramid does.
+    """
+    __slots__ = ('acl', 'entries', 'exact')
+
+    def __init__(self, acl):
+        self.acl = tuple(acl)
+        self.entries = {}
+        self.exact = True
+        for position, ace in enumerate(self.acl):
+            action, principal, permissions = ace
+            mask = _permissions_mask(permissions)
+            if mask is None:
+                self.exact = False
+                self.entries = {}
+                return
+            entry = self.entries.get(principal)
+            if entry is None:
+                entry = self.entries[principal] = [0, 0, {}]
+            new_bits = mask & ~(entry[0] | entry[1])
+            if not new_bits:
+                continue
+            entry[0 if action == Allow else 1] |= new_bits
+            positions = entry[2]
+            bit = 1
+            while bit <= new_bits:
+                if bit & new_bits:
+                    positions[bit] = position
+                bit <<= 1
+
+    def permits(self, principals, permission):
+        """ Check whether any of :principals: is allowed :permission: by
+        ACL.
+
+        :param principals: Effective principals of user.
+        :param permission: Permission name.
+        """
+        if not self.exact:
+            return _walk_acl(self.acl, principals, permission)
+        bit = PERMISSION_BITS.get(permission, OTHER_BIT)
+        entries = self.entries
+        first = None
+        allowed = False
+        for principal in principals:
+            entry = entries.get(principal)
+            if entry is None:
+                continue
+            allow_mask, deny_mask, positions = entry
+            if not (allow_mask | deny_mask) & bit:
+                continue
+            position = positions[bit]
+            if first is None or position < first:
+                first = position
+                allowed = bool(allow_mask & bit)
+        return allowed
+
+
+def _permissions_mask(permissions):
+    """ Get bit mask of ACE :permissions: or None if some of them are
+    not known.
+    """
+    # Pyramid 2 has ALL_PERMISSIONS in both pyramid.security and
+    # pyramid.authorization
+    if isinstance(permissions, AllPermissionsList):
+        return ALL_BITS
+    if isinstance(permissions, (list, tuple, set, frozenset)):
+        mask = 0
+        for permission in permissions:
+            bit = PERMISSION_BITS.get(permission)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+    return PERMISSION_BITS.get(permissions)
+
+
+def _walk_acl(acl, principals, permission):
+    """ Check :permission: by walking :acl: the way Pyramid does. """
+    for action, principal, permissions in acl:
+        if principal not in principals:
+            continue
+        if not isinstance(permissions, (
+                AllPermissionsList, list, tuple, set, frozenset)):
+            permissions = [permissions]
+        if permission in permissions:
+            return action == Allow
+    return False
@@ -2,6 +2,8 @@ def get_document_mixin(engine_module):
     """ Define and return DocumentACLMixin """
 
     import logging
+    from nefertari_guards.base import FLAT_ACL_MAPPING
+    from nefertari_guards.compact import CompactACL
     log = logging.getLogger(__name__)
 
     class DocumentACLMixin(object):
@@ -19,13 +21,25 @@ def get_document_mixin(engine_module):
             return cls.__item_acl__
 
         def get_acl(self):
-            """ Convert stored ACL to valid Pyramid ACL. """
-            acl = engine_module.ACLField.objectify_acl(self._acl)
+            """ Convert stored ACL to valid Pyramid ACL.
+
+            Stored ACL may be a list of ACE dicts or CompactACL.
+            Returned ACL is shared with other documents that have the
+            same ACL and must not be modified.
+            """
+            acl = engine_module.ACLField.objectify_acl_cached(self._acl)
             log.info('Loaded ACL from database for {}({}): {}'.format(
                 self.__class__.__name__,
                 getattr(self, self.pk_field()), acl))
             return acl
 
+        def get_compiled_acl(self):
+            """ Get stored ACL compiled for fast permission checks.
+
+            See `nefertari_guards.compiled.CompiledACL`.
+            """
+            return engine_module.ACLField.compile_acl_cached(self._acl)
+
         def _set_default_acl(self):
             """ Set default object ACL if not already set. """
             if self._is_created() and not self._acl:
@@ -37,10 +51,24 @@ def get_document_mixin(engine_module):
             self._set_default_acl()
             return super(DocumentACLMixin, self).save(*args, **kwargs)
 
+        def to_dict(self, **kwargs):
+            """ Override to serialize CompactACL. """
+            data = super(DocumentACLMixin, self).to_dict(**kwargs)
+            if isinstance(data.get('_acl'), CompactACL):
+                data['_acl'] = data['_acl'].to_dicts()
+            return data
+
         @classmethod
         def get_es_mapping(cls, types_map=None, **kwargs):
-            """ Generate ES mapping from model schema. """
-            return super(DocumentACLMixin, cls).get_es_mapping(
+            """ Generate ES mapping from model schema.
+
+            Flattened ACL fields are mapped if enabled.
+            """
+            mapping = super(DocumentACLMixin, cls).get_es_mapping(
                 types_map=engine_module.EXTENDED_TYPES_MAP, **kwargs)
+            if engine_module.ACLField.flat_acl:
+                for type_mapping in mapping.values():
+                    type_mapping['properties'].update(FLAT_ACL_MAPPING)
+            return mapping
 
     return DocumentACLMixin
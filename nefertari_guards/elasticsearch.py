@@ -1,19 +1,113 @@
+from nefertari import engine as nefertari_engine
 from nefertari.elasticsearch import ES, _ESDocs
 from nefertari.utils import dictset, DataProxy, is_document
 from nefertari.resource import PERMISSIONS
 
-from nefertari_guards import engine
+from nefertari_guards import engine, metrics
+from nefertari_guards.cache import LRUCache, freeze
+from nefertari_guards.compact import ACE_FIELDS, intern_string
+
+
+""" Cache of ACL queries generated by `cached_acl_query`. Size may be
+changed with 'nefertari_guards.acl_query_cache_size' setting.
+"""
+ACL_QUERY_CACHE = LRUCache(maxsize=256)
+
+""" Original `ES.prep_bulk_documents` called by `prep_bulk_documents` """
+_es_prep_bulk_documents = ES.prep_bulk_documents
 
 
 def includeme(config):
     Settings = dictset(config.registry.settings)
     ACLFilterES.setup(Settings)
+    # Engines index documents with nefertari ES, so flattened ACL fields
+    # are added by patched ES method
+    ES.prep_bulk_documents = prep_bulk_documents
+    # Models are defined and mapped by the time config is committed
+    config.action(
+        'nefertari_guards.relations_index',
+        ACLFilterES.build_relations_index)
 
 
 class ACLFilterES(ES):
     """ Nefertari ES subclass that applies ACL filtering when
     'request' param is passed and auth is enabled.
+
+    `relations_index` maps ES type names to trees of relationship fields
+    which may contain documents. It is built by `build_relations_index`
+    along with `list_relations` which maps ES type names to sets of
+    top-level relationship fields that hold lists of documents.
+
+    When `filter_relations` is True, top-level relationships of
+    collection items are ACL-filtered by ES using nested inner hits.
+
+    When `acl_filter_context` is True, ACL queries are placed in
+    non-scoring filter context which ES can cache. Otherwise ACL
+    queries are scored along with the user query.
+
+    When `intern_acls` is True, ACL strings of found documents are
+    interned as ES responses are received, so repeated principals and
+    permissions share one object.
     """
+    relations_index = {}
+    list_relations = {}
+    filter_relations = False
+    inner_hits_size = 100
+    acl_filter_context = True
+    intern_acls = False
+
+    def __init__(self, *args, **kwargs):
+        super(ACLFilterES, self).__init__(*args, **kwargs)
+        if self.intern_acls:
+            self.api = HitsAPI(self.api, intern_acls)
+
+    @classmethod
+    def setup(cls, settings):
+        super(ACLFilterES, cls).setup(settings)
+        ACL_QUERY_CACHE.clear()
+        ACL_QUERY_CACHE.resize(settings.asint(
+            'nefertari_guards.acl_query_cache_size',
+            ACL_QUERY_CACHE.maxsize))
+        cls.filter_relations = settings.asbool(
+            'nefertari_guards.es_relations_filter', False)
+        cls.inner_hits_size = settings.asint(
+            'nefertari_guards.es_relations_filter_size',
+            cls.inner_hits_size)
+        cls.acl_filter_context = settings.asbool(
+            'nefertari_guards.acl_filter_context', True)
+        cls.intern_acls = settings.asbool(
+            'nefertari_guards.es_intern_acls', False)
+
+    @classmethod
+    def build_relations_index(cls, models=None):
+        """ Build relationship fields index from models ES mappings.
+
+        Only relationships mapped as 'nested' are indexed as other
+        relationships are stored as IDs. Index is a dict of format
+        {type_name: {field_name: {nested_field_name: {...}, ...}, ...}}.
+
+        :param models: Document classes to index. Defaults to all
+            es-based document classes.
+        :return: Built index.
+        """
+        if models is None:
+            models = nefertari_engine.get_document_classes().values()
+        index = {}
+        list_relations = {}
+        for model in models:
+            if not getattr(model, '_index_enabled', False):
+                continue
+            for type_name, mapping in model.get_es_mapping().items():
+                tree = _relations_tree(mapping.get('properties', {}))
+                index[type_name] = tree
+                list_relations[type_name] = set(
+                    field for field in tree
+                    if engine.is_list_relationship(model, field))
+        cls.relations_index = index
+        cls.list_relations = list_relations
+        return index
+
+    @metrics.timed('nefertari_guards.es.build_search_params')
     def build_search_params(self, params):
         """ Overriden to add ACL filter params when '_principals'
         param is passed.
@@ -22,17 +116,132 @@ class ACLFilterES(ES):
         :return: ES query params
         """
         _principals = params.pop('_principals', None)
+        _filter_relations = params.pop('_filter_relations', False)
         _params = super(ACLFilterES, self).build_search_params(params)
 
         if _principals:
             old_body = _params['body']
-            permissions_query = build_acl_query(
+            permissions_query = cached_acl_query(
                 _principals, self._req_permission)
-            if 'query' in old_body:
-                permissions_query['must'].append(old_body['query'])
-            _params['body'] = {'query': {'bool': permissions_query}}
+            _params['body'] = {'query': self._acl_bool_query(
+                permissions_query, old_body.get('query'))}
+            if _filter_relations:
+                self._add_relations_filter(_params['body'], _principals)
         return _params
 
+    def _acl_bool_query(self, acl_query, query=None):
+        """ Build bool query that matches documents which match
+        :query: and are allowed by :acl_query:.
+
+        ACL clauses are put in 'filter' context when `acl_filter_context`
+        is True and in 'must' otherwise.
+
+        :param acl_query: ACL query generated by `build_acl_query`.
+        :param query: ES query to be combined with ACL query.
+        """
+        # Cached query parts are shared and can't be modified
+        acl_clauses = list(acl_query['must'])
+        if self.acl_filter_context:
+            bool_query = {'filter': acl_clauses}
+            if query is not None:
+                bool_query['must'] = [query]
+        else:
+            bool_query = {'must': acl_clauses}
+            if query is not None:
+                acl_clauses.append(query)
+        bool_query['must_not'] = acl_query['must_not']
+        return {'bool': bool_query}
+
+    def _add_relations_filter(self, body, principals):
+        """ Add relationships ACL filtering to query :body:.
+
+        Top-level nested relationships are excluded from '_source' and
+        visible related documents are requested as inner hits of nested
+        queries which use ACL filter built by `build_acl_query`.
+
+        :param body: ES query body generated by `build_search_params`.
+        :param principals: List of valid Pyramid ACL principals.
+        """
+        relations = self.relations_index.get(self.doc_type, {})
+        should = body['query']['bool'].setdefault('should', [])
+        for field in relations:
+            relation_query = cached_acl_query(
+                principals, 'view', path=field + '._acl')
+            should.append({
+                'nested': {
+                    'path': field,
+                    'score_mode': 'none',
+                    'query': self._acl_bool_query(relation_query),
+                    'inner_hits': {
+                        'name': field,
+                        'size': self.inner_hits_size,
+                    },
+                }
+            })
+        body['_source'] = {'exclude': sorted(relations)}
+
+    def _filters_relations(self, params):
+        """ Check whether relationships of collection requested with
+        :params: may be filtered by ES.
+        """
+        return (
+            self.filter_relations and
+            '_count' not in params and
+            '_fields' not in params and
+            bool(self.relations_index.get(self.doc_type)))
+
+    def _get_filtered_collection(self, **params):
+        """ Get collection which top-level relationships are ACL-filtered
+        by ES.
+
+        Uses `ES.get_collection` with ES client wrapped to restore
+        relationships of found documents from nested inner hits.
+        Documents that have more visible related documents than
+        `inner_hits_size` are loaded in full to be filtered by
+        `check_relations_permissions`.
+        """
+        params['_filter_relations'] = True
+        api = self.api
+        self.api = HitsAPI(api, self._restore_hit_relations)
+        try:
+            return super(ACLFilterES, self).get_collection(**params)
+        finally:
+            self.api = api
+
+    def _restore_hit_relations(self, hit):
+        """ Replace '_source' of search :hit: with source which
+        relationships are restored by `_restore_relations`.
+        """
+        if '_type' in hit:
+            hit['_source'] = self._restore_relations(hit)
+
+    def _restore_relations(self, found_doc):
+        """ Restore relationships of ES hit :found_doc: from its inner
+        hits.
+
+        :return: Document '_source' with visible related documents.
+        """
+        source = found_doc['_source']
+        inner_hits = found_doc.get('inner_hits', {})
+        relations = self.relations_index.get(found_doc['_type'], {})
+        list_relations = self.list_relations.get(found_doc['_type'], ())
+
+        for field in relations:
+            hits = inner_hits.get(field, {}).get('hits', {})
+            hits_list = hits.get('hits', [])
+            if hits.get('total', 0) > len(hits_list):
+                return self.api.get_source(
+                    index=found_doc['_index'], doc_type=found_doc['_type'],
+                    id=found_doc['_id'])
+            hits_list = sorted(
+                hits_list, key=lambda hit: hit['_nested']['offset'])
+            related = [hit['_source'] for hit in hits_list]
+            if field in list_relations:
+                source[field] = related
+            else:
+                source[field] = related[0] if related else None
+        return source
+
     def aggregate(self, request=None, **params):
         """ Overriden to support ACL filtering. """
         if auth_enabled(request):
@@ -40,6 +249,7 @@ class ACLFilterES(ES):
             params['_principals'] = request.effective_principals
         return super(ACLFilterES, self).aggregate(**params)
 
+    @metrics.timed('nefertari_guards.es.get_collection')
     def get_collection(self, request=None, **params):
         """ Overriden to support ACL filtering.
 
@@ -56,7 +266,10 @@ class ACLFilterES(ES):
         if _auth_enabled:
             self._req_permission = PERMISSIONS[request.action]
             params['_principals'] = request.effective_principals
-        documents = super(ACLFilterES, self).get_collection(**params)
+        if _auth_enabled and self._filters_relations(params):
+            documents = self._get_filtered_collection(**params)
+        else:
+            documents = super(ACLFilterES, self).get_collection(**params)
 
         if _auth_enabled and isinstance(documents, _ESDocs):
             _nefertari_meta = documents._nefertari_meta
@@ -67,6 +280,7 @@ class ACLFilterES(ES):
 
         return documents
 
+    @metrics.timed('nefertari_guards.es.get_item')
     def get_item(self, request=None, **kw):
         """ Overriden to support ACL filtering.
 
@@ -85,18 +299,87 @@ class ACLFilterES(ES):
         return document
 
 
+def prep_bulk_documents(self, action, documents):
+    """ Replacement of `ES.prep_bulk_documents` set by `includeme`.
+
+    Adds flattened ACL fields to indexed documents and their related
+    documents if enabled.
+    """
+    docs_actions = _es_prep_bulk_documents(self, action, documents)
+    if engine.ACLField.flat_acl:
+        for doc_action in docs_actions:
+            flatten_acls(doc_action['_source'])
+    return docs_actions
+
+
+class HitsAPI(object):
+    """ Wrapper of ES client which passes documents returned by `search`,
+    `mget` and `get_source` to :process_hit: before they are returned.
+
+    Search hits and `mget` docs are passed as is and `get_source`
+    results are passed as {'_source': source}. :process_hit: modifies
+    hits in place.
+    """
+    def __init__(self, api, process_hit):
+        self._api = api
+        self._process_hit = process_hit
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    def search(self, *args, **kwargs):
+        data = self._api.search(*args, **kwargs)
+        for hit in data.get('hits', {}).get('hits', ()):
+            self._process_hit(hit)
+        return data
+
+    def mget(self, *args, **kwargs):
+        data = self._api.mget(*args, **kwargs)
+        for doc in data.get('docs', ()):
+            self._process_hit(doc)
+        return data
+
+    def get_source(self, *args, **kwargs):
+        data = self._api.get_source(*args, **kwargs)
+        if isinstance(data, dict):
+            self._process_hit({'_source': data})
+        return data
+
+
 def auth_enabled(request):
     return (
         request is not None and
         dictset(request.registry.settings).asbool('auth'))
 
 
+def _relations_tree(properties):
+    """ Get tree of nested relationship fields from ES mapping
+    properties.
+    """
+    tree = {}
+    for name, field_mapping in properties.items():
+        if name == '_acl' or field_mapping.get('type') != 'nested':
+            continue
+        tree[name] = _relations_tree(field_mapping.get('properties', {}))
+    return tree
+
+
+@metrics.timed('nefertari_guards.check_relations_permissions')
 def check_relations_permissions(request, document):
     """ Check permissions of document relationships.
 
     If related document can not be visible by user, it is replaced with
-    None or removed from collection display. Each related document
-    permissions are checked with `_check_permissions` function.
+    None or removed from collection display. Visible related documents
+    relationships are checked in turn.
+
+    Document is walked iteratively and modified in place, so arbitrary
+    nesting depth is supported. Lists are filtered without making
+    copies and lists that don't start with a dict are skipped as
+    they can't contain documents.
+
+    When document type is present in `ACLFilterES.relations_index`,
+    only relationship fields from the index are visited. Otherwise all
+    fields are checked.
 
     :param request: Pyramid Request instance that represents current
         request
@@ -110,13 +393,139 @@ def check_relations_permissions(request, document):
     else:
         data = document
 
-    for key, value in data.items():
-        if isinstance(value, (list, tuple)):
-            checked = [_check_permissions(request, val) for val in value]
-            checked = [val for val in checked if val is not None]
-        else:
-            checked = _check_permissions(request, value)
-        data[key] = checked
+    decisions = DecisionCache.from_request(request)
+    relations = ACLFilterES.relations_index.get(data.get('_type'))
+    pending = [(data, relations)]
+    checked = pruned = 0
+    while pending:
+        data, relations = pending.pop()
+        for key in (data if relations is None else relations):
+            if key == '_acl':
+                continue
+            value = data.get(key)
+            subrelations = None if relations is None else relations[key]
+
+            if isinstance(value, dict):
+                if not is_document(value):
+                    continue
+                checked += 1
+                if not decisions.has_permission(
+                        request, value.get('_acl', []), 'view'):
+                    data[key] = None
+                    pruned += 1
+                elif subrelations != {}:
+                    pending.append((value, subrelations))
+                continue
+
+            if not isinstance(value, (list, tuple)):
+                continue
+            if isinstance(value, tuple):
+                value = data[key] = list(value)
+            if not value or not isinstance(value[0], dict):
+                continue
+            kept = 0
+            for val in value:
+                if is_document(val):
+                    checked += 1
+                    if not decisions.has_permission(
+                            request, val.get('_acl', []), 'view'):
+                        pruned += 1
+                        continue
+                    if subrelations != {}:
+                        pending.append((val, subrelations))
+                value[kept] = val
+                kept += 1
+            del value[kept:]
+    if metrics.enabled():
+        metrics.incr('nefertari_guards.documents_checked', checked)
+        metrics.incr('nefertari_guards.relations_pruned', pruned)
+    return document
+
+
+@metrics.timed('nefertari_guards.filter_documents')
+def filter_documents(request, documents, permission='view'):
+    """ Filter list of ES documents the way collection items are
+    filtered.
+
+    Documents which user doesn't have :permission: for are dropped and
+    relationships of the rest are filtered by
+    `check_relations_permissions`. Decisions are cached by
+    `DecisionCache`, so each distinct ACL is checked once per request.
+
+    :param request: Pyramid Request instance that represents current
+        request
+    :param documents: Sequence of DataProxy instances or dictionaries
+        containing ES documents data. Items which are not documents
+        are kept as is.
+    :param permission: Permission required to see top-level documents.
+        Related documents require 'view' permission.
+    :return: List of visible documents with ACL-filtered relationships
+    """
+    decisions = DecisionCache.from_request(request)
+    visible = []
+    for document in documents:
+        data = _document_data(document)
+        if is_document(data):
+            if not decisions.has_permission(
+                    request, data.get('_acl', []), permission):
+                continue
+            document = check_relations_permissions(request, document)
+        visible.append(document)
+    return visible
+
+
+def intern_acls(data):
+    """ Intern ACL strings of ES document :data: and its related
+    documents in place.
+
+    Any dict may be passed, e.g. ES hit with inner hits. Lists stored
+    under '_acl' keys are treated as ACLs.
+    """
+    pending = [data]
+    while pending:
+        data = pending.pop()
+        for key, value in data.items():
+            if isinstance(value, dict):
+                pending.append(value)
+                continue
+            if not isinstance(value, list):
+                continue
+            if key != '_acl':
+                pending.extend(val for val in value if isinstance(val, dict))
+                continue
+            for ace in value:
+                if not isinstance(ace, dict):
+                    continue
+                for field in ACE_FIELDS:
+                    if field in ace:
+                        ace[field] = intern_string(ace[field])
+
+
+def flatten_acls(data):
+    """ Add flattened ACL fields to ES document :data: and its related
+    documents in place.
+
+    Fields are added to every dict that has '_acl' key. See
+    `nefertari_guards.base.ACLEncoderMixin.flatten_acl`.
+    """
+    pending = [data]
+    while pending:
+        data = pending.pop()
+        for key, value in list(data.items()):
+            if key == '_acl':
+                continue
+            if isinstance(value, dict):
+                pending.append(value)
+            elif isinstance(value, list):
+                pending.extend(val for val in value if isinstance(val, dict))
+        if '_acl' in data:
+            data.update(engine.ACLField.flatten_acl(data['_acl']))
+
+
+def _document_data(document):
+    """ Get data dict of DataProxy or dict :document:. """
+    if isinstance(document, DataProxy):
+        return document._data
     return document
 
 
@@ -126,6 +535,78 @@ class SimpleContext(object):
         self.__acl__ = acl
 
 
+class DecisionCache(object):
+    """ Request-scoped cache of permission checks results.
+
+    Decisions are cached by (ACL fingerprint, permission) so each
+    distinct ACL is checked by authorization policy once per request.
+    Number of checks performed is stored in `evaluated` and number
+    of checks answered from cache is stored in `saved`.
+
+    When `principals` are set, checks are performed using compiled ACLs
+    instead of authorization policy. See `from_request`.
+    """
+    def __init__(self, principals=None):
+        self._decisions = {}
+        self.principals = principals
+        self.evaluated = 0
+        self.saved = 0
+
+    @classmethod
+    def from_request(cls, request):
+        """ Get cache of :request: creating it if needed.
+
+        Compiled ACLs are used when enabled by ACLField and
+        authorization policy is ACLAuthorizationPolicy, so results are
+        the same.
+        """
+        cache = getattr(request, '_acl_decision_cache', None)
+        if not isinstance(cache, cls):
+            principals = None
+            if engine.ACLField.compiled_acl and _uses_acl_policy(request):
+                principals = [
+                    intern_string(principal)
+                    for principal in request.effective_principals]
+            cache = cls(principals)
+            request._acl_decision_cache = cache
+        return cache
+
+    def has_permission(self, request, acl, permission):
+        """ Check whether user has :permission: in context with :acl:.
+
+        :param request: Pyramid Request instance that represents current
+            request
+        :param acl: Stringified ACL
+        :param permission: Permission name to check
+        """
+        key = (engine.ACLField.acl_fingerprint(acl), permission)
+        decision = self._decisions.get(key)
+        if decision is not None:
+            self.saved += 1
+            return decision
+
+        if self.principals is not None:
+            decision = engine.ACLField.compile_acl_cached(acl).permits(
+                self.principals, permission)
+        else:
+            context = SimpleContext(
+                engine.ACLField.objectify_acl_cached(acl))
+            decision = bool(request.has_permission(permission, context))
+        self._decisions[key] = decision
+        self.evaluated += 1
+        return decision
+
+
+def _uses_acl_policy(request):
+    """ Check whether authorization policy of :request: is
+    ACLAuthorizationPolicy.
+    """
+    from pyramid.authorization import ACLAuthorizationPolicy
+    from pyramid.interfaces import IAuthorizationPolicy
+    policy = request.registry.queryUtility(IAuthorizationPolicy)
+    return type(policy) is ACLAuthorizationPolicy
+
+
 def _check_permissions(request, document):
     """ Check permissions of ES document.
 
@@ -141,26 +622,26 @@ def _check_permissions(request, document):
         return document
 
     # Check whether document can be displayed to user
-    acl = engine.ACLField.objectify_acl(document.get('_acl', []))
-    context = SimpleContext(acl)
-    if request.has_permission('view', context):
+    decisions = DecisionCache.from_request(request)
+    if decisions.has_permission(request, document.get('_acl', []), 'view'):
         return check_relations_permissions(request, document)
 
 
-def _build_acl_bool_terms(acl, action_obj):
+def _build_acl_bool_terms(acl, action_obj, path='_acl'):
     """ Build ACL bool filter from given Pyramid ACL.
 
     :param acl: Valid Pyramid ACL used to build a bool filter query.
     :param action_obj: Pyramid ACL action object (Allow, Deny)
+    :param path: Path of nested ACL field.
     """
     acl = engine.ACLField.stringify_acl(acl)
     action = engine.ACLField._stringify_action(action_obj)
     principals = sorted(set([ace['principal'] for ace in acl]))
     permissions = sorted(set([ace['permission'] for ace in acl]))
     return [
-        {'term': {'_acl.action': action}},
-        {'terms': {'_acl.principal': principals}},
-        {'terms': {'_acl.permission': permissions}},
+        {'term': {path + '.action': action}},
+        {'terms': {path + '.principal': principals}},
+        {'terms': {path + '.permission': permissions}},
     ]
 
 
@@ -186,7 +667,7 @@ def _build_acl_from_principals(principals, action_obj, req_permission):
     return acl
 
 
-def build_acl_query(principals, req_permission):
+def build_acl_query(principals, req_permission, path='_acl'):
     """ Build ES query to filter collection by only getting items
     for which user has `req_permission` or 'all' permission and does
     not have any of these permissions denied.
@@ -200,10 +681,15 @@ def build_acl_query(principals, req_permission):
         which object permissions should be allowed.
     :param req_permission: Requested permission which is used to
         perform ACL filtering.
+    :param path: Path of nested ACL field. Use '<field>._acl' to
+        filter documents nested in <field>.
     :return: ES 'filter' query part.
     """
     from pyramid.security import Allow, Deny
 
+    if engine.ACLField.flat_acl:
+        return _build_flat_acl_query(principals, req_permission, path)
+
     # Generate ACLs from principals
     allowed_acl = _build_acl_from_principals(
         principals, Allow, req_permission)
@@ -211,13 +697,13 @@ def build_acl_query(principals, req_permission):
         principals, Deny, req_permission)
 
     # Generate bool terms queries
-    must = _build_acl_bool_terms(allowed_acl, Allow)
-    must_not = _build_acl_bool_terms(denied_acl, Deny)
+    must = _build_acl_bool_terms(allowed_acl, Allow, path)
+    must_not = _build_acl_bool_terms(denied_acl, Deny, path)
 
     def get_bool_filter(query_terms):
         return {
             'nested': {
-                'path': '_acl',
+                'path': path,
                 'filter': {'bool': {'must': query_terms}}
             }
         }
@@ -228,8 +714,45 @@ def build_acl_query(principals, req_permission):
     }
 
 
+def _build_flat_acl_query(principals, req_permission, path='_acl'):
+    """ Build ES query equivalent to `build_acl_query` which uses
+    flattened ACL fields instead of nested ACL.
+
+    :param path: Path of nested ACL field. Flattened ACL fields are
+        '<path>_allow' and '<path>_deny'.
+    """
+    from pyramid.security import ALL_PERMISSIONS
+    field = engine.ACLField
+    permissions = field._stringify_permissions(
+        [ALL_PERMISSIONS, req_permission])
+    tokens = sorted(set(
+        field.ace_token(field._stringify_principal(ident), perm)
+        for ident in principals for perm in permissions))
+    return {
+        'must': [{'terms': {path + '_allow': tokens}}],
+        'must_not': {'terms': {path + '_deny': tokens}},
+    }
+
+
+def cached_acl_query(principals, req_permission, path='_acl'):
+    """ Cached version of `build_acl_query`.
+
+    Queries are cached by (principals set, requested permission, path)
+    in ACL_QUERY_CACHE which is cleared when ACLFilterES is set up.
+    Returned query is shared, so its dicts are frozen and lists are
+    converted to tuples.
+    """
+    key = (frozenset(principals), req_permission, path)
+    query = ACL_QUERY_CACHE.get(key)
+    if query is None:
+        query = freeze(build_acl_query(
+            sorted(key[0]), req_permission, path=path))
+        ACL_QUERY_CACHE.set(key, query)
+    return query
+
+
 def get_es_item_acl(item):
     """ Get item ACL and return objectified version or it. """
     acl = getattr(item, '_acl', ())
-    return engine.ACLField.objectify_acl([
+    return engine.ACLField.objectify_acl_cached([
         ace._data for ace in acl])
@@ -0,0 +1,66 @@
+""" Instrumentation of ACL filtering.
+
+Metrics are reported to a hook callable set with
+'nefertari_guards.metrics_hook' setting or `set_hook`. Hook is called as
+`hook(name, value, kind)` where `kind` is either TIMING, with `value` in
+milliseconds, or COUNT. When no hook is set, metrics are not collected.
+"""
+import time
+from functools import wraps
+
+from nefertari.utils import dictset
+
+
+TIMING = 'timing'
+COUNT = 'count'
+
+# time.perf_counter is not available in python 2
+_clock = getattr(time, 'perf_counter', time.time)
+_hook = None
+
+
+def includeme(config):
+    Settings = dictset(config.registry.settings)
+    set_hook(config.maybe_dotted(
+        Settings.get('nefertari_guards.metrics_hook')))
+
+
+def set_hook(hook):
+    """ Set callable which receives metrics. Pass None to disable
+    metrics.
+    """
+    global _hook
+    _hook = hook
+
+
+def enabled():
+    """ Check whether metrics hook is set. """
+    return _hook is not None
+
+
+def incr(name, value=1):
+    """ Report :value: of counter :name: if it's not zero. """
+    hook = _hook
+    if hook is not None and value:
+        hook(name, value, COUNT)
+
+
+def timed(name):
+    """ Decorator that reports execution time of decorated function as
+    timing :name:.
+
+    Decorated function is called directly when metrics are disabled.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            hook = _hook
+            if hook is None:
+                return func(*args, **kwargs)
+            start = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hook(name, (_clock() - start) * 1000, TIMING)
+        return wrapper
+    return decorator
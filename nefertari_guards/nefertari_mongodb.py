@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+from itertools import islice
+
 from mongoengine import fields
 
 from nefertari_mongodb.fields import BaseFieldMixin
@@ -25,6 +27,60 @@ class ACLField(ACLEncoderMixin, BaseFieldMixin, fields.ListField):
         return super(ACLField, self).__set__(instance, value)
 
 
+def is_list_relationship(model, field):
+    """ Check whether relationship :field: of :model: holds a list of
+    documents.
+    """
+    return isinstance(model._fields[field], fields.ListField)
+
+
+def replace_ace(model, from_ace, to_ace, batch_size=1000):
+    """ Replace `from_ace` with `to_ace` in ACLs of all :model:
+    documents in database.
+
+    Ids of matching documents are streamed by cursor and matching ACEs
+    are replaced by `update_many` queries with array filters, each of
+    which updates up to :batch_size: documents, so documents are not
+    loaded through mongoengine. Requires MongoDB 3.6+.
+
+    :param model: Document class which ACLs should be updated.
+    :param from_ace: Stringified ACL entry (ACE) to match agains.
+    :param to_ace: Stringified ACL entry (ACE) ``from_ace`` should be
+        replaced with.
+    :param batch_size: Number of documents updated by a single query.
+    :returns: Tuple of number of modified documents and list of
+        (primary key, stringified ACL) tuples of documents matched by
+        update queries.
+    """
+    collection = model._get_collection()
+    acl_field = model._fields['_acl'].db_field
+    pk_field = model._fields[model.pk_field()].db_field
+    ace_match = {key: from_ace[key]
+                 for key in ('action', 'principal', 'permission')}
+    query = {acl_field: {'$elemMatch': ace_match}}
+    array_filters = [
+        {'elem.' + key: value for key, value in ace_match.items()}]
+
+    cursor = collection.find(query, {pk_field: 1}, batch_size=batch_size)
+    ids = (doc[pk_field] for doc in cursor)
+    modified = 0
+    rows = []
+    while True:
+        batch_ids = list(islice(ids, batch_size))
+        if not batch_ids:
+            break
+        batch_query = dict(query)
+        batch_query[pk_field] = {'$in': batch_ids}
+        result = collection.update_many(
+            batch_query, {'$set': {acl_field + '.$[elem]': to_ace}},
+            array_filters=array_filters)
+        modified += result.modified_count
+        updated = collection.find(
+            {pk_field: batch_query[pk_field]}, {acl_field: 1})
+        rows.extend((doc[pk_field], doc[acl_field]) for doc in updated)
+    return modified, rows
+
+
 """ Create full map of ES mappings including ACLField """
 ACL_TYPE_MAP = {ACLField: ACL_TYPE_MAPPING}
 EXTENDED_TYPES_MAP = dict(
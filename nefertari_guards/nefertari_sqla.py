@@ -1,6 +1,12 @@
 from __future__ import absolute_import
 
+import json
+
+import six
+from sqlalchemy import text
+from sqlalchemy.orm import class_mapper
 from sqlalchemy_utils.types.json import JSONType
+from pyramid_sqlalchemy import Session
 from nefertari_sqla.fields import BaseField
 from nefertari_sqla.documents import TYPES_MAP
 
@@ -34,6 +40,112 @@ class ACLField(ACLEncoderMixin, BaseField):
         return type_args, type_kw, cleaned_kw
 
 
+def is_list_relationship(model, field):
+    """ Check whether relationship :field: of :model: holds a list of
+    documents.
+    """
+    return class_mapper(model).relationships[field].uselist
+
+
+""" SQL which replaces matching ACEs of ACL column in place. Used by
+`replace_ace` for PostgreSQL and SQLite respectively.
+"""
+_ACE_MATCH = {
+    'postgresql': (
+        "ace->>'action' = :action AND "
+        "ace->>'principal' = :principal AND "
+        "ace->>'permission' = :permission"),
+    'sqlite': (
+        "json_extract(value, '$.action') = :action AND "
+        "json_extract(value, '$.principal') = :principal AND "
+        "json_extract(value, '$.permission') = :permission"),
+}
+_ACE_REPLACE_SQL = {
+    'postgresql': (
+        "UPDATE {table} SET {acl} = ("
+        "SELECT json_agg(CASE WHEN {match} THEN CAST(:to_ace AS json) "
+        "ELSE ace END ORDER BY idx) "
+        "FROM json_array_elements({table}.{acl}) "
+        "WITH ORDINALITY AS t(ace, idx)) "
+        "WHERE {where} RETURNING {pk}, {acl}"),
+    'sqlite': (
+        "UPDATE {table} SET {acl} = ("
+        "SELECT json_group_array(CASE WHEN {match} THEN json(:to_ace) "
+        "ELSE json(value) END) "
+        "FROM (SELECT value FROM json_each({table}.{acl}) ORDER BY key)) "
+        "WHERE {where}"),
+}
+_ACE_WHERE_SQL = {
+    'postgresql': (
+        "EXISTS (SELECT 1 FROM json_array_elements({table}.{acl}) "
+        "AS t(ace) WHERE {match})"),
+    'sqlite': (
+        "EXISTS (SELECT 1 FROM json_each({table}.{acl}) WHERE {match})"),
+}
+
+
+def replace_ace(model, from_ace, to_ace, session=None):
+    """ Replace `from_ace` with `to_ace` in ACLs of all :model: rows
+    with a single UPDATE query.
+
+    ACLs are rewritten by database using JSON functions, so no objects
+    are loaded. Only PostgreSQL and SQLite (json1) are supported.
+
+    :param model: Document class which ACLs should be updated.
+    :param from_ace: Stringified ACL entry (ACE) to match agains.
+    :param to_ace: Stringified ACL entry (ACE) ``from_ace`` should be
+        replaced with.
+    :param session: SQLA session to use. Defaults to
+        pyramid_sqlalchemy Session.
+    :returns: Tuple of number of updated rows and list of (primary key,
+        updated stringified ACL) tuples of updated rows.
+    :raises ValueError: If database is not supported.
+    """
+    session = session or Session()
+    dialect = session.get_bind(mapper=class_mapper(model)).dialect
+    if dialect.name not in _ACE_REPLACE_SQL:
+        raise ValueError(
+            'Server-side ACE replacement is not supported by {}'.format(
+                dialect.name))
+
+    quote = dialect.identifier_preparer.quote
+    names = {
+        'table': quote(model.__table__.name),
+        'acl': quote('_acl'),
+        'pk': quote(model.pk_field()),
+        'match': _ACE_MATCH[dialect.name],
+    }
+    names['where'] = _ACE_WHERE_SQL[dialect.name].format(**names)
+    params = {
+        'action': from_ace['action'],
+        'principal': from_ace['principal'],
+        'permission': from_ace['permission'],
+        'to_ace': json.dumps(to_ace),
+    }
+    update = text(_ACE_REPLACE_SQL[dialect.name].format(**names))
+
+    # Objects loaded in session are expired after update
+    session.flush()
+    if dialect.name == 'postgresql':
+        rows = session.execute(update, params).fetchall()
+    else:
+        # SQLite UPDATE is not able to return updated rows
+        select = 'SELECT {pk} FROM {table} WHERE {where}'.format(**names)
+        ids = [row[0] for row in session.execute(text(select), params)]
+        if not ids:
+            return 0, []
+        session.execute(update, params)
+        query = session.query(
+            getattr(model, model.pk_field()), model.__table__.c._acl)
+        rows = query.filter(getattr(model, model.pk_field()).in_(ids))
+
+    rows = [
+        (pk, json.loads(acl) if isinstance(acl, six.string_types) else acl)
+        for pk, acl in rows]
+    session.expire_all()
+    return len(rows), rows
+
+
 """ Create full map of ES mappings including ACLField """
 ACL_TYPE_MAP = {ACLType: ACL_TYPE_MAPPING}
 EXTENDED_TYPES_MAP = dict(
@@ -0,0 +1,77 @@
+"""
+acl_report:
+    Report number of documents per model, ACE action, principal and
+    permission. Prints report in CSV or JSON lines format.
+"""
+import csv
+import json
+import sys
+from argparse import ArgumentParser
+
+from nefertari import engine
+from nefertari.utils import split_strip
+
+from nefertari_guards.scripts.script_utils import AppBootstrapCmd
+from nefertari_guards.acl_utils import acl_report, DEFAULT_REPORT_SIZE
+
+
+REPORT_FIELDS = ('model', 'action', 'principal', 'permission', 'count')
+
+
+def main():
+    return ACLReportCommand().run()
+
+
+class ACLReportCommand(AppBootstrapCmd):
+    """
+    :Usage example:
+        $ nefertari-guards.acl_report
+        --config=local.ini
+        --models=User,Story
+        --format=json
+    """
+    def _parse_options(self):
+        parser = ArgumentParser(description=__doc__)
+        parser.add_argument(
+            '-c', '--config',
+            help='Config .ini file path',
+            required=True)
+        parser.add_argument(
+            '--models',
+            help=('Comma-separated list of model names which should be '
+                  'reported. If not provided all es-based models '
+                  'are used.'),
+            required=False)
+        parser.add_argument(
+            '--format',
+            help='Output format. Defaults to csv.',
+            choices=('csv', 'json'),
+            default='csv')
+        parser.add_argument(
+            '--size',
+            help=('Maximum number of distinct principals reported per '
+                  'model and action. Defaults to {}.'.format(
+                      DEFAULT_REPORT_SIZE)),
+            type=int,
+            default=DEFAULT_REPORT_SIZE)
+        return parser.parse_args()
+
+    def run(self, output=None):
+        if output is None:
+            output = sys.stdout
+
+        if self.options.models:
+            model_names = split_strip(self.options.models)
+            models = [engine.get_document_cls(name)
+                      for name in model_names]
+        else:
+            models = None
+
+        rows = acl_report(models=models, size=self.options.size)
+        if self.options.format == 'json':
+            for row in rows:
+                output.write(json.dumps(row, sort_keys=True) + '\n')
+        else:
+            writer = csv.DictWriter(output, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
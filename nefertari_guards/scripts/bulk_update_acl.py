@@ -0,0 +1,97 @@
+"""
+bulk_update_acl:
+    Apply multiple ACE operations (add/remove/replace) to documents
+    in one pass.
+"""
+
+import json
+import logging
+from argparse import ArgumentParser
+
+import six
+from nefertari import engine
+from nefertari.utils import split_strip
+
+from nefertari_guards.scripts.script_utils import AppBootstrapCmd
+from nefertari_guards.acl_utils import bulk_update_acl, DEFAULT_BATCH_SIZE
+
+
+def main():
+    return BulkUpdateACLCommand().run()
+
+
+class BulkUpdateACLCommand(AppBootstrapCmd):
+    """
+    :Usage example:
+        $ nefertari-guards.bulk_update_acl
+        --config=local.ini
+        --operations='[
+            {"op": "remove", "ace": {"action": "allow", "principal": "user1", "permission": "view"}},
+            {"op": "add", "match": {"action": "allow", "principal": "user2", "permission": "view"}, "ace": {"action": "allow", "principal": "user3", "permission": "view"}},
+            {"op": "replace", "from_ace": {"action": "deny", "principal": "user4", "permission": "view"}, "to_ace": {"action": "allow", "principal": "user4", "permission": "view"}}
+        ]'
+        --models=User,Story
+
+    Operations may also be read from a JSON file with
+    --operations_file=operations.json
+    """
+    def _parse_options(self):
+        parser = ArgumentParser(description=__doc__)
+        parser.add_argument(
+            '-c', '--config',
+            help='Config .ini file path',
+            required=True)
+        parser.add_argument(
+            '--models',
+            help=('Comma-separated list of model names which should be '
+                  'affected. If not provided all es-based models '
+                  'are used.'),
+            required=False)
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument(
+            '--operations',
+            help='JSON-encoded list of operations.')
+        group.add_argument(
+            '--operations_file',
+            help='Path to file with JSON-encoded list of operations.')
+        parser.add_argument(
+            '--batch_size',
+            help=('Number of documents updated and committed at once. '
+                  'Defaults to {}.'.format(DEFAULT_BATCH_SIZE)),
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            required=False)
+        return parser.parse_args()
+
+    def _setup_logger(self):
+        super(BulkUpdateACLCommand, self)._setup_logger()
+        # Report progress of update
+        logging.getLogger('nefertari_guards.acl_utils').setLevel(
+            logging.INFO)
+
+    def run(self):
+        if self.options.models:
+            model_names = split_strip(self.options.models)
+            models = [engine.get_document_cls(name)
+                      for name in model_names]
+        else:
+            models = None
+
+        if self.options.operations_file:
+            with open(self.options.operations_file) as operations_file:
+                operations = operations_file.read()
+        else:
+            operations = self.options.operations
+
+        try:
+            operations = json.loads(operations)
+        except ValueError as ex:
+            raise ValueError('--operations: {}'.format(ex))
+
+        six.print_('Updating documents ACL')
+
+        updated = bulk_update_acl(
+            operations=operations, models=models,
+            batch_size=self.options.batch_size, commit=True)
+
+        six.print_('Done. Updated {} documents'.format(updated))
@@ -2,6 +2,7 @@
 count_ace:
     Count the number of documents that contain a particular ACE.
     Prints the count of objects with matching ACE, listed by type, in CSV format.
+    Multiple ACEs may be counted at once with --aces.
 """
 import json
 from argparse import ArgumentParser
@@ -11,7 +12,7 @@ from nefertari import engine
 from nefertari.utils import split_strip
 
 from nefertari_guards.scripts.script_utils import AppBootstrapCmd
-from nefertari_guards.acl_utils import count_ace
+from nefertari_guards.acl_utils import count_aces
 
 
 def main():
@@ -25,6 +26,10 @@ class CountACECommand(AppBootstrapCmd):
         --config=local.ini
         --ace='{"action": "allow", "principal": "user1", "permission": "view"}'
         --models=User,Story
+
+        $ nefertari-guards.count_ace
+        --config=local.ini
+        --aces='[{"action": "allow", "principal": "user1", "permission": "view"}, {"action": "allow", "principal": "user2", "permission": "view"}]'
     """
     def _parse_options(self):
         parser = ArgumentParser(description=__doc__)
@@ -38,10 +43,14 @@ class CountACECommand(AppBootstrapCmd):
                   'affected. If not provided all es-based models '
                   'are used.'),
             required=False)
-        parser.add_argument(
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument(
             '--ace',
-            help=('JSON-encoded ACE to use in documents lookup.'),
-            required=True)
+            help=('JSON-encoded ACE to use in documents lookup.'))
+        group.add_argument(
+            '--aces',
+            help=('JSON-encoded list of ACEs to use in documents lookup. '
+                  'Documents are counted for each ACE.'))
         return parser.parse_args()
 
     def run(self):
@@ -52,14 +61,34 @@ class CountACECommand(AppBootstrapCmd):
         else:
             models = None
 
-        try:
-            ace = json.loads(self.options.ace)
-        except ValueError as ex:
-            raise ValueError('--ace: {}'.format(ex))
+        if self.options.aces:
+            try:
+                aces = json.loads(self.options.aces)
+            except ValueError as ex:
+                raise ValueError('--aces: {}'.format(ex))
+        else:
+            try:
+                aces = [json.loads(self.options.ace)]
+            except ValueError as ex:
+                raise ValueError('--ace: {}'.format(ex))
+
+        counts = count_aces(aces=aces, models=models)
+        if not self.options.aces:
+            self._print_counts(counts[0])
+            return
+
+        six.print_('Action,Principal,Permission,Model,Count')
+        for ace, ace_counts in zip(aces, counts):
+            prefix = '{},{},{},'.format(
+                ace['action'], ace['principal'], ace['permission'])
+            self._print_counts(ace_counts, prefix)
 
-        counts = count_ace(ace=ace, models=models)
-        six.print_('Model,Count')
+    def _print_counts(self, counts, prefix=None):
+        """ Print models counts in CSV format. """
+        if prefix is None:
+            six.print_('Model,Count')
+            prefix = ''
         for model, count in counts.items():
             if count is None:
                 count = 'Not es-based'
-            six.print_('{},{}'.format(model.__name__, count))
+            six.print_('{}{},{}'.format(prefix, model.__name__, count))
@@ -5,6 +5,7 @@ update_ace:
 """
 
 import json
+import logging
 from argparse import ArgumentParser
 
 import six
@@ -12,7 +13,8 @@ from nefertari import engine
 from nefertari.utils import split_strip
 
 from nefertari_guards.scripts.script_utils import AppBootstrapCmd
-from nefertari_guards.acl_utils import update_ace
+from nefertari_guards.acl_utils import update_ace, DEFAULT_BATCH_SIZE
+from nefertari_guards.compact import CompactACL
 
 
 def main():
@@ -27,6 +29,16 @@ class UpdateACECommand(AppBootstrapCmd):
         --from_ace='{"action": "allow", "principal": "user1", "permission": "view"}'
         --to_ace='{"action": "deny", "principal": "user1", "permission": "view"}'
         --models=User,Story
+        --batch_size=1000
+        --workers=4
+
+    Use --server_side to rewrite ACLs in database without loading
+    documents (PostgreSQL, SQLite or MongoDB 3.6+).
+
+    Use --dry_run to print changes as JSON lines without writing them.
+
+    Use --checkpoint=update_ace.json to save progress after each batch
+    and --resume to continue interrupted update from saved checkpoint.
     """
     def _parse_options(self):
         parser = ArgumentParser(description=__doc__)
@@ -48,8 +60,48 @@ class UpdateACECommand(AppBootstrapCmd):
             '--to_ace',
             help=('JSON-encoded ACE to replace "from_ace" ACE with.'),
             required=True)
+        parser.add_argument(
+            '--batch_size',
+            help=('Number of documents updated and committed at once. '
+                  'Defaults to {}.'.format(DEFAULT_BATCH_SIZE)),
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            required=False)
+        parser.add_argument(
+            '--workers',
+            help=('Number of threads used to update documents. '
+                  'Defaults to 1.'),
+            type=int,
+            default=1,
+            required=False)
+        parser.add_argument(
+            '--server_side',
+            help=('Rewrite ACLs with a single database query per model '
+                  'instead of updating documents one by one.'),
+            action='store_true')
+        parser.add_argument(
+            '--dry_run', '--dry-run',
+            help=('Print IDs and ACLs before and after update of matching '
+                  'documents as JSON lines without updating them.'),
+            dest='dry_run',
+            action='store_true')
+        parser.add_argument(
+            '--checkpoint',
+            help=('Path of file progress is saved to after each batch. '
+                  'File is removed when update is finished.'),
+            required=False)
+        parser.add_argument(
+            '--resume',
+            help='Continue update from progress saved to --checkpoint.',
+            action='store_true')
         return parser.parse_args()
 
+    def _setup_logger(self):
+        super(UpdateACECommand, self)._setup_logger()
+        # Report progress of update
+        logging.getLogger('nefertari_guards.acl_utils').setLevel(
+            logging.INFO)
+
     def run(self):
         if self.options.models:
             model_names = split_strip(self.options.models)
@@ -68,14 +120,25 @@ class UpdateACECommand(AppBootstrapCmd):
         except ValueError as ex:
             raise ValueError('--to_ace: {}'.format(ex))
 
-        six.print_('Updating documents ACE')
+        if self.options.dry_run:
+            changes = update_ace(
+                from_ace=from_ace, to_ace=to_ace, models=models,
+                batch_size=self.options.batch_size, dry_run=True)
+            for change in changes:
+                for key in ('before', 'after'):
+                    if isinstance(change[key], CompactACL):
+                        change[key] = change[key].to_dicts()
+                six.print_(json.dumps(change, sort_keys=True, default=str))
+            return
 
-        update_ace(from_ace=from_ace, to_ace=to_ace, models=models)
+        six.print_('Updating documents ACE')
 
-        try:
-            import transaction
-            transaction.commit()
-        except:
-            pass
+        updated = update_ace(
+            from_ace=from_ace, to_ace=to_ace, models=models,
+            batch_size=self.options.batch_size, commit=True,
+            workers=self.options.workers,
+            server_side=self.options.server_side,
+            checkpoint=self.options.checkpoint,
+            resume=self.options.resume)
 
-        six.print_('Done')
+        six.print_('Done. Updated {} documents'.format(updated))
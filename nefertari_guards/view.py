@@ -1,11 +1,13 @@
 from nefertari.view_helpers import ESAggregator
 
+from nefertari_guards import metrics
 from nefertari_guards.elasticsearch import ACLFilterES
 
 
 class ACLESAggregator(ESAggregator):
     """ Aggregator that applies ACL filtering when auth is enabled. """
 
+    @metrics.timed('nefertari_guards.aggregate')
     def aggregate(self):
         """ Perform aggregation and return response. """
         aggregations_params = self.pop_aggregations_params()
@@ -41,5 +41,7 @@ setup(
     [console_scripts]
         nefertari-guards.count_ace = nefertari_guards.scripts.count_ace:main
         nefertari-guards.update_ace = nefertari_guards.scripts.update_ace:main
+        nefertari-guards.bulk_update_acl = nefertari_guards.scripts.bulk_update_acl:main
+        nefertari-guards.acl_report = nefertari_guards.scripts.acl_report:main
     """,
 )
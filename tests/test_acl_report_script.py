@@ -0,0 +1,48 @@
+from six import StringIO
+from mock import patch, Mock, call
+
+from nefertari_guards.scripts.acl_report import ACLReportCommand
+
+
+ROWS = [
+    {'model': 'Story', 'action': 'allow', 'principal': 'user1',
+     'permission': 'view', 'count': 3},
+    {'model': 'Story', 'action': 'deny', 'principal': 'everyone',
+     'permission': 'all', 'count': 1},
+]
+
+
+@patch('nefertari_guards.scripts.acl_report.ACLReportCommand._parse_options')
+@patch('nefertari_guards.scripts.acl_report.ACLReportCommand._bootstrap')
+class TestACLReportCommand(object):
+
+    @patch('nefertari_guards.scripts.acl_report.acl_report')
+    def test_run_csv(self, mock_report, mock_boot, mock_parse):
+        obj = ACLReportCommand()
+        obj.options = Mock(models=None, format='csv', size=10)
+        mock_report.return_value = iter(ROWS)
+        output = StringIO()
+        obj.run(output)
+        mock_report.assert_called_once_with(models=None, size=10)
+        assert output.getvalue().splitlines() == [
+            'model,action,principal,permission,count',
+            'Story,allow,user1,view,3',
+            'Story,deny,everyone,all,1',
+        ]
+
+    @patch('nefertari_guards.scripts.acl_report.engine')
+    @patch('nefertari_guards.scripts.acl_report.acl_report')
+    def test_run_json(self, mock_report, mock_eng, mock_boot, mock_parse):
+        import json
+        obj = ACLReportCommand()
+        obj.options = Mock(models='User,Story', format='json', size=10)
+        mock_eng.get_document_cls.side_effect = lambda name: name
+        mock_report.return_value = iter(ROWS)
+        output = StringIO()
+        obj.run(output)
+        mock_eng.get_document_cls.assert_has_calls([
+            call('User'), call('Story')])
+        mock_report.assert_called_once_with(
+            models=['User', 'Story'], size=10)
+        lines = output.getvalue().splitlines()
+        assert [json.loads(line) for line in lines] == ROWS
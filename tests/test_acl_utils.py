@@ -6,28 +6,67 @@ from nefertari_guards import acl_utils
 
 class TestAclUtils(object):
 
-    @patch('nefertari_guards.acl_utils.engine')
-    @patch('nefertari_guards.acl_utils.find_by_ace')
-    def test_count_ace_with_models(self, mock_find, mock_eng):
-        result = acl_utils.count_ace(1, [2, 3])
-        mock_find.assert_has_calls([
-            call(1, [2], count=True),
-            call(1, [3], count=True)])
-        assert not mock_eng.get_document_classes.called
-        assert result == {2: mock_find(), 3: mock_find()}
+    @patch('nefertari_guards.acl_utils.count_aces')
+    def test_count_ace(self, mock_count):
+        mock_count.return_value = [{2: 1}]
+        assert acl_utils.count_ace(1, [2]) == {2: 1}
+        mock_count.assert_called_once_with([1], [2])
+
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_count_aces(self, mock_es):
+        mock_es.src2type.side_effect = lambda name: name
+        mock_es.settings.index_name = 'foondex'
+        Foo = Mock(__name__='Foo', _index_enabled=True)
+        Bar = Mock(__name__='Bar', _index_enabled=True)
+        Baz = Mock(__name__='Baz', _index_enabled=False)
+        ace1 = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        ace2 = {'action': 'deny', 'principal': 'b', 'permission': 'all'}
+        mock_es.api.search.return_value = {'aggregations': {'aces': {
+            'buckets': {
+                '0': {'types': {'buckets': [
+                    {'key': 'Foo', 'doc_count': 3},
+                    {'key': 'Bar', 'doc_count': 1},
+                ]}},
+                '1': {'types': {'buckets': [
+                    {'key': 'Bar', 'doc_count': 5},
+                ]}},
+            }
+        }}}
+        counts = acl_utils.count_aces([ace1, ace2], [Foo, Bar, Baz])
+        assert counts == [
+            {Foo: 3, Bar: 1, Baz: None},
+            {Foo: 0, Bar: 5, Baz: None},
+        ]
+        mock_es.api.search.assert_called_once_with(
+            index='foondex', doc_type='Bar,Foo', body={
+                'size': 0,
+                'aggs': {'aces': {
+                    'filters': {'filters': {
+                        '0': acl_utils._get_ace_filter(ace1),
+                        '1': acl_utils._get_ace_filter(ace2),
+                    }},
+                    'aggs': {'types': {
+                        'terms': {'field': '_type', 'size': 2}}},
+                }},
+            })
 
+    @patch('nefertari_guards.acl_utils.ES')
     @patch('nefertari_guards.acl_utils.engine')
-    @patch('nefertari_guards.acl_utils.find_by_ace')
-    def test_count_ace_without_models(self, mock_find, mock_eng):
-        mock_eng.get_document_classes.return_value = {'zoo': 2}
-        acl_utils.count_ace(1)
-        mock_find.assert_called_with(1, [2], count=True)
+    def test_count_aces_no_es_models(self, mock_eng, mock_es):
+        Baz = Mock(__name__='Baz', _index_enabled=False)
+        mock_eng.get_document_classes.return_value = {'Baz': Baz}
+        counts = acl_utils.count_aces([{'action': 'allow'}])
+        assert counts == [{Baz: None}]
+        assert not mock_es.api.search.called
 
-    @patch('nefertari_guards.acl_utils.find_by_ace')
-    def test_count_ace_valueerror(self, mock_find):
-        mock_find.side_effect = ValueError
-        result = acl_utils.count_ace(1, [2])
-        assert result == {2: None}
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_count_aces_no_index(self, mock_es):
+        mock_es.src2type.side_effect = lambda name: name
+        mock_es.api.search.side_effect = acl_utils.IndexNotFoundException(
+            404, 'missing')
+        Foo = Mock(__name__='Foo', _index_enabled=True)
+        ace = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        assert acl_utils.count_aces([ace], [Foo]) == [{Foo: 0}]
 
     @patch('nefertari_guards.acl_utils.ES')
     @patch('nefertari_guards.acl_utils._get_es_body')
@@ -90,36 +129,68 @@ class TestAclUtils(object):
             }
         }
 
+    @patch.object(acl_utils.ACLEncoderMixin, 'flat_acl', True)
+    def test_get_es_body_flat(self):
+        body = acl_utils._get_es_body({
+            'action': 'deny',
+            'principal': 'user12',
+            'permission': 'view'
+        })
+        assert body == {
+            'query': {
+                'filtered': {
+                    'filter': {'term': {'_acl_deny': 'user12:view'}}
+                }
+            }
+        }
+
     @patch('nefertari_guards.acl_utils.find_by_ace')
     def test_update_ace_invalid_ace(self, mock_find):
         with pytest.raises(ValueError) as ex:
             acl_utils.update_ace({}, {"action": "foo"}, 1)
         assert 'Invalid ACL action value: foo' in str(ex.value)
 
+    @patch('nefertari_guards.acl_utils._commit')
     @patch('nefertari_guards.acl_utils._replace_docs_ace')
     @patch('nefertari_guards.acl_utils._extract_ids')
     @patch('nefertari_guards.acl_utils._group_by_type')
-    @patch('nefertari_guards.acl_utils.find_by_ace')
-    def test_update_ace(self, mock_find, mock_group, mock_extr, mock_upd):
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace(self, mock_iter, mock_group, mock_extr, mock_upd,
+                        mock_commit):
         to_ace = {
             "action": "allow",
             "principal": "a",
             "permission": "view"}
         Model = Mock()
         Model.get_by_ids.return_value = [4, 5, 6]
+        mock_iter.return_value = iter([[1], [2]])
         mock_extr.return_value = {Model: [1, 2, 3]}
-        acl_utils.update_ace({'z': 1}, to_ace, 'Z')
-        mock_find.assert_called_once_with({'z': 1}, 'Z')
-        mock_group.assert_called_once_with(mock_find(), 'Z')
-        mock_extr.assert_called_once_with(mock_group())
-        mock_upd.assert_called_once_with(
-            [4, 5, 6], {'z': 1}, to_ace)
-        Model.get_by_ids.assert_called_once_with([1, 2, 3])
+        mock_upd.return_value = 3
+        result = acl_utils.update_ace({'z': 1}, to_ace, 'Z', batch_size=3)
+        assert result == 6
+        mock_iter.assert_called_once_with({'z': 1}, 'Z', 3)
+        mock_group.assert_has_calls([call([1], 'Z'), call([2], 'Z')])
+        assert mock_extr.call_count == 2
+        mock_upd.assert_called_with([4, 5, 6], {'z': 1}, to_ace)
+        Model.get_by_ids.assert_called_with([1, 2, 3])
+        assert not mock_commit.called
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_commit(self, mock_iter, mock_commit):
+        to_ace = {
+            "action": "allow",
+            "principal": "a",
+            "permission": "view"}
+        mock_iter.return_value = iter([[], []])
+        acl_utils.update_ace({'z': 1}, to_ace, [], commit=True)
+        assert mock_commit.call_count == 2
 
     @patch('nefertari_guards.acl_utils.engine')
-    @patch('nefertari_guards.acl_utils.find_by_ace')
-    def test_update_ace_end_to_end(self, mock_find, mock_eng):
-        mock_find.return_value = [Mock(username='user12', _type='User')]
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_end_to_end(self, mock_iter, mock_eng):
+        mock_iter.return_value = iter([
+            [Mock(username='user12', _type='User')]])
         db_obj = Mock(_acl=[{'foo': 1}])
         User = Mock()
         User.pk_field.return_value = 'username'
@@ -129,10 +200,332 @@ class TestAclUtils(object):
             "action": "allow",
             "principal": "user12",
             "permission": "view"}
-        acl_utils.update_ace({'foo': 1}, to_ace)
+        assert acl_utils.update_ace({'foo': 1}, to_ace) == 1
         db_obj.update.assert_called_once_with({
             '_acl': [to_ace]})
 
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_workers(self, mock_iter, mock_commit):
+        import threading
+        to_ace = {
+            "action": "allow",
+            "principal": "a",
+            "permission": "view"}
+        threads = set()
+
+        def get_by_ids(ids):
+            threads.add(threading.current_thread().ident)
+            return [Mock(_acl=[{'z': 1}]) for _ in ids]
+
+        Foo = Mock(__name__='Foo')
+        Foo.pk_field.return_value = 'id'
+        Foo.get_by_ids.side_effect = get_by_ids
+        Bar = Mock(__name__='Bar')
+        Bar.pk_field.return_value = 'id'
+        Bar.get_by_ids.side_effect = get_by_ids
+        batches = [
+            [Mock(_type='Foo', id=i), Mock(_type='Bar', id=i)]
+            for i in range(10)]
+        mock_iter.return_value = iter(batches)
+        result = acl_utils.update_ace(
+            {'z': 1}, to_ace, [Foo, Bar], batch_size=2, workers=3)
+        assert result == 20
+        assert Foo.get_by_ids.call_count == 10
+        assert Bar.get_by_ids.call_count == 10
+        assert mock_commit.call_count == 20
+        assert threading.current_thread().ident not in threads
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_workers_error(self, mock_iter, mock_commit):
+        to_ace = {
+            "action": "allow",
+            "principal": "a",
+            "permission": "view"}
+        Foo = Mock(__name__='Foo')
+        Foo.pk_field.return_value = 'id'
+        Foo.get_by_ids.side_effect = KeyError('foo')
+        mock_iter.return_value = iter([[Mock(_type='Foo', id=1)]])
+        with pytest.raises(KeyError):
+            acl_utils.update_ace({'z': 1}, to_ace, [Foo], workers=2)
+        assert not mock_commit.called
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils._reindex_acls')
+    @patch('nefertari_guards.engine', create=True)
+    def test_update_ace_server_side(self, mock_engine, mock_reindex,
+                                    mock_commit):
+        to_ace = {
+            "action": "allow",
+            "principal": "a",
+            "permission": "view"}
+        Foo = Mock(_index_enabled=True)
+        Bar = Mock(_index_enabled=False)
+        Baz = Mock(spec=[])
+        rows = {Foo: [(1, [to_ace]), (2, [to_ace])], Bar: [(3, [to_ace])]}
+        counts = {Foo: 1, Bar: 1}
+        mock_engine.replace_ace.side_effect = lambda m, f, t: (
+            counts[m], rows[m])
+        result = acl_utils.update_ace(
+            {'z': 1}, to_ace, [Foo, Bar, Baz], commit=True,
+            server_side=True)
+        assert result == 2
+        mock_engine.replace_ace.assert_has_calls([
+            call(Foo, {'z': 1}, to_ace), call(Bar, {'z': 1}, to_ace)])
+        assert mock_engine.replace_ace.call_count == 2
+        mock_reindex.assert_called_once_with(Foo, rows[Foo])
+        assert mock_commit.call_count == 2
+
+    @patch('nefertari_guards.engine', spec=[], create=True)
+    def test_update_ace_server_side_not_supported(self, mock_engine):
+        to_ace = {
+            "action": "allow",
+            "principal": "a",
+            "permission": "view"}
+        with pytest.raises(ValueError) as ex:
+            acl_utils.update_ace({}, to_ace, [], server_side=True)
+        assert 'not supported by engine' in str(ex.value)
+
+    @patch.object(acl_utils.ACLEncoderMixin, 'flat_acl', True)
+    @patch('nefertari_guards.acl_utils.helpers')
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_reindex_acls(self, mock_es, mock_helpers):
+        acl = [{'action': 'allow', 'principal': 'a', 'permission': 'view'}]
+        es = mock_es.return_value
+        es.index_name = 'foondex'
+        es.doc_type = 'Foo'
+        es.chunk_size = 1
+        model = Mock(__name__='Foo')
+        acl_utils._reindex_acls(model, [(1, acl), (2, [])])
+        mock_es.assert_called_once_with('Foo')
+        mock_helpers.bulk.assert_called_once_with(mock_es.api, [{
+            '_op_type': 'update',
+            '_index': 'foondex',
+            '_type': 'Foo',
+            '_id': '1',
+            'doc': {
+                '_acl': acl,
+                '_acl_allow': ['a:view'],
+                '_acl_deny': [],
+            },
+        }, {
+            '_op_type': 'update',
+            '_index': 'foondex',
+            '_type': 'Foo',
+            '_id': '2',
+            'doc': {'_acl': [], '_acl_allow': [], '_acl_deny': []},
+        }], chunk_size=1)
+        model.get_by_ids.assert_has_calls([call([1]), call([2])])
+        mock_es.bulk_index_relations.assert_called_with(
+            model.get_by_ids(), nested_only=True)
+        assert mock_es.bulk_index_relations.call_count == 2
+
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_dry_run(self, mock_iter):
+        to_ace = {
+            "action": "allow",
+            "principal": "user12",
+            "permission": "view"}
+        mock_iter.return_value = iter([
+            [Mock(username='user12', _type='User'),
+             Mock(username='user13', _type='User')],
+            [Mock(username='user14', _type='User')],
+        ])
+        changed = Mock(username='user12', _acl=[{'foo': 1}, {'bar': 1}])
+        stale = Mock(username='user13', _acl=[{'bar': 1}])
+        other = Mock(username='user14', _acl=[{'foo': 1}])
+        User = Mock(__name__='User')
+        User.pk_field.return_value = 'username'
+        User.get_by_ids.side_effect = [[changed, stale], [other]]
+        changes = acl_utils.update_ace(
+            {'foo': 1}, to_ace, [User], batch_size=2, dry_run=True)
+        assert not mock_iter.called
+        assert list(changes) == [
+            {'model': 'User', 'id': 'user12',
+             'before': [{'foo': 1}, {'bar': 1}],
+             'after': [to_ace, {'bar': 1}]},
+            {'model': 'User', 'id': 'user14',
+             'before': [{'foo': 1}], 'after': [to_ace]},
+        ]
+        mock_iter.assert_called_once_with({'foo': 1}, [User], 2)
+        User.get_by_ids.assert_has_calls([
+            call(['user12', 'user13']), call(['user14'])])
+        assert not changed.update.called
+        assert not other.update.called
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_checkpoint(self, mock_iter, mock_commit, tmpdir):
+        import json
+        import os
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        to_ace = {
+            "action": "allow",
+            "principal": "user12",
+            "permission": "view"}
+        saved = []
+
+        def commit():
+            # Checkpoint of previous batch is saved by now
+            if os.path.exists(checkpoint):
+                with open(checkpoint) as checkpoint_file:
+                    saved.append(json.load(checkpoint_file))
+
+        mock_commit.side_effect = commit
+        mock_iter.return_value = iter([
+            [Mock(username='user1', _type='User', _uid='User#user1')],
+            [Mock(username='user2', _type='User', _uid='User#user2')],
+        ])
+        User = Mock(__name__='User')
+        User.pk_field.return_value = 'username'
+        User.get_by_ids.side_effect = lambda ids: [Mock(_acl=[{'foo': 1}])]
+        result = acl_utils.update_ace(
+            {'foo': 1}, to_ace, [User], batch_size=1, commit=True,
+            checkpoint=checkpoint)
+        assert result == 2
+        mock_iter.assert_called_once_with(
+            {'foo': 1}, [User], 1, after=None, ordered=True)
+        assert saved == [{
+            'batch': 1, 'last_uid': 'User#user1', 'updated': 1,
+            'from_ace': {'foo': 1}, 'to_ace': to_ace,
+        }]
+        assert not tmpdir.join('checkpoint.json').exists()
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils.iter_by_ace')
+    def test_update_ace_resume(self, mock_iter, mock_commit, tmpdir):
+        import json
+        checkpoint = tmpdir.join('checkpoint.json')
+        to_ace = {
+            "action": "allow",
+            "principal": "user12",
+            "permission": "view"}
+        checkpoint.write(json.dumps({
+            'batch': 3, 'last_uid': 'User#user3', 'updated': 3,
+            'from_ace': {'foo': 1}, 'to_ace': to_ace,
+        }))
+        mock_iter.return_value = iter([
+            [Mock(username='user4', _type='User', _uid='User#user4')],
+        ])
+        User = Mock(__name__='User')
+        User.pk_field.return_value = 'username'
+        User.get_by_ids.return_value = [Mock(_acl=[{'foo': 1}])]
+        result = acl_utils.update_ace(
+            {'foo': 1}, to_ace, [User], commit=True,
+            checkpoint=str(checkpoint), resume=True)
+        assert result == 4
+        mock_iter.assert_called_once_with(
+            {'foo': 1}, [User], acl_utils.DEFAULT_BATCH_SIZE,
+            after='User#user3', ordered=True)
+        mock_commit.assert_called_once_with()
+        assert not checkpoint.exists()
+
+    def test_update_ace_resume_other_aces(self, tmpdir):
+        import json
+        checkpoint = tmpdir.join('checkpoint.json')
+        to_ace = {
+            "action": "allow",
+            "principal": "user12",
+            "permission": "view"}
+        checkpoint.write(json.dumps({
+            'batch': 3, 'last_uid': 'User#user3', 'updated': 3,
+            'from_ace': {'bar': 1}, 'to_ace': to_ace,
+        }))
+        with pytest.raises(ValueError) as ex:
+            acl_utils.update_ace(
+                {'foo': 1}, to_ace, [], commit=True,
+                checkpoint=str(checkpoint), resume=True)
+        assert 'saved for different ACEs' in str(ex.value)
+        assert checkpoint.exists()
+
+    def test_update_ace_checkpoint_invalid_options(self):
+        to_ace = {
+            "action": "allow",
+            "principal": "user12",
+            "permission": "view"}
+        with pytest.raises(ValueError):
+            acl_utils.update_ace({}, to_ace, [], checkpoint='foo')
+        with pytest.raises(ValueError):
+            acl_utils.update_ace(
+                {}, to_ace, [], checkpoint='foo', commit=True, workers=2)
+        with pytest.raises(ValueError) as ex:
+            acl_utils.update_ace({}, to_ace, [], resume=True)
+        assert 'Checkpoint file is required' in str(ex.value)
+
+    def test_replace_ace(self):
+        acl = [{'foo': 1}, {'bar': 1}, {'foo': 1}]
+        result = acl_utils._replace_ace(acl, {'foo': 1}, {'baz': 1})
+        assert result == [{'baz': 1}, {'bar': 1}, {'baz': 1}]
+        assert acl == [{'foo': 1}, {'bar': 1}, {'foo': 1}]
+        assert acl_utils._replace_ace(None, {'foo': 1}, {'baz': 1}) is None
+
+    @patch('nefertari_guards.acl_utils.helpers')
+    @patch('nefertari_guards.acl_utils.ES')
+    @patch('nefertari_guards.acl_utils._get_es_body')
+    @patch('nefertari_guards.acl_utils._get_es_types')
+    def test_iter_by_ace(self, mock_types, mock_body, mock_es, mock_helpers):
+        mock_types.return_value = 'Foo,Bar'
+        mock_es.settings.index_name = 'foondex'
+        Foo = Mock()
+        Foo.pk_field.return_value = 'id'
+        Bar = Mock()
+        Bar.pk_field.return_value = 'username'
+        mock_helpers.scan.return_value = iter([
+            {'_type': 'Foo', '_id': '1', '_source': {'id': 1}},
+            {'_type': 'Bar', '_id': 'a', '_source': {'username': 'a'}},
+            {'_type': 'Foo', '_id': '2', '_source': {'id': 2}},
+        ])
+        batches = list(acl_utils.iter_by_ace(
+            {'a': 1}, [Foo, Bar], batch_size=2))
+        mock_helpers.scan.assert_called_once_with(
+            mock_es.api, query=mock_body(), index='foondex',
+            doc_type='Foo,Bar', size=2, preserve_order=False,
+            _source_include='id,username')
+        assert mock_body.call_args_list[0] == call({'a': 1})
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert batches[0][0]._type == 'Foo'
+        assert batches[0][0].id == 1
+        assert batches[0][1].username == 'a'
+        assert batches[1][0].id == 2
+        assert batches[1][0]._uid == 'Foo#2'
+
+    @patch('nefertari_guards.acl_utils.helpers')
+    @patch('nefertari_guards.acl_utils.ES')
+    @patch('nefertari_guards.acl_utils._get_es_types')
+    def test_iter_by_ace_ordered(self, mock_types, mock_es, mock_helpers):
+        mock_types.return_value = 'Foo'
+        Foo = Mock()
+        Foo.pk_field.return_value = 'id'
+        mock_helpers.scan.return_value = iter([])
+        ace = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        list(acl_utils.iter_by_ace(ace, [Foo], ordered=True, after='Foo#1'))
+        kwargs = mock_helpers.scan.call_args[1]
+        assert kwargs['preserve_order']
+        assert kwargs['query'] == {
+            'query': {'filtered': {'filter': {'bool': {'must': [
+                acl_utils._get_ace_filter(ace),
+                {'range': {'_uid': {'gt': 'Foo#1'}}},
+            ]}}}},
+            'sort': [{'_uid': 'asc'}],
+        }
+
+    def test_get_ordered_body(self):
+        body = {'query': {'filtered': {'filter': 'foo'}}}
+        assert acl_utils._get_ordered_body(body) == {
+            'query': {'filtered': {'filter': 'foo'}},
+            'sort': [{'_uid': 'asc'}],
+        }
+
+    @patch('nefertari_guards.acl_utils._get_es_types')
+    def test_iter_by_ace_not_es(self, mock_types):
+        mock_types.return_value = ''
+        with pytest.raises(ValueError) as ex:
+            next(acl_utils.iter_by_ace(
+                {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+                []))
+        assert 'No es-based models passed' in str(ex.value)
+
     @patch('nefertari_guards.acl_utils.engine')
     def test_group_by_type(self, mock_eng):
         doc1 = Mock(_type='Foo')
@@ -170,6 +563,35 @@ class TestAclUtils(object):
         assert set(ids.keys()) == {model}
         assert set(ids[model]) == {'user12', 'admin'}
 
+    def test_load_batches(self):
+        doc1 = Mock(_type='Foo', id=1)
+        doc2 = Mock(_type='Foo', id=2)
+        model = Mock(__name__='Foo')
+        model.pk_field.return_value = 'id'
+        model.get_by_ids.side_effect = lambda ids: ['item'] * len(ids)
+        batches = list(acl_utils._load_batches([[doc1, doc2]], [model]))
+        assert batches == [([doc1, doc2], [(model, ['item', 'item'])])]
+        model.get_by_ids.assert_called_once_with([1, 2])
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils._load_batches')
+    def test_update_batches(self, mock_load, mock_commit):
+        model = Mock()
+        mock_load.return_value = iter([
+            ([1, 2], [(model, [3, 4])]),
+            ([5], [(model, [6])]),
+        ])
+        update = Mock(side_effect=lambda model, items: len(items))
+        after_batch = Mock()
+        updated = acl_utils._update_batches(
+            'batches', 'models', update, commit=True,
+            after_batch=after_batch)
+        assert updated == 3
+        mock_load.assert_called_once_with('batches', 'models')
+        update.assert_has_calls([call(model, [3, 4]), call(model, [6])])
+        after_batch.assert_has_calls([call([1, 2], 2), call([5], 3)])
+        assert mock_commit.call_count == 2
+
     def test_replace_docs_ace_ace_missing(self):
         doc = Mock(_acl=[])
         acl_utils._replace_docs_ace([doc], {'foo': 1}, {'bar': 1})
@@ -186,3 +608,230 @@ class TestAclUtils(object):
         acl_utils._replace_docs_ace([doc], {'foo': 1}, {'foo': 2})
         doc.update.assert_called_once_with(
             {'_acl': [{'foo': 2}, {'foo': 2}]})
+
+    def test_replace_docs_ace_compact_acl(self):
+        from nefertari_guards.compact import CompactACL
+        doc = Mock(_acl=CompactACL([
+            _ace('allow', 'user1', 'view'), _ace('deny', 'user2', 'all')]))
+        updated = acl_utils._replace_docs_ace(
+            [doc], _ace('allow', 'user1', 'view'),
+            _ace('allow', 'user3', 'view'))
+        assert updated == 1
+        acl = doc.update.call_args[0][0]['_acl']
+        assert isinstance(acl, CompactACL)
+        assert acl.to_dicts() == [
+            _ace('allow', 'user3', 'view'), _ace('deny', 'user2', 'all')]
+
+
+
+def _ace(action, principal, permission):
+    return {
+        'action': action,
+        'principal': principal,
+        'permission': permission,
+    }
+
+
+class TestBulkUpdateACL(object):
+
+    def test_validate_operations(self):
+        operations = [
+            {'op': 'add', 'ace': _ace('allow', 'a', 'view'),
+             'match': _ace('allow', 'b', 'view')},
+            {'op': 'remove', 'ace': _ace('allow', 'c', 'view')},
+            {'op': 'replace', 'from_ace': _ace('deny', 'd', 'view'),
+             'to_ace': _ace('allow', 'd', 'view')},
+        ]
+        assert acl_utils._validate_operations(operations) == [
+            _ace('allow', 'b', 'view'),
+            _ace('allow', 'c', 'view'),
+            _ace('deny', 'd', 'view'),
+        ]
+
+    def test_validate_operations_empty(self):
+        with pytest.raises(ValueError) as ex:
+            acl_utils._validate_operations([])
+        assert 'No operations passed' in str(ex.value)
+
+    def test_validate_operations_invalid_op(self):
+        with pytest.raises(ValueError) as ex:
+            acl_utils._validate_operations([{'op': 'foo'}])
+        assert 'Invalid operation: foo' in str(ex.value)
+
+    def test_validate_operations_missing_keys(self):
+        with pytest.raises(ValueError) as ex:
+            acl_utils._validate_operations([
+                {'op': 'add', 'ace': _ace('allow', 'a', 'view')}])
+        assert 'Operation "add" requires: match' in str(ex.value)
+
+    def test_validate_operations_invalid_ace(self):
+        with pytest.raises(ValueError) as ex:
+            acl_utils._validate_operations([{
+                'op': 'replace', 'from_ace': _ace('allow', 'a', 'view'),
+                'to_ace': _ace('foo', 'a', 'view')}])
+        assert 'Invalid ACL action value: foo' in str(ex.value)
+
+    def test_apply_operations(self):
+        a, b, c = (
+            _ace('allow', 'a', 'view'), _ace('allow', 'b', 'view'),
+            _ace('allow', 'c', 'view'))
+        deny_d, allow_d = _ace('deny', 'd', 'view'), _ace('allow', 'd', 'view')
+        deny_all = _ace('deny', 'everyone', 'all')
+        acl = [a, b, deny_d, a, deny_all]
+        operations = [
+            {'op': 'remove', 'ace': a},
+            {'op': 'add', 'ace': c, 'match': b},
+            {'op': 'replace', 'from_ace': deny_d, 'to_ace': allow_d},
+        ]
+        result = acl_utils._apply_operations(acl, operations)
+        assert result == [b, c, allow_d, deny_all]
+        assert acl == [a, b, deny_d, a, deny_all]
+
+    def test_apply_operations_add(self):
+        a, b = _ace('allow', 'a', 'view'), _ace('allow', 'b', 'view')
+        operation = {'op': 'add', 'ace': a, 'match': b}
+        assert acl_utils._apply_operations([], [operation]) == []
+        assert acl_utils._apply_operations([b, a], [operation]) == [b, a]
+
+    def test_apply_operations_chained(self):
+        a, b, c = (
+            _ace('allow', 'a', 'view'), _ace('allow', 'b', 'view'),
+            _ace('allow', 'c', 'view'))
+        operations = [
+            {'op': 'replace', 'from_ace': a, 'to_ace': b},
+            {'op': 'add', 'ace': c, 'match': b},
+        ]
+        assert acl_utils._apply_operations([a], operations) == [b, c]
+
+    def test_get_es_body_any(self):
+        a, b = _ace('allow', 'a', 'view'), _ace('allow', 'b', 'view')
+        body = acl_utils._get_es_body_any([a, b, a])
+        should = body['query']['filtered']['filter']['bool']['should']
+        assert should == [
+            acl_utils._get_ace_filter(a),
+            acl_utils._get_ace_filter(b),
+        ]
+
+    @patch('nefertari_guards.acl_utils._commit')
+    @patch('nefertari_guards.acl_utils._iter_documents')
+    @patch('nefertari_guards.acl_utils.engine')
+    def test_bulk_update_acl(self, mock_eng, mock_iter, mock_commit):
+        a, b = _ace('allow', 'a', 'view'), _ace('allow', 'b', 'view')
+        changed = Mock(_acl=[a])
+        unchanged = Mock(_acl=[b])
+        User = Mock(__name__='User')
+        User.pk_field.return_value = 'username'
+        User.get_by_ids.return_value = [changed, unchanged]
+        mock_eng.get_document_classes.return_value = {'User': User}
+        mock_iter.return_value = iter([[
+            Mock(username='user1', _type='User'),
+            Mock(username='user2', _type='User'),
+        ]])
+        operations = [{'op': 'replace', 'from_ace': a, 'to_ace': b}]
+
+        result = acl_utils.bulk_update_acl(
+            operations, batch_size=10, commit=True)
+
+        assert result == 1
+        mock_iter.assert_called_once_with(
+            acl_utils._get_es_body_any([a]), [User], 10)
+        User.get_by_ids.assert_called_once_with(['user1', 'user2'])
+        changed.update.assert_called_once_with({'_acl': [b]})
+        assert not unchanged.update.called
+        mock_commit.assert_called_once_with()
+
+
+class TestACLReport(object):
+
+    def _models(self):
+        Story = Mock(__name__='Story', _index_enabled=True)
+        User = Mock(__name__='User', _index_enabled=False)
+        return Story, User
+
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_acl_report(self, mock_es):
+        mock_es.src2type.side_effect = lambda name: name
+        mock_es.settings.index_name = 'foondex'
+        Story, User = self._models()
+        mock_es.api.search.return_value = {'aggregations': {'types': {
+            'buckets': [{'key': 'Story', 'acl': {'actions': {'buckets': [
+                {'key': 'allow', 'principals': {'buckets': [
+                    {'key': 'user1', 'permissions': {'buckets': [
+                        {'key': 'view', 'documents': {'doc_count': 3}},
+                        {'key': 'all', 'documents': {'doc_count': 1}},
+                    ]}},
+                ]}},
+                {'key': 'deny', 'principals': {'buckets': [
+                    {'key': 'everyone', 'permissions': {'buckets': [
+                        {'key': 'all', 'documents': {'doc_count': 4}},
+                    ]}},
+                ]}},
+            ]}}}],
+        }}}
+        rows = list(acl_utils.acl_report([Story, User], size=5))
+        assert rows == [
+            {'model': 'Story', 'action': 'allow', 'principal': 'user1',
+             'permission': 'view', 'count': 3},
+            {'model': 'Story', 'action': 'allow', 'principal': 'user1',
+             'permission': 'all', 'count': 1},
+            {'model': 'Story', 'action': 'deny', 'principal': 'everyone',
+             'permission': 'all', 'count': 4},
+        ]
+        kwargs = mock_es.api.search.call_args[1]
+        assert kwargs['index'] == 'foondex'
+        assert kwargs['doc_type'] == 'Story'
+        types_agg = kwargs['body']['aggs']['types']
+        assert types_agg['terms'] == {'field': '_type', 'size': 1}
+        acl_agg = types_agg['aggs']['acl']
+        assert acl_agg['nested'] == {'path': '_acl'}
+        actions = acl_agg['aggs']['actions']
+        assert actions['terms'] == {'field': '_acl.action', 'size': 0}
+        principals = actions['aggs']['principals']
+        assert principals['terms'] == {
+            'field': '_acl.principal', 'size': 5}
+        permissions = principals['aggs']['permissions']
+        assert permissions['terms'] == {
+            'field': '_acl.permission', 'size': 0}
+        assert permissions['aggs'] == {
+            'documents': {'reverse_nested': {}}}
+
+    @patch.object(acl_utils.ACLEncoderMixin, 'flat_acl', True)
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_acl_report_flat(self, mock_es):
+        mock_es.src2type.side_effect = lambda name: name
+        Story, User = self._models()
+        mock_es.api.search.return_value = {'aggregations': {'types': {
+            'buckets': [{
+                'key': 'Story',
+                'allow': {'buckets': [
+                    {'key': 'g:admin:all', 'doc_count': 2}]},
+                'deny': {'buckets': [
+                    {'key': 'everyone:view', 'doc_count': 1}]},
+            }],
+        }}}
+        rows = list(acl_utils.acl_report([Story], size=5))
+        assert rows == [
+            {'model': 'Story', 'action': 'allow', 'principal': 'g:admin',
+             'permission': 'all', 'count': 2},
+            {'model': 'Story', 'action': 'deny', 'principal': 'everyone',
+             'permission': 'view', 'count': 1},
+        ]
+        aggs = mock_es.api.search.call_args[1]['body']['aggs']['types']
+        assert aggs['aggs'] == {
+            'allow': {'terms': {'field': '_acl_allow', 'size': 5}},
+            'deny': {'terms': {'field': '_acl_deny', 'size': 5}},
+        }
+
+    def test_acl_report_no_es_models(self):
+        Story, User = self._models()
+        with pytest.raises(ValueError) as ex:
+            list(acl_utils.acl_report([User]))
+        assert 'No es-based models passed' in str(ex.value)
+
+    @patch('nefertari_guards.acl_utils.ES')
+    def test_acl_report_no_index(self, mock_es):
+        mock_es.src2type.side_effect = lambda name: name
+        mock_es.api.search.side_effect = acl_utils.IndexNotFoundException(
+            404, 'missing')
+        Story, User = self._models()
+        assert list(acl_utils.acl_report([Story])) == []
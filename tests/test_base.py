@@ -1,10 +1,50 @@
 import pytest
-from mock import patch
+from mock import patch, Mock
 
 from pyramid.security import (
     Allow, Deny, Everyone, Authenticated, ALL_PERMISSIONS)
 
-from nefertari_guards.base import ACLEncoderMixin, NEF_PERMISSIONS
+from nefertari_guards.base import (
+    ACLEncoderMixin, NEF_PERMISSIONS, OBJECTIFIED_ACL_CACHE, includeme)
+
+
+def test_includeme_cache_size():
+    config = Mock()
+    config.registry.settings = {'nefertari_guards.acl_cache_size': '10'}
+    maxsize = OBJECTIFIED_ACL_CACHE.maxsize
+    try:
+        includeme(config)
+        assert OBJECTIFIED_ACL_CACHE.maxsize == 10
+    finally:
+        OBJECTIFIED_ACL_CACHE.resize(maxsize)
+
+
+@patch.object(ACLEncoderMixin, 'flat_acl', False)
+def test_includeme_flat_acl():
+    config = Mock()
+    config.registry.settings = {'nefertari_guards.flat_acl': 'true'}
+    includeme(config)
+    assert ACLEncoderMixin.flat_acl
+
+
+@patch.object(ACLEncoderMixin, 'add_permissions')
+def test_add_acl_permissions(mock_add):
+    from nefertari_guards.base import add_acl_permissions
+    config = Mock()
+    config.registry.settings = {}
+    includeme(config)
+    config.add_directive.assert_called_once_with(
+        'add_acl_permissions', add_acl_permissions)
+    add_acl_permissions(config, 'publish', 'archive')
+    mock_add.assert_called_once_with(('publish', 'archive'))
+
+
+@patch.object(ACLEncoderMixin, 'compiled_acl', False)
+def test_includeme_compiled_acl():
+    config = Mock()
+    config.registry.settings = {'nefertari_guards.compiled_acl': 'true'}
+    includeme(config)
+    assert ACLEncoderMixin.compiled_acl
 
 
 class TestACLEncoderMixin(object):
@@ -36,13 +76,80 @@ class TestACLEncoderMixin(object):
         expected = 'Invalid ACL permission value: foobarbaz. Valid values are:'
         assert expected in str(ex.value)
 
-    @patch.object(ACLEncoderMixin, '_validate_action')
-    @patch.object(ACLEncoderMixin, '_validate_permission')
-    def test_validate_acl(self, mock_perm, mock_action):
+    def test_validate_acl(self):
+        obj = ACLEncoderMixin()
+        obj.validate_acl([
+            {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+            {'action': 'deny', 'principal': 'b', 'permission': 'all'},
+        ])
+
+    def test_validate_acl_all_errors(self):
         obj = ACLEncoderMixin()
-        obj.validate_acl([{'action': 1, 'principal': 2, 'permission': 3}])
-        mock_action.assert_called_once_with(1)
-        mock_perm.assert_called_once_with(3)
+        with pytest.raises(ValueError) as ex:
+            obj.validate_acl([
+                {'action': 'foo', 'principal': 'a', 'permission': 'view'},
+                {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+                {'action': 'bar', 'principal': 'b', 'permission': 'baz'},
+                {'action': 'deny', 'principal': 'b', 'permission': []},
+            ])
+        errors = str(ex.value).split('\n')
+        assert len(errors) == 4
+        assert errors[0].startswith(
+            'ACE 0: Invalid ACL action value: foo. Valid values are: '
+            'allow, deny')
+        assert errors[1].startswith('ACE 2: Invalid ACL action value: bar')
+        assert errors[2].startswith(
+            'ACE 2: Invalid ACL permission value: baz. Valid values are: '
+            'all, create, delete, options, update, view')
+        assert errors[3].startswith('ACE 3: Invalid ACL permission value: []')
+
+    def test_validate_acl_missing_permission(self):
+        with pytest.raises(ValueError) as ex:
+            ACLEncoderMixin().validate_acl([{'action': 'allow'}])
+        assert 'Invalid ACL permission value: None' in str(ex.value)
+
+    @patch.object(ACLEncoderMixin, 'EXTRA_PERMISSIONS', frozenset())
+    def test_add_permissions(self):
+        class Field(ACLEncoderMixin):
+            pass
+        ACLEncoderMixin.add_permissions(['publish'])
+        assert 'publish' in ACLEncoderMixin.VALID_PERMISSIONS
+        Field().validate_acl([
+            {'action': 'allow', 'principal': 'a', 'permission': 'publish'}])
+
+    @patch.object(ACLEncoderMixin, 'EXTRA_PERMISSIONS', frozenset())
+    def test_add_permissions_subclass(self):
+        class Field(ACLEncoderMixin):
+            pass
+        Field.add_permissions(['publish'])
+        assert 'publish' in Field.VALID_PERMISSIONS
+        assert 'publish' not in ACLEncoderMixin.VALID_PERMISSIONS
+        Field.reset_permissions()
+        assert 'publish' not in Field.VALID_PERMISSIONS
+
+    def test_add_permissions_string(self):
+        with pytest.raises(TypeError) as ex:
+            ACLEncoderMixin.add_permissions('ab')
+        assert 'not a string' in str(ex.value)
+        assert 'a' not in ACLEncoderMixin.VALID_PERMISSIONS
+
+    @patch.object(ACLEncoderMixin, 'EXTRA_PERMISSIONS', frozenset())
+    def test_reset_permissions(self):
+        ACLEncoderMixin.add_permissions(['publish'])
+        ACLEncoderMixin.reset_permissions()
+        assert ACLEncoderMixin.EXTRA_PERMISSIONS == frozenset()
+        assert 'publish' not in ACLEncoderMixin.VALID_PERMISSIONS
+        assert 'view' in ACLEncoderMixin.VALID_PERMISSIONS
+
+    def test_valid_values_subclass(self):
+        class Field(ACLEncoderMixin):
+            ACTIONS = dict(ACLEncoderMixin.ACTIONS, special='sp')
+            PERMISSIONS = dict(ACLEncoderMixin.PERMISSIONS, publish='pub')
+        assert Field.VALID_ACTIONS == frozenset(['allow', 'deny', 'sp'])
+        assert 'pub' in Field.VALID_PERMISSIONS
+        assert 'pub' not in ACLEncoderMixin.VALID_PERMISSIONS
+        Field().validate_acl([
+            {'action': 'sp', 'principal': 'a', 'permission': 'pub'}])
 
     def test_stringify_action_existing(self):
         obj = ACLEncoderMixin()
@@ -99,22 +206,186 @@ class TestACLEncoderMixin(object):
             'authenticated') is Authenticated
         assert ACLEncoderMixin._objectify_principal('foo') == 'foo'
 
+    def test_inverted_tables_subclass(self):
+        class Field(ACLEncoderMixin):
+            ACTIONS = dict(ACLEncoderMixin.ACTIONS, special='sp')
+            PRINCIPALS = {Everyone: 'all-users'}
+        assert Field.ACTIONS_INVERTED['sp'] == 'special'
+        assert Field.PRINCIPALS_INVERTED == {'all-users': Everyone}
+        assert Field.objectify_acl([{
+            'action': 'sp', 'principal': 'all-users', 'permission': 'view',
+        }]) == [('special', Everyone, 'view')]
+        assert 'sp' not in ACLEncoderMixin.ACTIONS_INVERTED
+        assert ACLEncoderMixin.PRINCIPALS_INVERTED == {
+            'everyone': Everyone, 'authenticated': Authenticated}
+
+    def test_inverted_tables_cached(self):
+        assert (ACLEncoderMixin.ACTIONS_INVERTED is
+                ACLEncoderMixin.ACTIONS_INVERTED)
+        with patch.object(ACLEncoderMixin, 'ACTIONS', {Allow: 'yes'}):
+            assert ACLEncoderMixin.ACTIONS_INVERTED == {'yes': Allow}
+        assert ACLEncoderMixin.ACTIONS_INVERTED == {
+            'allow': Allow, 'deny': Deny}
+
     def test_objectify_permission(self):
         assert ACLEncoderMixin._objectify_permission(
             'all') == ALL_PERMISSIONS
         assert ACLEncoderMixin._objectify_permission('foo') == 'foo'
 
-    @patch.object(ACLEncoderMixin, '_objectify_action')
-    @patch.object(ACLEncoderMixin, '_objectify_principal')
-    @patch.object(ACLEncoderMixin, '_objectify_permission')
-    def test_objectify_acl(self, mock_perm, mock_id, mock_action):
-        mock_action.return_value = 1
-        mock_id.return_value = 2
-        mock_perm.return_value = [3]
+    def test_objectify_acl(self):
         result = ACLEncoderMixin.objectify_acl([
-            {'action': 'a', 'principal': 'b', 'permission': 'c'}
+            {'action': 'allow', 'principal': 'everyone',
+             'permission': 'all'},
+            {'action': 'deny', 'principal': 'authenticated',
+             'permission': 'view'},
+            {'action': 'allow', 'principal': 'g:admin',
+             'permission': 'update'},
         ])
-        assert result == [[1, 2, [3]]]
-        mock_action.assert_called_once_with('a')
-        mock_id.assert_called_once_with('b')
-        mock_perm.assert_called_once_with('c')
+        assert result == [
+            (Allow, Everyone, ALL_PERMISSIONS),
+            (Deny, Authenticated, 'view'),
+            (Allow, 'g:admin', 'update'),
+        ]
+
+    def test_objectify_acl_none(self):
+        assert ACLEncoderMixin.objectify_acl(None) == []
+
+    def test_objectify_acl_invalid_action(self):
+        with pytest.raises(KeyError):
+            ACLEncoderMixin.objectify_acl([
+                {'action': 'foo', 'principal': 'b', 'permission': 'c'}])
+
+    def test_objectify_stringify_roundtrip(self):
+        acl = [
+            (Allow, Everyone, ALL_PERMISSIONS),
+            (Deny, 'user1', 'view'),
+        ]
+        stringified = ACLEncoderMixin.stringify_acl(acl)
+        assert ACLEncoderMixin.objectify_acl(stringified) == acl
+
+    def test_acl_fingerprint(self):
+        acl = [
+            {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+            {'action': 'deny', 'principal': 'b', 'permission': 'all'},
+        ]
+        assert ACLEncoderMixin.acl_fingerprint(acl) == (
+            ('allow', 'a', 'view'), ('deny', 'b', 'all'))
+        assert ACLEncoderMixin.acl_fingerprint(None) == ()
+
+    def test_objectify_acl_cached(self):
+        OBJECTIFIED_ACL_CACHE.clear()
+        acl = [{'action': 'allow', 'principal': 'everyone',
+                'permission': 'view'}]
+        result = ACLEncoderMixin.objectify_acl_cached(acl)
+        assert result == ((Allow, Everyone, 'view'),)
+        assert OBJECTIFIED_ACL_CACHE.misses == 1
+        same = ACLEncoderMixin.objectify_acl_cached([dict(acl[0])])
+        assert same is result
+        assert OBJECTIFIED_ACL_CACHE.hits == 1
+
+    @patch.object(ACLEncoderMixin, 'objectify_acl')
+    def test_objectify_acl_cached_unhashable(self, mock_obj):
+        mock_obj.return_value = [1]
+        acl = [{'action': 'allow', 'principal': 'a', 'permission': []}]
+        assert ACLEncoderMixin.objectify_acl_cached(acl) == (1,)
+        mock_obj.assert_called_once_with(acl)
+
+    def test_stringify_acl_interned(self):
+        acls = [ACLEncoderMixin.stringify_acl([
+            (Allow, ''.join(['us', 'er1']), ''.join(['vi', 'ew']))])
+            for _ in range(2)]
+        assert acls[0][0]['principal'] is acls[1][0]['principal']
+        assert acls[0][0]['permission'] is acls[1][0]['permission']
+
+    def test_objectify_acl_interned(self):
+        acls = [ACLEncoderMixin.objectify_acl([{
+            'action': 'allow', 'principal': ''.join(['us', 'er1']),
+            'permission': ''.join(['vi', 'ew'])}]) for _ in range(2)]
+        assert acls[0][0][1] is acls[1][0][1]
+        assert acls[0][0][2] is acls[1][0][2]
+
+    def test_stringify_acl_compact(self):
+        from nefertari_guards.compact import CompactACL
+        ace = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        result = ACLEncoderMixin.stringify_acl(CompactACL([ace]))
+        assert result == [ace]
+        assert type(result[0]) is dict
+
+    def test_objectify_acl_compact(self):
+        from nefertari_guards.compact import CompactACL
+        acl = CompactACL([
+            {'action': 'allow', 'principal': 'everyone',
+             'permission': 'all'}])
+        assert ACLEncoderMixin.objectify_acl(acl) == [
+            (Allow, Everyone, ALL_PERMISSIONS)]
+
+    def test_acl_fingerprint_compact(self):
+        from nefertari_guards.compact import CompactACL
+        acl = [{'action': 'allow', 'principal': 'a', 'permission': 'view'}]
+        assert (ACLEncoderMixin.acl_fingerprint(CompactACL(acl)) ==
+                ACLEncoderMixin.acl_fingerprint(acl))
+
+    def test_validate_acl_compact(self):
+        from nefertari_guards.compact import CompactACL
+        acl = CompactACL([
+            {'action': 'allow', 'principal': 'a', 'permission': 'foo'}])
+        with pytest.raises(ValueError):
+            ACLEncoderMixin().validate_acl(acl)
+
+    def test_compact_acl(self):
+        from nefertari_guards.compact import ACE, CompactACL
+        acl = ACLEncoderMixin.compact_acl([(Allow, Everyone, 'view')])
+        assert isinstance(acl, CompactACL)
+        assert acl == (ACE('allow', 'everyone', 'view'),)
+        assert ACLEncoderMixin.compact_acl(acl) is acl
+
+    def test_compile_acl_cached(self):
+        from nefertari_guards.compiled import CompiledACL
+        OBJECTIFIED_ACL_CACHE.clear()
+        acl = [{'action': 'allow', 'principal': 'everyone',
+                'permission': 'view'}]
+        result = ACLEncoderMixin.compile_acl_cached(acl)
+        assert isinstance(result, CompiledACL)
+        assert result.acl == ((Allow, Everyone, 'view'),)
+        assert result.permits([Everyone], 'view')
+        same = ACLEncoderMixin.compile_acl_cached([dict(acl[0])])
+        assert same is result
+
+    @patch.object(ACLEncoderMixin, 'objectify_acl')
+    def test_compile_acl_cached_unhashable(self, mock_obj):
+        mock_obj.return_value = [(Allow, 'a', 'view')]
+        acl = [{'action': 'allow', 'principal': 'a', 'permission': []}]
+        result = ACLEncoderMixin.compile_acl_cached(acl)
+        mock_obj.assert_called_once_with(acl)
+        assert result.permits(['a'], 'view')
+
+    def test_ace_token(self):
+        assert ACLEncoderMixin.ace_token('g:admin', 'view') == 'g:admin:view'
+
+    def test_flatten_acl(self):
+        acl = [
+            {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+            {'action': 'deny', 'principal': 'b', 'permission': 'all'},
+            {'action': 'allow', 'principal': 'everyone',
+             'permission': 'all'},
+            {'action': 'allow', 'principal': 'a', 'permission': 'view'},
+        ]
+        assert ACLEncoderMixin.flatten_acl(acl) == {
+            '_acl_allow': ['a:view', 'everyone:all'],
+            '_acl_deny': ['b:all'],
+        }
+
+    def test_flatten_acl_pyramid_acl(self):
+        from pyramid.security import Allow, Deny, Everyone, ALL_PERMISSIONS
+        acl = [
+            (Allow, 'a', ['view', 'update']),
+            (Deny, Everyone, ALL_PERMISSIONS),
+        ]
+        assert ACLEncoderMixin.flatten_acl(acl) == {
+            '_acl_allow': ['a:view', 'a:update'],
+            '_acl_deny': ['everyone:all'],
+        }
+
+    def test_flatten_acl_none(self):
+        assert ACLEncoderMixin.flatten_acl(None) == {
+            '_acl_allow': [], '_acl_deny': []}
@@ -0,0 +1,49 @@
+import pytest
+from mock import patch, Mock, call, mock_open
+
+from nefertari_guards.scripts.bulk_update_acl import BulkUpdateACLCommand
+
+
+@patch('nefertari_guards.scripts.bulk_update_acl.'
+       'BulkUpdateACLCommand._parse_options')
+@patch('nefertari_guards.scripts.bulk_update_acl.'
+       'BulkUpdateACLCommand._bootstrap')
+class TestBulkUpdateACLCommand(object):
+
+    def test_run_wrong_operations_format(self, mock_boot, mock_parse):
+        obj = BulkUpdateACLCommand()
+        obj.options = Mock(
+            operations='asdasdasd', operations_file=None, models=None)
+        with pytest.raises(ValueError) as ex:
+            obj.run()
+        assert '--operations' in str(ex.value)
+
+    @patch('nefertari_guards.scripts.bulk_update_acl.engine')
+    @patch('nefertari_guards.scripts.bulk_update_acl.bulk_update_acl')
+    def test_run(self, mock_update, mock_eng, mock_boot, mock_parse):
+        obj = BulkUpdateACLCommand()
+        obj.options = Mock(
+            operations='[{"op": "remove"}]', operations_file=None,
+            models='User,Story', batch_size=10)
+        mock_eng.get_document_cls.side_effect = lambda name: name
+        mock_update.return_value = 2
+        obj.run()
+        mock_eng.get_document_cls.assert_has_calls([
+            call('User'), call('Story')])
+        mock_update.assert_called_once_with(
+            operations=[{'op': 'remove'}], models=['User', 'Story'],
+            batch_size=10, commit=True)
+
+    @patch('nefertari_guards.scripts.bulk_update_acl.bulk_update_acl')
+    def test_run_operations_file(self, mock_update, mock_boot, mock_parse):
+        obj = BulkUpdateACLCommand()
+        obj.options = Mock(
+            operations=None, operations_file='ops.json', models=None,
+            batch_size=10)
+        mock_update.return_value = 0
+        with patch('nefertari_guards.scripts.bulk_update_acl.open',
+                   mock_open(read_data='[{"op": "add"}]'), create=True):
+            obj.run()
+        mock_update.assert_called_once_with(
+            operations=[{'op': 'add'}], models=None,
+            batch_size=10, commit=True)
@@ -0,0 +1,94 @@
+from copy import copy, deepcopy
+import pickle
+
+import pytest
+
+from nefertari_guards.cache import LRUCache, FrozenDict, freeze
+
+
+class TestLRUCache(object):
+
+    def test_get_missing(self):
+        cache = LRUCache(maxsize=2)
+        assert cache.get('foo') is None
+        assert cache.get('foo', 1) == 1
+        assert cache.misses == 2
+        assert cache.hits == 0
+
+    def test_set_get(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('foo', 1)
+        assert cache.get('foo') == 1
+        assert cache.hits == 1
+        assert cache.misses == 0
+        assert 'foo' in cache
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+        assert len(cache) == 2
+        assert 'bar' not in cache
+        assert cache.get('foo') == 1
+        assert cache.get('baz') == 3
+
+    def test_zero_size_stores_nothing(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('foo', 1)
+        assert len(cache) == 0
+
+    def test_resize(self):
+        cache = LRUCache(maxsize=3)
+        for key in range(3):
+            cache.set(key, key)
+        cache.resize(1)
+        assert len(cache) == 1
+        assert 2 in cache
+
+    def test_clear_and_stats(self):
+        cache = LRUCache(maxsize=3)
+        cache.set('foo', 1)
+        cache.get('foo')
+        cache.get('bar')
+        assert cache.stats() == {
+            'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 3}
+        cache.clear()
+        assert cache.stats() == {
+            'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 3}
+
+
+class TestFrozenDict(object):
+
+    def test_immutable(self):
+        frozen = FrozenDict({'foo': 1})
+        with pytest.raises(TypeError):
+            frozen['bar'] = 2
+        with pytest.raises(TypeError):
+            del frozen['foo']
+        with pytest.raises(TypeError):
+            frozen.update({'bar': 2})
+        with pytest.raises(TypeError):
+            frozen.pop('foo')
+        assert frozen == {'foo': 1}
+
+    def test_copies_are_mutable(self):
+        frozen = freeze({'foo': {'bar': [1]}})
+        copied = copy(frozen)
+        copied['baz'] = 1
+        deep = deepcopy(frozen)
+        deep['foo']['bar'] = 2
+        assert type(deep) is dict
+        assert frozen == {'foo': {'bar': (1,)}}
+
+    def test_pickle(self):
+        frozen = FrozenDict({'foo': 1})
+        assert pickle.loads(pickle.dumps(frozen)) == frozen
+
+    def test_freeze(self):
+        frozen = freeze({'foo': [{'bar': 1}, 2], 'baz': 'a'})
+        assert isinstance(frozen, FrozenDict)
+        assert frozen['foo'] == ({'bar': 1}, 2)
+        assert isinstance(frozen['foo'][0], FrozenDict)
+        assert frozen['baz'] == 'a'
@@ -0,0 +1,88 @@
+import pickle
+
+import pytest
+
+from nefertari_guards.compact import ACE, CompactACL
+
+
+def _ace(action, principal, permission):
+    return {
+        'action': action,
+        'principal': principal,
+        'permission': permission,
+    }
+
+
+class TestACE(object):
+
+    def test_dict_access(self):
+        ace = ACE('allow', 'user1', 'view')
+        assert ace['action'] == 'allow'
+        assert ace['principal'] == 'user1'
+        assert ace['permission'] == 'view'
+        assert ace[0] == 'allow'
+        assert ace[1:] == ('user1', 'view')
+        assert ace.get('action') == 'allow'
+        assert ace.get('foo', 1) == 1
+        with pytest.raises(KeyError):
+            ace['count']
+
+    def test_dict_conversion(self):
+        ace = ACE.from_dict(_ace('deny', 'everyone', 'all'))
+        assert ace == ('deny', 'everyone', 'all')
+        assert ace.to_dict() == _ace('deny', 'everyone', 'all')
+
+    def test_equals_dict(self):
+        ace = ACE('allow', 'user1', 'view')
+        assert ace == _ace('allow', 'user1', 'view')
+        assert _ace('allow', 'user1', 'view') == ace
+        assert ace != _ace('allow', 'user1', 'update')
+        assert ace in [_ace('allow', 'user1', 'view')]
+        assert _ace('allow', 'user1', 'view') in CompactACL([ace])
+
+    def test_hash(self):
+        ace = ACE('allow', 'user1', 'view')
+        assert hash(ace) == hash(('allow', 'user1', 'view'))
+
+    def test_strings_interned(self):
+        first = ACE(*'allow user1 view'.split())
+        second = ACE(*'allow user1 view'.split())
+        assert all(a is b for a, b in zip(first, second))
+
+    def test_slots(self):
+        with pytest.raises(AttributeError):
+            ACE('allow', 'user1', 'view').foo = 1
+
+
+class TestCompactACL(object):
+
+    def test_create(self):
+        acl = CompactACL([
+            _ace('allow', 'user1', 'view'), ACE('deny', 'user2', 'all')])
+        assert all(isinstance(ace, ACE) for ace in acl)
+        assert acl.to_dicts() == [
+            _ace('allow', 'user1', 'view'), _ace('deny', 'user2', 'all')]
+        assert CompactACL() == ()
+
+    def test_pickle(self):
+        acl = CompactACL([_ace('allow', 'user1', 'view')])
+        assert pickle.loads(pickle.dumps(acl)) == acl
+
+    def test_replace(self):
+        acl = CompactACL([
+            _ace('allow', 'user1', 'view'),
+            _ace('deny', 'user2', 'all'),
+            _ace('allow', 'user1', 'view'),
+        ])
+        result = acl.replace(
+            _ace('allow', 'user1', 'view'), _ace('allow', 'user3', 'view'))
+        assert isinstance(result, CompactACL)
+        assert result.to_dicts() == [
+            _ace('allow', 'user3', 'view'),
+            _ace('deny', 'user2', 'all'),
+            _ace('allow', 'user3', 'view'),
+        ]
+
+    def test_replace_missing(self):
+        acl = CompactACL([_ace('allow', 'user1', 'view')])
+        assert acl.replace(_ace('allow', 'user2', 'view'), {}) is None
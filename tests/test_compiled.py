@@ -0,0 +1,139 @@
+import random
+
+import pytest
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import (
+    Allow, Deny, Everyone, Authenticated, ALL_PERMISSIONS)
+
+from nefertari_guards.compiled import (
+    CompiledACL, PERMISSION_BITS, OTHER_BIT, ALL_BITS)
+
+
+PRINCIPALS = [Everyone, Authenticated, 'user1', 'user2', 'g:admins']
+PERMISSIONS = sorted(PERMISSION_BITS) + ['custom']
+
+
+class Context(object):
+    def __init__(self, acl):
+        self.__acl__ = acl
+
+
+def pyramid_permits(acl, principals, permission):
+    return bool(ACLAuthorizationPolicy().permits(
+        Context(acl), principals, permission))
+
+
+def random_acl(rnd, size, permissions):
+    acl = []
+    for _ in range(size):
+        perms = rnd.choice(permissions + [ALL_PERMISSIONS] * 2)
+        if rnd.random() < 0.2:
+            perms = tuple(rnd.sample(permissions, 2))
+        acl.append((
+            rnd.choice([Allow, Deny]), rnd.choice(PRINCIPALS), perms))
+    return acl
+
+
+def assert_equivalent(acl):
+    compiled = CompiledACL(acl)
+    for size in range(len(PRINCIPALS) + 1):
+        principals = PRINCIPALS[:size]
+        for permission in PERMISSIONS:
+            expected = pyramid_permits(acl, principals, permission)
+            assert compiled.permits(principals, permission) == expected, (
+                acl, principals, permission)
+    return compiled
+
+
+def _authorization_all_permissions():
+    """ Get ALL_PERMISSIONS of pyramid.authorization defined by
+    Pyramid 2.
+    """
+    from pyramid import authorization
+    if not hasattr(authorization, 'ALL_PERMISSIONS'):
+        pytest.skip('Pyramid 2 is required')
+    return authorization.ALL_PERMISSIONS
+
+
+class TestCompiledACL(object):
+
+    def test_bits(self):
+        assert sorted(PERMISSION_BITS) == [
+            'create', 'delete', 'options', 'update', 'view']
+        assert OTHER_BIT not in PERMISSION_BITS.values()
+        assert ALL_BITS == sum(PERMISSION_BITS.values()) | OTHER_BIT
+
+    def test_empty(self):
+        compiled = assert_equivalent([])
+        assert compiled.entries == {}
+        assert not compiled.permits([Everyone], 'view')
+
+    def test_entries(self):
+        compiled = CompiledACL([
+            (Allow, 'user1', 'view'),
+            (Deny, 'user1', ALL_PERMISSIONS),
+            (Allow, 'user1', 'update'),
+        ])
+        assert compiled.exact
+        allow, deny, positions = compiled.entries['user1']
+        assert allow == PERMISSION_BITS['view']
+        assert deny == ALL_BITS & ~PERMISSION_BITS['view']
+        assert positions[PERMISSION_BITS['view']] == 0
+        assert positions[PERMISSION_BITS['update']] == 1
+
+    def test_first_match_across_principals(self):
+        acl = [(Deny, 'user1', 'view'), (Allow, Everyone, 'view')]
+        compiled = assert_equivalent(acl)
+        assert not compiled.permits([Everyone, 'user1'], 'view')
+        assert compiled.permits([Everyone, 'user2'], 'view')
+
+    def test_later_principal_order_irrelevant(self):
+        acl = [(Allow, Everyone, 'view'), (Deny, 'user1', 'view')]
+        compiled = assert_equivalent(acl)
+        assert compiled.permits(['user1', Everyone], 'view')
+
+    def test_all_permissions(self):
+        acl = [(Allow, 'g:admins', ALL_PERMISSIONS),
+               (Deny, Everyone, ALL_PERMISSIONS)]
+        compiled = assert_equivalent(acl)
+        assert compiled.permits(['g:admins', Everyone], 'custom')
+        assert not compiled.permits([Everyone], 'view')
+
+    def test_authorization_all_permissions(self):
+        all_permissions = _authorization_all_permissions()
+        acl = [(Deny, 'user1', all_permissions),
+               (Allow, Everyone, all_permissions)]
+        compiled = CompiledACL(acl)
+        assert compiled.exact
+        assert compiled.entries['user1'][1] == ALL_BITS
+        assert compiled.permits([Everyone], 'custom')
+        assert not compiled.permits(['user1', Everyone], 'view')
+
+    def test_authorization_all_permissions_walk(self):
+        all_permissions = _authorization_all_permissions()
+        acl = [(Deny, 'user1', 'custom'), (Allow, 'user1', all_permissions)]
+        compiled = CompiledACL(acl)
+        assert not compiled.exact
+        assert compiled.permits(['user1'], 'view')
+
+    def test_permission_sequences(self):
+        acl = [(Allow, 'user1', ('view', 'update')),
+               (Deny, 'user1', ['view', 'delete'])]
+        compiled = assert_equivalent(acl)
+        assert compiled.permits(['user1'], 'view')
+        assert not compiled.permits(['user1'], 'delete')
+
+    def test_unknown_permission_walks_acl(self):
+        acl = [(Deny, 'user1', 'custom'), (Allow, 'user1', ALL_PERMISSIONS)]
+        compiled = assert_equivalent(acl)
+        assert not compiled.exact
+        assert not compiled.permits(['user1'], 'custom')
+        assert compiled.permits(['user1'], 'view')
+
+    @pytest.mark.parametrize('seed', range(200))
+    def test_random_acls(self, seed):
+        rnd = random.Random(seed)
+        permissions = sorted(PERMISSION_BITS)
+        if seed % 4 == 0:
+            permissions.append('custom')
+        assert_equivalent(random_acl(rnd, rnd.randint(1, 12), permissions))
@@ -11,29 +11,30 @@ class TestCountACECommand(object):
     @patch('nefertari_guards.scripts.count_ace.engine')
     def test_run_wrong_ace_format(self, mock_eng, mock_boot, mock_parse):
         obj = CountACECommand()
-        obj.options = Mock(ace='asdasdasdasd', models='User,Story')
+        obj.options = Mock(
+            ace='asdasdasdasd', aces=None, models='User,Story')
         with pytest.raises(ValueError) as ex:
             obj.run()
         assert '--ace' in str(ex.value)
         mock_eng.get_document_cls.assert_has_calls([
             call('User'), call('Story')])
 
-    @patch('nefertari_guards.scripts.count_ace.count_ace')
+    @patch('nefertari_guards.scripts.count_ace.count_aces')
     def test_run_no_models(
             self, mock_count, mock_boot, mock_parse):
         obj = CountACECommand()
-        obj.options = Mock(ace='{}', models=None)
-        mock_count.return_value = {Mock(__name__='Foo'): 1}
+        obj.options = Mock(ace='{}', aces=None, models=None)
+        mock_count.return_value = [{Mock(__name__='Foo'): 1}]
         obj.run()
-        mock_count.assert_called_once_with(ace={}, models=None)
+        mock_count.assert_called_once_with(aces=[{}], models=None)
 
-    @patch('nefertari_guards.scripts.count_ace.count_ace')
+    @patch('nefertari_guards.scripts.count_ace.count_aces')
     @patch('nefertari_guards.scripts.count_ace.six')
     def test_run_none_count(
             self, mock_six, mock_count, mock_boot, mock_parse):
         obj = CountACECommand()
-        obj.options = Mock(ace='{}', models='')
-        mock_count.return_value = {Mock(__name__='Foo'): None}
+        obj.options = Mock(ace='{}', aces=None, models='')
+        mock_count.return_value = [{Mock(__name__='Foo'): None}]
         obj.run()
         mock_six.print_.assert_has_calls([
             call('Model,Count'),
@@ -41,19 +42,46 @@ class TestCountACECommand(object):
         ])
 
     @patch('nefertari_guards.scripts.count_ace.engine')
-    @patch('nefertari_guards.scripts.count_ace.count_ace')
+    @patch('nefertari_guards.scripts.count_ace.count_aces')
     @patch('nefertari_guards.scripts.count_ace.six')
     def test_run(
             self, mock_six, mock_count, mock_eng, mock_boot,
             mock_parse):
         obj = CountACECommand()
-        obj.options = Mock(ace='{}', models='User')
+        obj.options = Mock(ace='{}', aces=None, models='User')
         model = Mock(__name__='Foo')
         mock_eng.get_document_cls.return_value = model
-        mock_count.return_value = {model: 123}
+        mock_count.return_value = [{model: 123}]
         obj.run()
         mock_six.print_.assert_has_calls([
             call('Model,Count'),
             call('Foo,123'),
         ])
-        mock_count.assert_called_once_with(ace={}, models=[model])
+        mock_count.assert_called_once_with(aces=[{}], models=[model])
+
+    def test_run_wrong_aces_format(self, mock_boot, mock_parse):
+        obj = CountACECommand()
+        obj.options = Mock(ace=None, aces='asdasd', models=None)
+        with pytest.raises(ValueError) as ex:
+            obj.run()
+        assert '--aces' in str(ex.value)
+
+    @patch('nefertari_guards.scripts.count_ace.count_aces')
+    @patch('nefertari_guards.scripts.count_ace.six')
+    def test_run_aces(self, mock_six, mock_count, mock_boot, mock_parse):
+        obj = CountACECommand()
+        obj.options = Mock(
+            ace=None, models=None,
+            aces=('[{"action": "allow", "principal": "a", '
+                  '"permission": "view"}, {"action": "deny", '
+                  '"principal": "b", "permission": "all"}]'))
+        model = Mock(__name__='Foo')
+        mock_count.return_value = [{model: 1}, {model: None}]
+        obj.run()
+        mock_six.print_.assert_has_calls([
+            call('Action,Principal,Permission,Model,Count'),
+            call('allow,a,view,Foo,1'),
+            call('deny,b,all,Foo,Not es-based'),
+        ])
+        assert mock_count.call_args[1]['models'] is None
+        assert len(mock_count.call_args[1]['aces']) == 2
@@ -24,8 +24,17 @@ class TestDocumentACLMixin(object):
         document._acl = 'foo'
         result = document.get_acl()
         field = document_cls._engine_mock.ACLField
-        field.objectify_acl.assert_called_once_with('foo')
-        assert result == field.objectify_acl()
+        field.objectify_acl_cached.assert_called_once_with('foo')
+        assert result == field.objectify_acl_cached()
+
+    def test_get_compiled_acl(self):
+        document_cls = self._mocked_document_cls()
+        document = document_cls()
+        document._acl = 'foo'
+        result = document.get_compiled_acl()
+        field = document_cls._engine_mock.ACLField
+        field.compile_acl_cached.assert_called_once_with('foo')
+        assert result == field.compile_acl_cached()
 
     def test_set_default_acl(self):
         document_cls = self._mocked_document_cls()
@@ -55,3 +64,51 @@ class TestDocumentACLMixin(object):
         document._acl = 123
         document._set_default_acl()
         assert document._acl == 123
+
+    def _mocked_indexed_cls(self, flat_acl):
+        from nefertari_guards.base import ACLEncoderMixin
+
+        class Base(object):
+            def to_dict(self, **kwargs):
+                return {'id': 1, '_acl': self._acl}
+
+            @classmethod
+            def get_es_mapping(cls, types_map=None, **kwargs):
+                return {'Foo': {'properties': {'id': {'type': 'long'}}}}
+
+        engine = Mock()
+        engine.ACLField = type('ACLField', (ACLEncoderMixin,), {
+            'flat_acl': flat_acl})
+        mixin = docs.get_document_mixin(engine)
+        return type('Foo', (mixin, Base), {})
+
+    def test_to_dict_flat_acl_not_added(self):
+        document = self._mocked_indexed_cls(flat_acl=True)()
+        document._acl = [
+            {'action': 'allow', 'principal': 'a', 'permission': 'view'}]
+        assert document.to_dict() == {'id': 1, '_acl': document._acl}
+
+    def test_to_dict_no_flat_acl(self):
+        document = self._mocked_indexed_cls(flat_acl=False)()
+        document._acl = []
+        assert document.to_dict() == {'id': 1, '_acl': []}
+
+    def test_to_dict_compact_acl(self):
+        from nefertari_guards.compact import CompactACL
+        ace = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        document = self._mocked_indexed_cls(flat_acl=False)()
+        document._acl = CompactACL([ace])
+        data = document.to_dict()
+        assert data['_acl'] == [ace]
+        assert type(data['_acl'][0]) is dict
+
+    def test_get_es_mapping_flat_acl(self):
+        from nefertari_guards.base import FLAT_ACL_MAPPING
+        properties = self._mocked_indexed_cls(
+            flat_acl=True).get_es_mapping()['Foo']['properties']
+        assert properties['_acl_allow'] == FLAT_ACL_MAPPING['_acl_allow']
+        assert properties['_acl_deny'] == FLAT_ACL_MAPPING['_acl_deny']
+
+    def test_get_es_mapping_no_flat_acl(self):
+        mapping = self._mocked_indexed_cls(flat_acl=False).get_es_mapping()
+        assert mapping == {'Foo': {'properties': {'id': {'type': 'long'}}}}
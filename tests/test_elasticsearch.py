@@ -1,7 +1,9 @@
+import pytest
 from mock import patch, call, Mock
-from nefertari.utils import DataProxy
+from nefertari.utils import DataProxy, dictset
 
 from nefertari_guards import elasticsearch as es
+from nefertari_guards.base import ACLEncoderMixin
 
 
 class TestESHelpers(object):
@@ -32,9 +34,10 @@ class TestESHelpers(object):
         assert (Deny, 'admin', 'delete') in acl
         assert (Deny, 'admin', ALL_PERMISSIONS) in acl
 
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
     @patch('nefertari_guards.elasticsearch._build_acl_bool_terms')
     @patch('nefertari_guards.elasticsearch._build_acl_from_principals')
-    def test_build_acl_query(self, build_princ, build_terms):
+    def test_build_acl_query(self, build_princ, build_terms, mock_engine):
         from pyramid.security import Deny, Allow
         build_princ.return_value = [(1, 2, 3)]
         build_terms.return_value = 'foo'
@@ -44,8 +47,8 @@ class TestESHelpers(object):
             call(['user', 'admin'], Deny, 'update'),
         ])
         build_terms.assert_has_calls([
-            call([(1, 2, 3)], Allow),
-            call([(1, 2, 3)], Deny),
+            call([(1, 2, 3)], Allow, '_acl'),
+            call([(1, 2, 3)], Deny, '_acl'),
         ])
         must = must_not = {
             'nested': {
@@ -58,65 +61,281 @@ class TestESHelpers(object):
             'must_not': must_not
         }
 
-    @patch('nefertari_guards.elasticsearch._check_permissions')
-    def test_check_relations_permissions_dict(self, mock_check):
-        mock_check.return_value = 1
+    def _visibility_request(self, visible):
+        """ Mock request that allows viewing documents ACLs of which
+        include :visible: principal.
+        """
+        request = Mock()
+
+        def has_permission(permission, context):
+            principals = [ace[1] for ace in context.__acl__]
+            return visible in principals
+        request.has_permission.side_effect = has_permission
+        return request
+
+    def _doc(self, principal, **data):
+        data.setdefault('_type', 'Story')
+        data['_acl'] = [{
+            'action': 'allow', 'principal': principal,
+            'permission': 'view'}]
+        return data
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_dict(self, mock_engine):
+        request = self._visibility_request('user1')
         document = {
             'one': 2,
             'two': {},
-            'three': ['foo', 'bar']
+            'three': ['foo', 'bar'],
+            'four': self._doc('user1', id=1),
+            'five': self._doc('user2', id=2),
+            'six': [self._doc('user2', id=3), self._doc('user1', id=4)],
         }
-        request = 'Foo'
         checked = es.check_relations_permissions(request, document)
-        assert checked == {
-            'one': 1,
-            'two': 1,
-            'three': [1, 1]
+        assert checked is document
+        assert checked['one'] == 2
+        assert checked['two'] == {}
+        assert checked['three'] == ['foo', 'bar']
+        assert checked['four']['id'] == 1
+        assert checked['five'] is None
+        assert [doc['id'] for doc in checked['six']] == [4]
+
+    @patch('nefertari_guards.elasticsearch.metrics._hook')
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_metrics(self, mock_engine, hook):
+        request = self._visibility_request('user1')
+        document = {
+            'one': self._doc('user2', id=1),
+            'two': [self._doc('user1', id=2), self._doc('user2', id=3)],
         }
-        mock_check.assert_has_calls([
-            call(request, 2),
-            call(request, {}),
-            call(request, 'foo'),
-            call(request, 'bar'),
-        ], any_order=True)
-
-    @patch('nefertari_guards.elasticsearch._check_permissions')
-    def test_check_relations_permissions_dataproxy(self, mock_check):
-        mock_check.return_value = 1
+        es.check_relations_permissions(request, document)
+        hook.assert_any_call(
+            'nefertari_guards.documents_checked', 3, 'count')
+        hook.assert_any_call(
+            'nefertari_guards.relations_pruned', 2, 'count')
+        name, _, kind = hook.call_args[0]
+        assert name == 'nefertari_guards.check_relations_permissions'
+        assert kind == 'timing'
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_dataproxy(self, mock_engine):
+        request = self._visibility_request('user1')
         data = {
             'one': 2,
-            'two': {},
-            'three': ['foo', 'bar']
+            'two': self._doc('user2'),
+            'three': (self._doc('user1', id=1), self._doc('user2', id=2)),
         }
         document = DataProxy(data)
-        request = 'Foo'
         checked = es.check_relations_permissions(request, document)
-        assert checked._data == {
-            'one': 1,
-            'two': 1,
-            'three': [1, 1]
-        }
-        mock_check.assert_has_calls([
-            call(request, 2),
-            call(request, {}),
-            call(request, 'foo'),
-            call(request, 'bar'),
-        ], any_order=True)
-
-    @patch('nefertari_guards.elasticsearch._check_permissions')
-    def test_check_relations_permissions_none_dropped(self, mock_check):
-        mock_check.return_value = None
-        document = {
-            'one': 2,
-            'two': {},
-            'three': ['foo', 'bar']
+        assert checked is document
+        assert checked._data['one'] == 2
+        assert checked._data['two'] is None
+        assert [doc['id'] for doc in checked._data['three']] == [1]
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_nested(self, mock_engine):
+        request = self._visibility_request('user1')
+        document = self._doc('user1', author=self._doc(
+            'user1',
+            profile=self._doc('user2'),
+            stories=[self._doc('user2'), self._doc('user1', id=3)]))
+        denied_parent = self._doc('user2', author=self._doc('user1'))
+        document['denied'] = denied_parent
+        checked = es.check_relations_permissions(request, document)
+        assert checked['author']['profile'] is None
+        assert [doc['id'] for doc in checked['author']['stories']] == [3]
+        assert checked['denied'] is None
+        # Relations of denied documents are not checked
+        assert denied_parent['author'] is not None
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_deep(self, mock_engine):
+        import sys
+        request = self._visibility_request('user1')
+        document = node = self._doc('user1')
+        for _ in range(sys.getrecursionlimit()):
+            node['child'] = self._doc('user1')
+            node = node['child']
+        node['child'] = self._doc('user2')
+        es.check_relations_permissions(request, document)
+        assert node['child'] is None
+        assert request.has_permission.call_count == 2
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_acl_skipped(self, mock_engine):
+        request = self._visibility_request('user1')
+        document = self._doc('user1')
+        document['_acl'].append({'_type': 'Story'})
+        es.check_relations_permissions(request, document)
+        assert not request.has_permission.called
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_relations_index(self, mock_engine):
+        request = self._visibility_request('user1')
+        document = self._doc(
+            'user1',
+            author=self._doc('user1', profile=self._doc('user2')),
+            editor=self._doc('user2'),
+        )
+        index = {'Story': {'author': {'profile': {}}}}
+        with patch.object(es.ACLFilterES, 'relations_index', index):
+            es.check_relations_permissions(request, document)
+        assert document['author']['profile'] is None
+        assert document['editor'] is not None
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_relations_index_leaf(
+            self, mock_engine):
+        request = self._visibility_request('user1')
+        document = self._doc(
+            'user1', author=self._doc('user1', profile=self._doc('user2')))
+        index = {'Story': {'author': {}}}
+        with patch.object(es.ACLFilterES, 'relations_index', index):
+            es.check_relations_permissions(request, document)
+        assert document['author']['profile'] is not None
+        assert request.has_permission.call_count == 1
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_check_relations_permissions_relations_index_unknown_type(
+            self, mock_engine):
+        request = self._visibility_request('user1')
+        document = self._doc('user1', author=self._doc('user2'))
+        index = {'User': {}}
+        with patch.object(es.ACLFilterES, 'relations_index', index):
+            es.check_relations_permissions(request, document)
+        assert document['author'] is None
+
+    def test_relations_tree(self):
+        properties = {
+            'id': {'type': 'long'},
+            '_acl': {'type': 'nested', 'properties': {}},
+            'owner': {'type': 'string'},
+            'author': {
+                'type': 'nested',
+                'properties': {
+                    '_acl': {'type': 'nested'},
+                    'stories': {'type': 'long'},
+                    'profile': {
+                        'type': 'nested',
+                        'properties': {'id': {'type': 'long'}},
+                    },
+                },
+            },
         }
-        checked = es.check_relations_permissions('Foo', document)
-        assert checked == {
-            'one': None,
-            'two': None,
-            'three': []
+        assert es._relations_tree(properties) == {
+            'author': {'profile': {}}}
+
+    def _page(self):
+        return [
+            self._doc('user1', id=1, author=self._doc(
+                'user1', id=10,
+                profile=self._doc('user2'),
+                stories=[self._doc('user2'), self._doc('user1', id=3)])),
+            self._doc('user2', id=2, author=self._doc('user2', id=20)),
+            self._doc('user1', id=4, tags=(
+                self._doc('user1', id=5), self._doc('user2', id=6)),
+                plain=[{'foo': 1}], empty=[]),
+            'not a document',
+        ]
+
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_filter_documents(self, mock_engine):
+        request = self._visibility_request('user1')
+        page = self._page()
+        page[0] = DataProxy(page[0])
+        visible = es.filter_documents(request, page, 'view')
+        assert len(visible) == 3
+        assert visible[0] is page[0]
+        assert visible[1]['id'] == 4
+        assert visible[2] == 'not a document'
+        assert [doc['id'] for doc in visible[1]['tags']] == [5]
+        assert visible[0]._data['author']['profile'] is None
+        assert request.has_permission.call_count == 2
+
+    def test_intern_acls(self):
+        def make_hit():
+            ace = {'action': ''.join(['al', 'low']),
+                   'principal': ''.join(['us', 'er1']), 'permission': 1}
+            return {'_source': {'_acl': [ace, 'foo'], 'author': {
+                '_acl': [dict(ace)], 'tags': [{'_acl': [dict(ace)]}, 1]}},
+                'inner_hits': {'x': {'hits': {'hits': [
+                    {'_source': {'_acl': [dict(ace)]}}]}}}}
+        first, second = make_hit(), make_hit()
+        es.intern_acls(first)
+        es.intern_acls(second)
+        aces = [
+            first['_source']['_acl'][0],
+            second['_source']['_acl'][0],
+            second['_source']['author']['_acl'][0],
+            second['_source']['author']['tags'][0]['_acl'][0],
+            second['inner_hits']['x']['hits']['hits'][0]['_source'][
+                '_acl'][0],
+        ]
+        for ace in aces:
+            assert ace['action'] is aces[0]['action']
+            assert ace['principal'] is aces[0]['principal']
+            assert ace['permission'] == 1
+        assert second['_source']['_acl'][1] == 'foo'
+
+    def test_intern_acls_dicts_not_iterated(self):
+        class Source(dict):
+            def __iter__(self):
+                raise AssertionError('Dict iterated as ACL')
+        data = {'_source': Source(_acl=[{'action': 'allow'}])}
+        es.intern_acls(data)
+        assert data['_source']['_acl'] == [{'action': 'allow'}]
+
+    def test_hits_api(self):
+        api = Mock()
+        api.search.return_value = {'hits': {'hits': [1, 2]}}
+        api.get_source.return_value = {'_acl': []}
+        process_hit = Mock()
+        wrapper = es.HitsAPI(api, process_hit)
+        assert wrapper.search(body=1) == {'hits': {'hits': [1, 2]}}
+        api.search.assert_called_once_with(body=1)
+        assert wrapper.get_source(id=1) == {'_acl': []}
+        process_hit.assert_has_calls([
+            call(1), call(2), call({'_source': {'_acl': []}})])
+        assert wrapper.count is api.count
+
+    def test_hits_api_mget(self):
+        api = Mock()
+        api.mget.return_value = {'docs': [{'_id': 1}, {'_id': 2}]}
+        process_hit = Mock()
+        wrapper = es.HitsAPI(api, process_hit)
+        assert wrapper.mget(body=1) == {'docs': [{'_id': 1}, {'_id': 2}]}
+        api.mget.assert_called_once_with(body=1)
+        process_hit.assert_has_calls([call({'_id': 1}), call({'_id': 2})])
+
+    def test_intern_acls_mget(self):
+        ace = {'action': ''.join(['al', 'low']), 'principal': 'user1',
+               'permission': 'view'}
+        api = Mock()
+        api.mget.return_value = {'docs': [
+            {'_id': 1, 'found': True, '_source': {'_acl': [ace]}},
+            {'_id': 2, 'found': False},
+        ]}
+        data = es.HitsAPI(api, es.intern_acls).mget(body=1)
+        interned = data['docs'][0]['_source']['_acl'][0]['action']
+        assert interned is es.intern_string('allow')
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', True)
+    @patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+    def test_flatten_acls(self, mock_engine):
+        ace = {'action': 'allow', 'principal': 'a', 'permission': 'view'}
+        data = {
+            '_acl': [ace],
+            'author': {'_acl': []},
+            'comments': [{'_acl': [ace]}, 1],
+            'tags': ['a'],
         }
+        es.flatten_acls(data)
+        assert data['_acl_allow'] == ['a:view']
+        assert data['_acl_deny'] == []
+        assert data['author']['_acl_allow'] == []
+        assert data['comments'][0]['_acl_allow'] == ['a:view']
+        assert data['comments'][1] == 1
+        assert 'tags_allow' not in data
 
     def test_check_permissions_invalid_doc(self):
         assert es._check_permissions(None, 1) == 1
@@ -130,9 +349,9 @@ class TestESHelpers(object):
         request.has_permission.return_value = False
         document = {'_type': 'Story', '_acl': ['foobar']}
         assert es._check_permissions(request, document) is None
-        mock_engine.ACLField.objectify_acl.assert_called_once_with(
+        mock_engine.ACLField.objectify_acl_cached.assert_called_once_with(
             ['foobar'])
-        objectified = mock_engine.ACLField.objectify_acl()
+        objectified = mock_engine.ACLField.objectify_acl_cached()
         mock_ctx.assert_called_once_with(objectified)
         request.has_permission.assert_any_call('view', mock_ctx())
 
@@ -145,22 +364,268 @@ class TestESHelpers(object):
         request.has_permission.return_value = True
         document = {'_type': 'Story', '_acl': ['foobar']}
         result = es._check_permissions(request, document)
-        mock_engine.ACLField.objectify_acl.assert_called_once_with(
+        mock_engine.ACLField.objectify_acl_cached.assert_called_once_with(
             ['foobar'])
-        objectified = mock_engine.ACLField.objectify_acl()
+        objectified = mock_engine.ACLField.objectify_acl_cached()
         mock_ctx.assert_called_once_with(objectified)
         request.has_permission.assert_any_call('view', mock_ctx())
         mock_check.assert_called_once_with(request, document)
         assert result == mock_check()
 
 
-class TestACLFilterES(object):
+class TestCachedACLQuery(object):
+
+    def setup_method(self, method):
+        es.ACL_QUERY_CACHE.clear()
+
+    @patch('nefertari_guards.elasticsearch.build_acl_query')
+    def test_cached(self, mock_build):
+        mock_build.return_value = {'must': [{'foo': 1}], 'must_not': {}}
+        query = es.cached_acl_query(['b', 'a', 'a'], 'view')
+        assert query == {'must': ({'foo': 1},), 'must_not': {}}
+        mock_build.assert_called_once_with(['a', 'b'], 'view', path='_acl')
+        assert es.cached_acl_query(['a', 'b'], 'view') is query
+        assert mock_build.call_count == 1
+        assert es.ACL_QUERY_CACHE.hits == 1
+
+    @patch('nefertari_guards.elasticsearch.build_acl_query')
+    def test_cache_key(self, mock_build):
+        mock_build.return_value = {}
+        es.cached_acl_query(['a'], 'view')
+        es.cached_acl_query(['a'], 'update')
+        es.cached_acl_query(['a'], 'view', path='foo._acl')
+        es.cached_acl_query(['b'], 'view')
+        assert mock_build.call_count == 4
 
     @patch('nefertari_guards.elasticsearch.build_acl_query')
+    def test_immutable(self, mock_build):
+        import pytest
+        mock_build.return_value = {'must': [{'foo': 1}]}
+        query = es.cached_acl_query(['a'], 'view')
+        with pytest.raises(TypeError):
+            query['must_not'] = {}
+        with pytest.raises(TypeError):
+            query['must'][0]['bar'] = 1
+        with pytest.raises(AttributeError):
+            query['must'].append(1)
+
+    @patch('nefertari.elasticsearch.ES.setup')
+    def test_cleared_on_setup(self, mock_setup):
+        from nefertari.utils import dictset
+        es.ACL_QUERY_CACHE.set('foo', 1)
+        es.ACLFilterES.setup(dictset())
+        assert 'foo' not in es.ACL_QUERY_CACHE
+
+
+@patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+class TestDecisionCache(object):
+
+    def test_from_request(self, mock_engine):
+        request = Mock()
+        cache = es.DecisionCache.from_request(request)
+        assert isinstance(cache, es.DecisionCache)
+        assert es.DecisionCache.from_request(request) is cache
+
+    def test_has_permission_cached(self, mock_engine):
+        from pyramid.security import Allow, Everyone
+        request = Mock()
+        request.has_permission.return_value = True
+        cache = es.DecisionCache()
+        acl = [{'action': 'allow', 'principal': 'everyone',
+                'permission': 'view'}]
+        assert cache.has_permission(request, acl, 'view')
+        assert cache.has_permission(request, [dict(acl[0])], 'view')
+        assert request.has_permission.call_count == 1
+        permission, context = request.has_permission.call_args[0]
+        assert permission == 'view'
+        assert list(context.__acl__) == [(Allow, Everyone, 'view')]
+        assert cache.evaluated == 1
+        assert cache.saved == 1
+
+    def test_has_permission_denied_cached(self, mock_engine):
+        request = Mock()
+        request.has_permission.return_value = False
+        cache = es.DecisionCache()
+        assert not cache.has_permission(request, [], 'view')
+        assert not cache.has_permission(request, [], 'view')
+        assert request.has_permission.call_count == 1
+        assert cache.saved == 1
+
+    def test_has_permission_per_permission(self, mock_engine):
+        request = Mock()
+        request.has_permission.return_value = True
+        cache = es.DecisionCache()
+        cache.has_permission(request, [], 'view')
+        cache.has_permission(request, [], 'update')
+        assert request.has_permission.call_count == 2
+        assert cache.evaluated == 2
+        assert cache.saved == 0
+
+    def _acl_policy_request(self, principals):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        request = Mock(effective_principals=principals)
+        request.registry.queryUtility.return_value = ACLAuthorizationPolicy()
+        return request
+
+    def test_from_request_compiled(self, mock_engine):
+        request = self._acl_policy_request(['user1'])
+        with patch.object(ACLEncoderMixin, 'compiled_acl', True):
+            cache = es.DecisionCache.from_request(request)
+        assert cache.principals == ['user1']
+
+    def test_from_request_compiled_principals_interned(self, mock_engine):
+        principal = ''.join(['us', 'er1'])
+        request = self._acl_policy_request([principal])
+        with patch.object(ACLEncoderMixin, 'compiled_acl', True):
+            cache = es.DecisionCache.from_request(request)
+        assert cache.principals[0] is es.intern_string('user1')
+
+    def test_from_request_compiled_other_policy(self, mock_engine):
+        request = Mock()
+        with patch.object(ACLEncoderMixin, 'compiled_acl', True):
+            cache = es.DecisionCache.from_request(request)
+        assert cache.principals is None
+
+    def test_has_permission_compiled(self, mock_engine):
+        from pyramid.security import Everyone
+        principals = [Everyone, 'user1']
+        request = self._acl_policy_request(principals)
+        cache = es.DecisionCache(principals=principals)
+        acl = [{'action': 'deny', 'principal': 'user1', 'permission': 'all'},
+               {'action': 'allow', 'principal': 'everyone',
+                'permission': 'view'}]
+        assert not cache.has_permission(request, acl, 'view')
+        assert cache.has_permission(request, acl[1:], 'view')
+        assert not request.has_permission.called
+        assert cache.evaluated == 2
+
+
+@pytest.fixture
+def indexed_actions():
+    """ Include nefertari_guards.elasticsearch and collect actions of ES
+    bulk requests made by nefertari ES.
+    """
+    actions = []
+
+    def bulk_body(documents_actions, request=None):
+        actions.extend(documents_actions)
+
+    config = Mock()
+    config.registry.settings = {}
+    settings = dictset(index_name='foondex', chunk_size=10)
+    with patch.object(es.ES, 'prep_bulk_documents',
+                      es.ES.prep_bulk_documents), \
+            patch.object(es.ES, 'settings', settings), \
+            patch.object(es.ACLFilterES, 'setup'), \
+            patch('nefertari.elasticsearch._bulk_body', bulk_body), \
+            patch('nefertari_guards.elasticsearch.engine',
+                  ACLField=ACLEncoderMixin):
+        es.includeme(config)
+        yield actions
+
+
+class TestFlatACLIndexing(object):
+    ace = {'action': 'deny', 'principal': 'a', 'permission': 'all'}
+
+    def _document(self, pk):
+        document = Mock()
+        document.to_dict.return_value = {
+            '_pk': pk, '_acl': [self.ace],
+            'author': {'_pk': 2, '_acl': []}}
+        return document
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', True)
+    def test_engine_index_object(self, indexed_actions):
+        signals = pytest.importorskip('nefertari_sqla.signals')
+        signals.index_object(self._document(1), with_refs=False)
+        source = indexed_actions[0]['_source']
+        assert source['_acl_allow'] == []
+        assert source['_acl_deny'] == ['a:all']
+        assert source['author']['_acl_deny'] == []
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', True)
+    def test_bulk_index_relations(self, indexed_actions):
+        model = Mock(__name__='Story', _index_enabled=True)
+        item = Mock()
+        item.get_related_documents.return_value = [
+            (model, [self._document(1)])]
+        es.ES.bulk_index_relations([item], nested_only=True)
+        source = indexed_actions[0]['_source']
+        assert source['_acl_deny'] == ['a:all']
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', False)
+    def test_no_flat_acl(self, indexed_actions):
+        es.ES('Story').index(self._document(1).to_dict())
+        assert '_acl_allow' not in indexed_actions[0]['_source']
+
+
+class TestACLFilterES(object):
+
+    def test_includeme(self):
+        config = Mock()
+        config.registry.settings = {}
+        with patch.object(es.ACLFilterES, 'setup') as mock_setup:
+            with patch.object(es.ES, 'prep_bulk_documents'):
+                es.includeme(config)
+                assert es.ES.prep_bulk_documents is es.prep_bulk_documents
+        mock_setup.assert_called_once_with({})
+        config.action.assert_called_once_with(
+            'nefertari_guards.relations_index',
+            es.ACLFilterES.build_relations_index)
+
+    def test_init_intern_acls(self):
+        obj = es.ACLFilterES('Foo', 'foondex', chunk_size=10)
+        assert not isinstance(obj.api, es.HitsAPI)
+        with patch.object(es.ACLFilterES, 'intern_acls', True):
+            obj = es.ACLFilterES('Foo', 'foondex', chunk_size=10)
+        assert isinstance(obj.api, es.HitsAPI)
+        assert obj.api._api is es.ES.api
+        assert obj.api._process_hit is es.intern_acls
+
+    @patch('nefertari_guards.elasticsearch.engine')
+    @patch('nefertari_guards.elasticsearch.nefertari_engine')
+    def test_build_relations_index(self, mock_engine, mock_guards_engine):
+        story_mapping = {'Story': {'properties': {
+            'author': {'type': 'nested', 'properties': {}},
+            'name': {'type': 'string'},
+        }}}
+        Story = Mock(_index_enabled=True)
+        Story.get_es_mapping.return_value = story_mapping
+        User = Mock(_index_enabled=False)
+        mock_engine.get_document_classes.return_value = {
+            'Story': Story, 'User': User}
+        with patch.object(es.ACLFilterES, 'relations_index', {}):
+            index = es.ACLFilterES.build_relations_index()
+            assert es.ACLFilterES.relations_index == index
+        assert index == {'Story': {'author': {}}}
+        assert not User.get_es_mapping.called
+        mock_guards_engine.is_list_relationship.assert_called_once_with(
+            Story, 'author')
+
+    @patch('nefertari.elasticsearch.ES.setup')
+    def test_setup(self, mock_setup):
+        from nefertari.utils import dictset
+        settings = dictset({
+            'nefertari_guards.es_relations_filter': 'true',
+            'nefertari_guards.es_relations_filter_size': '5',
+            'nefertari_guards.acl_filter_context': 'false',
+            'nefertari_guards.es_intern_acls': 'true',
+        })
+        with patch.multiple(
+                es.ACLFilterES, filter_relations=False, inner_hits_size=100,
+                acl_filter_context=True, intern_acls=False):
+            es.ACLFilterES.setup(settings)
+            assert es.ACLFilterES.filter_relations
+            assert es.ACLFilterES.inner_hits_size == 5
+            assert not es.ACLFilterES.acl_filter_context
+            assert es.ACLFilterES.intern_acls
+        mock_setup.assert_called_once_with(settings)
+
+    @patch('nefertari_guards.elasticsearch.cached_acl_query')
     def test_build_search_params(self, mock_build):
         obj = es.ACLFilterES('Foo', 'foondex', chunk_size=10)
         obj._req_permission = 'view'
-        mock_build.return_value = {'must': ['zoo']}
+        mock_build.return_value = {'must': ('zoo',), 'must_not': 'bar'}
         params = obj.build_search_params(
             {'foo': 1, '_limit': 10, '_principals': [3, 4]})
         assert sorted(params.keys()) == sorted([
@@ -168,10 +633,9 @@ class TestACLFilterES(object):
         assert params['body'] == {
             'query': {
                 'bool': {
-                    'must': [
-                        'zoo',
-                        {'query_string': {'query': 'foo:1'}}
-                    ]
+                    'filter': ['zoo'],
+                    'must': [{'query_string': {'query': 'foo:1'}}],
+                    'must_not': 'bar',
                 }
             }
         }
@@ -179,6 +643,35 @@ class TestACLFilterES(object):
         assert params['doc_type'] == 'Foo'
         mock_build.assert_called_once_with([3, 4], 'view')
 
+    @patch('nefertari_guards.elasticsearch.cached_acl_query')
+    def test_build_search_params_scoring(self, mock_build):
+        obj = es.ACLFilterES('Foo', 'foondex', chunk_size=10)
+        obj._req_permission = 'view'
+        obj.acl_filter_context = False
+        mock_build.return_value = {'must': ('zoo',), 'must_not': 'bar'}
+        params = obj.build_search_params(
+            {'foo': 1, '_limit': 10, '_principals': [3, 4]})
+        assert params['body'] == {
+            'query': {
+                'bool': {
+                    'must': [
+                        'zoo',
+                        {'query_string': {'query': 'foo:1'}}
+                    ],
+                    'must_not': 'bar',
+                }
+            }
+        }
+
+    def test_acl_bool_query_no_query(self):
+        obj = es.ACLFilterES('Foo', 'foondex', chunk_size=10)
+        acl_query = {'must': ('zoo',), 'must_not': 'bar'}
+        assert obj._acl_bool_query(acl_query) == {
+            'bool': {'filter': ['zoo'], 'must_not': 'bar'}}
+        obj.acl_filter_context = False
+        assert obj._acl_bool_query(acl_query) == {
+            'bool': {'must': ['zoo'], 'must_not': 'bar'}}
+
     @patch('nefertari_guards.elasticsearch.check_relations_permissions')
     @patch('nefertari_guards.elasticsearch.ES.get_collection')
     def test_get_collection_no_request(self, mock_get, mock_filter):
@@ -246,3 +739,169 @@ class TestACLFilterES(object):
         obj.get_item(request=request, foo=1)
         mock_get.assert_called_once_with(foo=1)
         mock_filter.assert_called_once_with(request, 1)
+
+
+""" Hand-written response in ES 2.x format to a collection query built
+by ACLFilterES with relationships filtering enabled.
+"""
+INNER_HITS_RESPONSE = {
+    'took': 3,
+    'hits': {
+        'total': 1,
+        'hits': [{
+            '_index': 'foondex',
+            '_type': 'Story',
+            '_id': '1',
+            '_score': 1.0,
+            '_source': {'id': 1, 'name': 'Story 1', '_acl': []},
+            'inner_hits': {
+                'comments': {'hits': {'total': 2, 'hits': [
+                    {'_type': 'Story', '_id': '1', '_score': 0.0,
+                     '_nested': {'field': 'comments', 'offset': 2},
+                     '_source': {'_type': 'Comment', 'id': 3}},
+                    {'_type': 'Story', '_id': '1', '_score': 0.0,
+                     '_nested': {'field': 'comments', 'offset': 0},
+                     '_source': {'_type': 'Comment', 'id': 1}},
+                ]}},
+                'author': {'hits': {'total': 0, 'hits': []}},
+            },
+        }],
+    },
+}
+
+
+@patch('nefertari_guards.elasticsearch.engine', ACLField=ACLEncoderMixin)
+class TestACLFilterESRelationsFilter(object):
+
+    def _es(self):
+        obj = es.ACLFilterES('Story', 'foondex', chunk_size=10)
+        obj.relations_index = {'Story': {'comments': {}, 'author': {}}}
+        obj.list_relations = {'Story': {'comments'}}
+        obj.filter_relations = True
+        obj._req_permission = 'view'
+        return obj
+
+    def test_build_search_params(self, mock_engine):
+        obj = self._es()
+        params = obj.build_search_params({
+            '_limit': 10, '_principals': ['user1'],
+            '_filter_relations': True})
+        body = params['body']
+        assert body['_source'] == {'exclude': ['author', 'comments']}
+        should = body['query']['bool']['should']
+        assert len(should) == 2
+        nested = [clause['nested'] for clause in should]
+        assert sorted(n['path'] for n in nested) == ['author', 'comments']
+        comments = [n for n in nested if n['path'] == 'comments'][0]
+        assert comments['inner_hits'] == {'name': 'comments', 'size': 100}
+        assert comments['score_mode'] == 'none'
+        acl_query = es.cached_acl_query(
+            ['user1'], 'view', path='comments._acl')
+        assert comments['query'] == {'bool': {
+            'filter': list(acl_query['must']),
+            'must_not': acl_query['must_not'],
+        }}
+
+    def test_build_search_params_no_filter_relations(self, mock_engine):
+        obj = self._es()
+        params = obj.build_search_params({
+            '_limit': 10, '_principals': ['user1']})
+        assert '_source' not in params['body']
+        assert 'should' not in params['body']['query']['bool']
+
+    def test_build_acl_query_path(self, mock_engine):
+        query = es.build_acl_query(['user1'], 'view', path='comments._acl')
+        nested = query['must'][0]['nested']
+        assert nested['path'] == 'comments._acl'
+        terms = nested['filter']['bool']['must']
+        assert {'term': {'comments._acl.action': 'allow'}} in terms
+        assert query['must_not']['nested']['path'] == 'comments._acl'
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', True)
+    def test_build_acl_query_flat(self, mock_engine):
+        from pyramid.security import Everyone
+        query = es.build_acl_query(['user1', Everyone], 'view')
+        tokens = [
+            'everyone:all', 'everyone:view', 'user1:all', 'user1:view']
+        assert query == {
+            'must': [{'terms': {'_acl_allow': tokens}}],
+            'must_not': {'terms': {'_acl_deny': tokens}},
+        }
+
+    @patch.object(ACLEncoderMixin, 'flat_acl', True)
+    def test_build_acl_query_flat_path(self, mock_engine):
+        query = es.build_acl_query(['user1'], 'view', path='comments._acl')
+        tokens = ['user1:all', 'user1:view']
+        assert query == {
+            'must': [{'terms': {'comments._acl_allow': tokens}}],
+            'must_not': {'terms': {'comments._acl_deny': tokens}},
+        }
+
+    def test_filters_relations(self, mock_engine):
+        obj = self._es()
+        assert obj._filters_relations({})
+        assert not obj._filters_relations({'_count': True})
+        assert not obj._filters_relations({'_fields': ['id']})
+        obj.filter_relations = False
+        assert not obj._filters_relations({})
+        obj.filter_relations = True
+        obj.doc_type = 'User'
+        assert not obj._filters_relations({})
+
+    def test_get_filtered_collection(self, mock_engine):
+        from copy import deepcopy
+        obj = self._es()
+        obj.api = Mock()
+        obj.api.search.return_value = deepcopy(INNER_HITS_RESPONSE)
+        documents = obj._get_filtered_collection(
+            _limit=10, _principals=['user1'])
+        assert documents._nefertari_meta == {
+            'start': 0, 'fields': '', 'total': 1, 'took': 3}
+        assert len(documents) == 1
+        data = documents[0]._data
+        assert data['name'] == 'Story 1'
+        assert data['_type'] == 'Story'
+        assert [c['id'] for c in data['comments']] == [1, 3]
+        assert data['author'] is None
+        body = obj.api.search.call_args[1]['body']
+        assert body['_source'] == {'exclude': ['author', 'comments']}
+
+    def test_get_filtered_collection_truncated(self, mock_engine):
+        from copy import deepcopy
+        obj = self._es()
+        obj.api = Mock()
+        response = deepcopy(INNER_HITS_RESPONSE)
+        hit = response['hits']['hits'][0]
+        hit['inner_hits']['comments']['hits']['total'] = 5
+        obj.api.search.return_value = response
+        obj.api.get_source.return_value = {'id': 1, 'comments': [1]}
+        documents = obj._get_filtered_collection(_limit=10)
+        obj.api.get_source.assert_called_once_with(
+            index='foondex', doc_type='Story', id='1')
+        assert documents[0]._data['comments'] == [1]
+
+    def test_get_filtered_collection_no_index(self, mock_engine):
+        from nefertari.elasticsearch import IndexNotFoundException
+        obj = self._es()
+        obj.api = Mock()
+        obj.api.search.side_effect = IndexNotFoundException
+        documents = obj._get_filtered_collection(_limit=10)
+        assert len(documents) == 0
+        assert documents._nefertari_meta['total'] == 0
+
+    @patch('nefertari_guards.elasticsearch.check_relations_permissions')
+    @patch('nefertari_guards.elasticsearch.ES.get_collection')
+    def test_get_collection(self, mock_get, mock_check, mock_engine):
+        from nefertari.elasticsearch import _ESDocs
+        obj = self._es()
+        request = Mock(effective_principals=['user1'], action='index')
+        request.registry.settings = {'auth': 'true'}
+        docs = _ESDocs([1])
+        docs._nefertari_meta = {}
+        with patch.object(obj, '_get_filtered_collection') as mock_filtered:
+            mock_filtered.return_value = docs
+            obj.get_collection(request=request, _limit=10)
+        mock_filtered.assert_called_once_with(
+            _limit=10, _principals=['user1'])
+        assert not mock_get.called
+        mock_check.assert_called_once_with(request, 1)
@@ -0,0 +1,94 @@
+from mock import Mock, patch, call
+
+import pytest
+
+from nefertari_guards import metrics
+from nefertari_guards.base import ACLEncoderMixin
+
+
+@pytest.fixture
+def hook():
+    hook = Mock()
+    metrics.set_hook(hook)
+    yield hook
+    metrics.set_hook(None)
+
+
+def test_includeme():
+    config = Mock()
+    config.registry.settings = {
+        'nefertari_guards.metrics_hook': 'foo.bar'}
+    try:
+        metrics.includeme(config)
+        config.maybe_dotted.assert_called_once_with('foo.bar')
+        assert metrics.enabled()
+        assert metrics._hook is config.maybe_dotted()
+    finally:
+        metrics.set_hook(None)
+
+
+def test_includeme_no_hook():
+    config = Mock()
+    config.registry.settings = {}
+    config.maybe_dotted.return_value = None
+    metrics.includeme(config)
+    config.maybe_dotted.assert_called_once_with(None)
+    assert not metrics.enabled()
+
+
+def test_incr(hook):
+    metrics.incr('foo')
+    metrics.incr('bar', 3)
+    metrics.incr('zero', 0)
+    assert hook.mock_calls == [
+        call('foo', 1, metrics.COUNT),
+        call('bar', 3, metrics.COUNT),
+    ]
+
+
+def test_incr_disabled():
+    metrics.set_hook(None)
+    metrics.incr('foo')
+
+
+@patch('nefertari_guards.metrics._clock')
+def test_timed(mock_clock, hook):
+    mock_clock.side_effect = [1.0, 1.5]
+
+    @metrics.timed('foo')
+    def func(a, b=1):
+        return a + b
+
+    assert func(1, b=2) == 3
+    hook.assert_called_once_with('foo', 500.0, metrics.TIMING)
+    assert func.__name__ == 'func'
+
+
+@patch('nefertari_guards.metrics._clock')
+def test_timed_error(mock_clock, hook):
+    mock_clock.side_effect = [1.0, 2.0]
+
+    @metrics.timed('foo')
+    def func():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        func()
+    hook.assert_called_once_with('foo', 1000.0, metrics.TIMING)
+
+
+@patch('nefertari_guards.metrics._clock')
+def test_timed_disabled(mock_clock):
+    metrics.set_hook(None)
+    func = metrics.timed('foo')(lambda: 1)
+    assert func() == 1
+    assert not mock_clock.called
+
+
+def test_objectify_acl_aces_decoded(hook):
+    ACLEncoderMixin.objectify_acl([
+        {'action': 'allow', 'principal': 'user1', 'permission': 'view'},
+        {'action': 'deny', 'principal': 'user2', 'permission': 'all'},
+    ])
+    hook.assert_called_once_with(
+        'nefertari_guards.aces_decoded', 2, metrics.COUNT)
@@ -0,0 +1,113 @@
+import pytest
+from mock import Mock, call
+
+pytest.importorskip('mongoengine')
+
+from nefertari_guards.nefertari_mongodb import replace_ace
+
+
+def _ace(action, principal, permission):
+    return {
+        'action': action,
+        'principal': principal,
+        'permission': permission,
+    }
+
+
+def _model(collection):
+    class Story(object):
+        _fields = {
+            'id': Mock(db_field='_id'),
+            '_acl': Mock(db_field='_acl'),
+        }
+
+        @classmethod
+        def pk_field(cls):
+            return 'id'
+
+        @classmethod
+        def _get_collection(cls):
+            return collection
+
+    return Story
+
+
+class TestReplaceAce(object):
+
+    def test_replace_ace(self):
+        from_ace = _ace('allow', 'user1', 'view')
+        to_ace = _ace('deny', 'user2', 'view')
+        collection = Mock()
+        collection.find.side_effect = [
+            iter([{'_id': 1}, {'_id': 3}]),
+            [{'_id': 1, '_acl': [to_ace]}],
+            [{'_id': 3, '_acl': [to_ace]}],
+        ]
+        collection.update_many.side_effect = [
+            Mock(modified_count=1), Mock(modified_count=0)]
+        modified, rows = replace_ace(
+            _model(collection), from_ace, to_ace, batch_size=1)
+        assert modified == 1
+        assert rows == [(1, [to_ace]), (3, [to_ace])]
+        query = {'_acl': {'$elemMatch': from_ace}}
+        collection.find.assert_has_calls([
+            call(query, {'_id': 1}, batch_size=1),
+            call({'_id': {'$in': [1]}}, {'_acl': 1}),
+            call({'_id': {'$in': [3]}}, {'_acl': 1}),
+        ])
+        array_filters = [{
+            'elem.action': 'allow',
+            'elem.principal': 'user1',
+            'elem.permission': 'view',
+        }]
+        collection.update_many.assert_has_calls([
+            call(dict(query, _id={'$in': [1]}),
+                 {'$set': {'_acl.$[elem]': to_ace}},
+                 array_filters=array_filters),
+            call(dict(query, _id={'$in': [3]}),
+                 {'$set': {'_acl.$[elem]': to_ace}},
+                 array_filters=array_filters),
+        ])
+
+    def test_replace_ace_no_matches(self):
+        collection = Mock()
+        collection.find.return_value = iter([])
+        result = replace_ace(
+            _model(collection), _ace('allow', 'user1', 'view'),
+            _ace('deny', 'user1', 'view'))
+        assert result == (0, [])
+        assert not collection.update_many.called
+
+
+@pytest.fixture
+def mongo_collection():
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=500)
+    try:
+        client.server_info()
+    except pymongo.errors.PyMongoError:
+        pytest.skip('MongoDB is not available')
+    collection = client.nefertari_guards_test.stories
+    collection.drop()
+    yield collection
+    collection.drop()
+
+
+def test_replace_ace_mongod(mongo_collection):
+    from_ace = _ace('allow', 'user1', 'view')
+    to_ace = _ace('deny', 'user2', 'view')
+    other = _ace('allow', 'everyone', 'all')
+    mongo_collection.insert_many([
+        {'_id': 1, '_acl': [other, from_ace, other, from_ace]},
+        {'_id': 2, '_acl': [other]},
+        {'_id': 3, '_acl': [from_ace]},
+    ])
+    modified, rows = replace_ace(
+        _model(mongo_collection), from_ace, to_ace, batch_size=1)
+    assert modified == 2
+    assert sorted(rows) == [
+        (1, [other, to_ace, other, to_ace]),
+        (3, [to_ace]),
+    ]
+    acls = {doc['_id']: doc['_acl'] for doc in mongo_collection.find()}
+    assert acls[2] == [other]
@@ -13,3 +13,90 @@ class TestACLType(object):
         obj.process_bind_param([('a', 'b', 'c')], Mock())
         mock_str.assert_called_once_with([('a', 'b', 'c')])
         mock_validate.assert_called_once_with([[1, 2, [3]]])
+
+
+class TestReplaceAce(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import Column, Integer, create_engine
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import sessionmaker
+
+        Base = declarative_base()
+
+        class Story(Base):
+            __tablename__ = 'stories'
+            id = Column(Integer, primary_key=True)
+            _acl = Column(ACLType)
+
+            @classmethod
+            def pk_field(cls):
+                return 'id'
+
+        self.model = Story
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def _ace(self, action, principal, permission):
+        return {
+            'action': action,
+            'principal': principal,
+            'permission': permission,
+        }
+
+    def test_replace_ace(self):
+        from nefertari_guards.nefertari_sqla import replace_ace
+        from_ace = self._ace('allow', 'user1', 'view')
+        to_ace = self._ace('deny', 'user2', 'view')
+        other = self._ace('allow', 'everyone', 'all')
+        self.session.add_all([
+            self.model(id=1, _acl=[other, from_ace, other, from_ace]),
+            self.model(id=2, _acl=[other]),
+            self.model(id=3, _acl=[from_ace]),
+            self.model(id=4, _acl=[]),
+        ])
+        self.session.flush()
+
+        updated, rows = replace_ace(
+            self.model, from_ace, to_ace, session=self.session)
+
+        assert updated == 2
+        assert sorted(rows) == [
+            (1, [other, to_ace, other, to_ace]),
+            (3, [to_ace]),
+        ]
+        acls = dict(self.session.query(self.model.id, self.model._acl))
+        assert acls == {
+            1: [other, to_ace, other, to_ace],
+            2: [other],
+            3: [to_ace],
+            4: [],
+        }
+
+    def test_replace_ace_no_matches(self):
+        from nefertari_guards.nefertari_sqla import replace_ace
+        other = self._ace('allow', 'everyone', 'all')
+        self.session.add(self.model(id=1, _acl=[other]))
+        result = replace_ace(
+            self.model, self._ace('allow', 'user1', 'view'), other,
+            session=self.session)
+        assert result == (0, [])
+
+    def test_replace_ace_expires_loaded_objects(self):
+        from nefertari_guards.nefertari_sqla import replace_ace
+        from_ace = self._ace('allow', 'user1', 'view')
+        to_ace = self._ace('deny', 'user2', 'view')
+        story = self.model(id=1, _acl=[from_ace])
+        self.session.add(story)
+        replace_ace(self.model, from_ace, to_ace, session=self.session)
+        assert story._acl == [to_ace]
+
+    def test_replace_ace_not_supported(self):
+        import pytest
+        from nefertari_guards.nefertari_sqla import replace_ace
+        session = Mock()
+        session.get_bind().dialect.name = 'mysql'
+        with pytest.raises(ValueError) as ex:
+            replace_ace(self.model, {}, {}, session=session)
+        assert 'not supported by mysql' in str(ex.value)
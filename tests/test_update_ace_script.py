@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from mock import patch, Mock, call
 
@@ -34,21 +36,72 @@ class TestUpdateACECommand(object):
     def test_run_no_models(
             self, mock_count, mock_boot, mock_parse):
         obj = UpdateACECommand()
-        obj.options = Mock(to_ace='{}', from_ace='{}', models=None)
-        mock_count.return_value = {Mock(__name__='Foo'): 1}
+        obj.options = Mock(
+            to_ace='{}', from_ace='{}', models=None, batch_size=10,
+            workers=1, server_side=False, dry_run=False, checkpoint=None,
+            resume=False)
+        mock_count.return_value = 1
         obj.run()
         mock_count.assert_called_once_with(
-            to_ace={}, from_ace={}, models=None)
+            to_ace={}, from_ace={}, models=None, batch_size=10,
+            commit=True, workers=1, server_side=False, checkpoint=None,
+            resume=False)
 
     @patch('nefertari_guards.scripts.update_ace.engine')
     @patch('nefertari_guards.scripts.update_ace.update_ace')
     def test_run(self, mock_count, mock_eng, mock_boot, mock_parse):
         obj = UpdateACECommand()
         obj.options = Mock(
-            from_ace='{"a": 1}', to_ace='{"b": 2}', models='User')
+            from_ace='{"a": 1}', to_ace='{"b": 2}', models='User',
+            batch_size=10, workers=1, server_side=False, dry_run=False,
+            checkpoint='update.json', resume=True)
         model = Mock(__name__='Foo')
         mock_eng.get_document_cls.return_value = model
-        mock_count.return_value = {model: 123}
+        mock_count.return_value = 123
         obj.run()
         mock_count.assert_called_once_with(
-            from_ace={"a": 1}, to_ace={"b": 2}, models=[model])
+            from_ace={"a": 1}, to_ace={"b": 2}, models=[model],
+            batch_size=10, commit=True, workers=1, server_side=False,
+            checkpoint='update.json', resume=True)
+
+    @patch('nefertari_guards.scripts.update_ace.update_ace')
+    @patch('nefertari_guards.scripts.update_ace.six')
+    def test_run_dry_run_compact_acl(self, mock_six, mock_update, mock_boot,
+                                     mock_parse):
+        from nefertari_guards.compact import CompactACL
+        before = {'action': 'allow', 'principal': 'everyone',
+                  'permission': 'view'}
+        after = {'action': 'deny', 'principal': 'everyone',
+                 'permission': 'view'}
+        obj = UpdateACECommand()
+        obj.options = Mock(
+            from_ace='{"a": 1}', to_ace='{"b": 2}', models=None,
+            batch_size=10, dry_run=True)
+        mock_update.return_value = iter([
+            {'model': 'Foo', 'id': 1, 'before': CompactACL([before]),
+             'after': CompactACL([after])},
+        ])
+        obj.run()
+        printed = json.loads(mock_six.print_.call_args[0][0])
+        assert printed['before'] == [before]
+        assert printed['after'] == [after]
+
+    @patch('nefertari_guards.scripts.update_ace.update_ace')
+    @patch('nefertari_guards.scripts.update_ace.six')
+    def test_run_dry_run(self, mock_six, mock_update, mock_boot,
+                         mock_parse):
+        obj = UpdateACECommand()
+        obj.options = Mock(
+            from_ace='{"a": 1}', to_ace='{"b": 2}', models=None,
+            batch_size=10, dry_run=True)
+        mock_update.return_value = iter([
+            {'model': 'Foo', 'id': 1, 'before': [{'a': 1}],
+             'after': [{'b': 2}]},
+        ])
+        obj.run()
+        mock_update.assert_called_once_with(
+            from_ace={"a": 1}, to_ace={"b": 2}, models=None,
+            batch_size=10, dry_run=True)
+        mock_six.print_.assert_called_once_with(
+            '{"after": [{"b": 2}], "before": [{"a": 1}], '
+            '"id": 1, "model": "Foo"}')